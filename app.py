@@ -27,6 +27,8 @@ import json
 import os
 import re
 import numpy as np
+import soundfile as sf
+from io import BytesIO
 from threading import Thread,Event
 #import multiprocessing
 import torch.multiprocessing as mp
@@ -37,6 +39,9 @@ import aiohttp_cors
 from aiortc import RTCPeerConnection, RTCSessionDescription
 from aiortc.rtcrtpsender import RTCRtpSender
 from webrtc import HumanPlayer
+from audiostream import Framer
+from micvad import MicIngest,load_asr_hook
+import httpclient
 
 import argparse
 import random
@@ -51,7 +56,9 @@ app = Flask(__name__)
 nerfreals = {}
 opt = None
 model = None
-avatar = None
+avatars = None  #AvatarRegistry
+governor = None  #按负载调整各会话的质量档位
+mic_asr = None  #上行麦克风的语音识别, fn(audio)->text
 
 
 # def llm_response(message):
@@ -113,6 +120,14 @@ avatar = None
 #==========================================
 
 
+def mic_response(nerfreal):
+    def on_utterance(audio):
+        text = mic_asr(audio)
+        print('mic asr:',text)
+        if text:
+            llm_response(text,nerfreal)
+    return on_utterance
+
 def llm_response(message,nerfreal):
     # 检查是否是表演命令  
     if "表演" in message and ("古筝" in message or "节目" in message):  
@@ -194,14 +209,37 @@ def randN(N):
     max = pow(10, N)
     return random.randint(min, max - 1)
 
-def build_nerfreal(sessionid):
+def build_nerfreal(sessionid,avatar_id):
     opt.sessionid=sessionid
 
     from lipreal import LipReal
-    nerfreal = LipReal(opt,model,avatar)
+    avatar_model = model
+    if opt.engine=='onnxruntime_int8': #avatar有通过评估的int8模型时使用, 否则用fp32
+        from onnxquant import load_avatar_int8
+        avatar_model = load_avatar_int8(avatar_id,opt.ort_intra_threads,opt.ort_inter_threads) or model
+    avatar = avatars.acquire(avatar_id)
+    try:
+        nerfreal = LipReal(opt,avatar_model,avatar)
+    except Exception:
+        avatars.release(avatar_id)
+        raise
+    nerfreal.avatar_id = avatar_id
+    if governor is not None:
+        governor.register(sessionid,nerfreal.load)
 
     return nerfreal
 
+def close_nerfreal(sessionid):
+    nerfreal = nerfreals.pop(sessionid,None)
+    if governor is not None:
+        governor.unregister(sessionid)
+    if nerfreal is not None:
+        avatars.release(nerfreal.avatar_id)
+
+def valid_avatar_id(avatar_id):
+    return (isinstance(avatar_id,str) and re.fullmatch(r'[\w\-.]+',avatar_id) is not None
+            and avatar_id not in ('.','..') and os.path.isdir(f"./data/avatars/{avatar_id}"))
+
 #@app.route('/offer', methods=['POST'])
 async def offer(request):
     params = await request.json()
@@ -210,10 +248,22 @@ async def offer(request):
     if len(nerfreals) >= opt.max_session:
         print('reach max session')
         return -1
+    avatar_id = params.get('avatar_id') or opt.avatar_id
+    if not valid_avatar_id(avatar_id):
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "msg": f"avatar {avatar_id} not found"}
+            ),
+        )
     sessionid = randN(6) #len(nerfreals)
-    print('sessionid=',sessionid)
+    print('sessionid=',sessionid,'avatar_id=',avatar_id)
     nerfreals[sessionid] = None
-    nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal,sessionid)
+    try:
+        nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal,sessionid,avatar_id)
+    except Exception:
+        del nerfreals[sessionid]
+        raise
     nerfreals[sessionid] = nerfreal
     
     pc = RTCPeerConnection()
@@ -225,10 +275,10 @@ async def offer(request):
         if pc.connectionState == "failed":
             await pc.close()
             pcs.discard(pc)
-            del nerfreals[sessionid]
+            close_nerfreal(sessionid)
         if pc.connectionState == "closed":
             pcs.discard(pc)
-            del nerfreals[sessionid]
+            close_nerfreal(sessionid)
 
     player = HumanPlayer(nerfreals[sessionid])
     audio_sender = pc.addTrack(player.audio)
@@ -240,6 +290,13 @@ async def offer(request):
     transceiver = pc.getTransceivers()[1]
     transceiver.setCodecPreferences(preferences)
 
+    @pc.on("track")
+    def on_track(track):
+        #上行麦克风: 开口时打断数字人, 识别出的文字按 chat 处理
+        if track.kind == "audio":
+            on_utterance = mic_response(nerfreal) if mic_asr else None
+            asyncio.ensure_future(MicIngest(nerfreal,on_utterance).run(track))
+
     await pc.setRemoteDescription(offer)
 
     answer = await pc.createAnswer()
@@ -276,12 +333,22 @@ async def human(request):
 
 async def humanaudio(request):
     try:
-        form= await request.post()
-        sessionid = int(form.get('sessionid',0))
-        fileobj = form["file"]
-        filename=fileobj.filename
-        filebytes=fileobj.file.read()
-        nerfreals[sessionid].put_audio_file(filebytes)
+        #异步读取上传内容, 解码/重采样/写入语音缓冲在单独的线程中边处理边播放, 不阻塞事件循环
+        sessionid = 0
+        filebytes = None
+        reader = await request.multipart()
+        async for field in reader:
+            if field.name == 'sessionid':
+                sessionid = int(await field.text())
+            elif field.name == 'file':
+                filebytes = bytes(await field.read())
+        if filebytes is None:
+            raise ValueError('file is required')
+        try:
+            sf.info(BytesIO(filebytes)) #只读文件头, 不能解码的上传直接返回错误
+        except Exception as e:
+            raise ValueError(f'unsupported audio file: {e}')
+        Thread(target=nerfreals[sessionid].put_audio_file, args=(filebytes,), daemon=True).start()
 
         return web.Response(
             content_type="application/json",
@@ -297,11 +364,39 @@ async def humanaudio(request):
             ),
         )
 
+async def audio_ws(request):
+    '''实时语音输入: ws://host/audio_ws?sessionid=xxx, 二进制消息为 16kHz 单声道 int16 小端 PCM, 长度任意'''
+    sessionid = int(request.query.get('sessionid',0))
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    nerfreal = nerfreals.get(sessionid)
+    if nerfreal is None:
+        await ws.close(message=b'Session not found')
+        return ws
+    framer = Framer(nerfreal.chunk)
+    rest = b''
+    dropped = 0
+    async for msg in ws:
+        if msg.type == aiohttp.WSMsgType.BINARY:
+            data = rest + msg.data
+            n = len(data)//2*2
+            rest = data[n:]
+            frames = framer.push(np.frombuffer(data[:n],dtype=np.int16).astype(np.float32)/32767)
+            if len(frames): #缓冲满时丢弃, 不阻塞事件循环
+                written = nerfreal.asr.put_audio_frames(frames,block=False)
+                if written < len(frames):
+                    dropped += len(frames)-written
+                    print(f'[WARN] audio_ws session {sessionid} buffer full, dropped {dropped} frames')
+        elif msg.type == aiohttp.WSMsgType.ERROR:
+            print(f'audio_ws session {sessionid} error: {ws.exception()}')
+    return ws
+
 async def set_audiotype(request):
     params = await request.json()
 
     sessionid = params.get('sessionid',0)    
-    nerfreals[sessionid].set_curr_state(params['audiotype'],params['reinit'])
+    #reinit 时可能要重新解码磁盘上改动过的自定义素材, 不能在事件循环中执行
+    await asyncio.get_event_loop().run_in_executor(None, nerfreals[sessionid].set_curr_state, params['audiotype'], params['reinit'])
 
     return web.Response(
         content_type="application/json",
@@ -344,6 +439,27 @@ async def is_speaking(request):
         ),
     )
 
+async def tier(request):
+    params = await request.json()
+
+    sessionid = params.get('sessionid',0)
+    if sessionid not in nerfreals or nerfreals[sessionid] is None:
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "data": None, "msg": "Session not found"}
+            ),
+        )
+    from governor import TIER_NAMES
+    load = nerfreals[sessionid].load
+    stats = governor.stats().get(sessionid) if governor is not None else None
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps(
+            {"code": 0, "data": {"tier": load.tier, "name": TIER_NAMES[load.tier], "stats": stats}}
+        ),
+    )
+
 
 async def on_shutdown(app):
     # close peer connections
@@ -360,7 +476,7 @@ async def post(url,data):
         print(f'Error: {e}')
 
 async def run(push_url,sessionid):
-    nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal,sessionid)
+    nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal,sessionid,opt.avatar_id)
     nerfreals[sessionid] = nerfreal
 
     pc = RTCPeerConnection()
@@ -410,16 +526,32 @@ if __name__ == '__main__':
 
     parser.add_argument('--asr_save_feats', action='store_true')
     # audio FPS
-    parser.add_argument('--fps', type=int, default=50)
+    parser.add_argument('--fps', type=int, default=50) #音频帧率, 20ms一帧
+    parser.add_argument('--video_fps', type=int, default=25, help="output video frame rate, e.g. 15/20/25/30, at most --fps")
     # sliding window left-middle-right length (unit: 20ms)
     parser.add_argument('-l', type=int, default=10)
     parser.add_argument('-m', type=int, default=8)
     parser.add_argument('-r', type=int, default=10)
+    parser.add_argument('--asr_batch', type=int, default=1, help="nerf asr: windows of l+m+r frames run in one batched forward, adds (asr_batch-1)*m frames of latency")
 
     #musetalk opt
     parser.add_argument('--avatar_id', type=str, default='avator_1')
     parser.add_argument('--bbox_shift', type=int, default=5)
     parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--audio_buffer', type=int, default=30, help="seconds of speech buffered per session, TTS waits when it is full")
+    parser.add_argument('--adaptive_batch', action='store_true', help="small batches at the start of an utterance, growing up to --batch_size as speech queues up")
+    parser.add_argument('--latency_target', type=int, default=250, help="ms, target time to the first lip-synced frame with --adaptive_batch")
+    parser.add_argument('--avatar_mem_budget', type=int, default=0, help="MB of private memory for loaded avatars, unused ones are evicted beyond it, 0 no limit")
+    parser.add_argument('--engine', type=str, default='torch', choices=['torch','onnxruntime','onnxruntime_int8'], help="wav2lip inference backend, onnxruntime exports models/wav2lip.onnx on first use, onnxruntime_int8 uses per avatar int8 models accepted by onnxquant.py")
+    parser.add_argument('--ort_intra_threads', type=int, default=0, help="onnxruntime intra-op threads, 0 auto")
+    parser.add_argument('--ort_inter_threads', type=int, default=0, help="onnxruntime inter-op threads, 0 auto")
+    parser.add_argument('--fuse_model', action='store_true', help="fold BatchNorm into conv weights for inference, cached as models/wav2lip_fused.pth")
+    parser.add_argument('--channels_last', action='store_true', help="run wav2lip in channels_last memory format")
+    parser.add_argument('--face_feats', action='store_true', help="use precomputed face encoder features (python facefeats.py --avatar_id <id>). the float16 cache is about 9.4MB per frame (384 model), mapped from disk, so long avatars need that much page cache")
+    parser.add_argument('--face_dtype', type=str, default='uint8', choices=['float16','float32','uint8'], help="dtype of the preprocessed face tensor used to assemble inference batches")
+    parser.add_argument('--governor', action='store_true', help="degrade sessions to half-rate inference (or --lowres_checkpoint) when inference can't keep up, restore when load drops")
+    parser.add_argument('--lowres_checkpoint', type=str, default='', help="96px wav2lip checkpoint, e.g. ./models/wav2lip_gan.pth, lowest quality tier with --governor")
+    parser.add_argument('--frame_cache', type=int, default=0, help="keep full frames compressed and decode on demand with a LRU window of this many frames, 0 decode all at startup")
 
     # parser.add_argument('--customvideo', action='store_true', help="custom video")
     # parser.add_argument('--customvideo_img', type=str, default='data/customvideo/img')
@@ -431,9 +563,14 @@ if __name__ == '__main__':
     parser.add_argument('--REF_FILE', type=str, default=None)
     parser.add_argument('--REF_TEXT', type=str, default=None)
     parser.add_argument('--TTS_SERVER', type=str, default='http://127.0.0.1:9880') # http://localhost:9000
+    parser.add_argument('--tts_concurrency', type=int, default=2, help="sentences synthesized at the same time, audio is still played in order")
+    parser.add_argument('--tts_max_conn', type=int, default=4, help="concurrent requests per TTS server over pooled keep-alive connections")
+    parser.add_argument('--tts_timeout', type=float, default=30, help="seconds, TTS server read timeout (connect timeout is 5s)")
     # parser.add_argument('--CHARACTER', type=str, default='test')
     # parser.add_argument('--EMOTION', type=str, default='default')
 
+    parser.add_argument('--mic_asr', type=str, default='', help="module:function turning 16k float32 mic speech into text, webrtc mic utterances are then answered like chat, empty only interrupts. micasr:fixed_transcript is a local stand-in")
+
     parser.add_argument('--model', type=str, default='wav2lip') #musetalk wav2lip
 
     parser.add_argument('--transport', type=str, default='webrtc') #rtmp webrtc rtcpush
@@ -443,6 +580,7 @@ if __name__ == '__main__':
     parser.add_argument('--listenport', type=int, default=8010)
 
     opt = parser.parse_args()
+    httpclient.configure(opt.tts_max_conn,read_timeout=opt.tts_timeout)
     #app.config.from_object(opt)
     #print(app.config)
     opt.customopt = []
@@ -453,10 +591,28 @@ if __name__ == '__main__':
 
 
     from lipreal import LipReal,load_model,load_avatar,warm_up
+    from avatarregistry import AvatarRegistry
     print(opt)
-    model = load_model("./models/wav2lip.pth")
-    avatar = load_avatar(opt.avatar_id)
+    if opt.engine in ('onnxruntime','onnxruntime_int8'):
+        from onnxengine import load_onnx_model
+        model = load_onnx_model("./models/wav2lip.pth",opt.ort_intra_threads,opt.ort_inter_threads)
+        if opt.face_feats:
+            print('[WARN] --face_feats is not supported by onnxruntime engine, ignored')
+            opt.face_feats = False
+    else:
+        model = load_model("./models/wav2lip.pth",opt.fuse_model,opt.channels_last) #所有avatar共享同一个模型
+    avatars = AvatarRegistry(lambda avatar_id: load_avatar(avatar_id,opt.frame_cache,opt.face_feats,opt.face_dtype,bool(opt.lowres_checkpoint)),opt.avatar_mem_budget*1024*1024)
+    avatars.acquire(opt.avatar_id) #默认avatar常驻
     warm_up(opt.batch_size,model,384)
+    if opt.lowres_checkpoint:
+        from lipreal import load_lowres_model
+        warm_up(opt.batch_size,load_lowres_model(opt.lowres_checkpoint),96)
+    if opt.governor:
+        from governor import Governor,TIER_HALF,TIER_LOWRES
+        governor = Governor(TIER_LOWRES if opt.lowres_checkpoint else TIER_HALF)
+        governor.start()
+    if opt.mic_asr:
+        mic_asr = load_asr_hook(opt.mic_asr)
     # for k in range(opt.max_session):
     #     opt.sessionid=k
     #     nerfreal = LipReal(opt,model)
@@ -465,7 +621,7 @@ if __name__ == '__main__':
 
     if opt.transport=='rtmp':
         thread_quit = Event()
-        nerfreals[0] = build_nerfreal(0)
+        nerfreals[0] = build_nerfreal(0,opt.avatar_id)
         rendthrd = Thread(target=nerfreals[0].render,args=(thread_quit,))
         rendthrd.start()
 
@@ -475,9 +631,11 @@ if __name__ == '__main__':
     appasync.router.add_post("/offer", offer)
     appasync.router.add_post("/human", human)
     appasync.router.add_post("/humanaudio", humanaudio)
+    appasync.router.add_get("/audio_ws", audio_ws)
     appasync.router.add_post("/set_audiotype", set_audiotype)
     appasync.router.add_post("/record", record)
     appasync.router.add_post("/is_speaking", is_speaking)
+    appasync.router.add_post("/tier", tier)
     appasync.router.add_static('/',path='web')
 
     # Configure default CORS settings.
@@ -0,0 +1,125 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 待播放语音的环形缓冲: 预分配的 int16 采样(每行一个 20ms 块)加上并行的类型和事件 id 数组
+# 一个生产者(TTS/上传的音频)一个消费者(ASR), 写满时生产者阻塞, 长回答不会无限占用内存
+
+import threading
+
+import numpy as np
+
+
+class AudioRing:
+    def __init__(self, capacity, chunk=320):
+        '''capacity: 最多缓存的块数'''
+        self.capacity = capacity
+        self.chunk = chunk
+        self.samples = np.zeros((capacity, chunk), dtype=np.int16)
+        self.types = np.zeros(capacity, dtype=np.int8)
+        self.event_ids = np.zeros(capacity, dtype=np.int32)  # 0 表示没有事件
+        self.__events = {}  # 事件 id -> eventpoint
+        self.__next_event = 1
+        self.__read = 0     # 已读块数, 只增不减, 对 capacity 取模得到位置
+        self.__write = 0    # 已写块数
+        self.generation = 0  # 每次 clear 加一, 阻塞中的写入发现变化后放弃剩余数据
+        self.closed = False
+        self.__cond = threading.Condition()
+
+    def qsize(self):
+        return self.__write - self.__read
+
+    def empty(self):
+        return self.__write == self.__read
+
+    def write(self, frames, eventpoints=None, type=0, block=True, timeout=None):
+        '''
+        frames: float 采样(-1~1), 长度为 chunk 的整数倍, 或 (n, chunk)
+        eventpoints: None 或每块一个(可为 None)
+        返回写入的块数, 被 clear/close 打断或超时时少于 n
+        '''
+        frames = np.asarray(frames).reshape(-1, self.chunk)
+        n = len(frames)
+        done = 0
+        with self.__cond:
+            generation = self.generation
+            while done < n:
+                if not self.__cond.wait_for(lambda: self.closed or self.generation != generation
+                                            or self.qsize() < self.capacity, timeout if block else 0):
+                    break
+                if self.closed or self.generation != generation:
+                    break
+                start = self.__write % self.capacity
+                count = min(n - done, self.capacity - self.qsize(), self.capacity - start)
+                block_ = frames[done:done + count] * 32767
+                np.rint(block_, out=block_)
+                np.clip(block_, -32768, 32767, out=block_)
+                self.samples[start:start + count] = block_
+                self.types[start:start + count] = type
+                self.event_ids[start:start + count] = 0
+                if eventpoints is not None:
+                    for i in range(count):
+                        eventpoint = eventpoints[done + i]
+                        if eventpoint is not None:
+                            self.event_ids[start + i] = self.__next_event
+                            self.__events[self.__next_event] = eventpoint
+                            self.__next_event += 1
+                self.__write += count
+                done += count
+                self.__cond.notify_all()
+        return done
+
+    def read(self, n, block=True, timeout=None):
+        '''
+        至少有一块时返回最多 n 块: (float32 采样 (k, chunk), 类型 (k,), eventpoint 列表), 超时返回 None
+        '''
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: self.closed or not self.empty(), timeout if block else 0) \
+                    or self.empty():
+                return None
+            start = self.__read % self.capacity
+            count = min(n, self.qsize(), self.capacity - start)
+            frames = self.samples[start:start + count].astype(np.float32)
+            frames /= 32767
+            types = self.types[start:start + count].copy()
+            eventpoints = [self.__events.pop(int(i), None) if i else None for i in self.event_ids[start:start + count]]
+            self.__read += count
+            self.__cond.notify_all()
+        return frames, types, eventpoints
+
+    def peek(self, n):
+        '''不取出, 返回最多 n 块已排队的 float32 采样 (k, chunk) 和当前的 generation'''
+        with self.__cond:
+            count = min(n, self.qsize())
+            idx = (self.__read + np.arange(count)) % self.capacity
+            frames = self.samples[idx].astype(np.float32)
+            generation = self.generation
+        frames /= 32767
+        return frames, generation
+
+    def clear(self):
+        '''丢弃未读的数据(打断说话)'''
+        with self.__cond:
+            self.__read = self.__write
+            self.__events.clear()
+            self.generation += 1
+            self.__cond.notify_all()
+
+    def close(self):
+        '''会话结束, 唤醒并放弃所有阻塞中的写入'''
+        with self.__cond:
+            self.closed = True
+            self.__cond.notify_all()
@@ -0,0 +1,258 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 流式音频输入: 分块解码, 有状态重采样, 切成 20ms 块
+# TTS 后端返回的字节流和上传的音频文件都经过这里
+# 上传的音频边解码边写入语音缓冲, 不必等整段处理完才开始播放
+
+import math
+import struct
+from functools import lru_cache
+from math import gcd
+
+import numpy as np
+import resampy
+import resampy.filters
+import soundfile as sf
+
+
+class Framer:
+    '''把任意长度的采样切成 chunk 长的块, 不足一块的留到下次'''
+    def __init__(self, chunk=320):
+        self.chunk = chunk
+        self.rest = np.zeros(0, dtype=np.float32)
+
+    def push(self, samples):
+        '''返回 (n, chunk) 的 float32 数组'''
+        data = np.concatenate([self.rest, np.asarray(samples, dtype=np.float32)])
+        n = len(data) // self.chunk
+        self.rest = data[n * self.chunk:]
+        return data[:n * self.chunk].reshape(n, self.chunk)
+
+
+
+class PCMDecoder:
+    '''
+    流式解码 TTS 返回的字节: 原始 int16 pcm(需给出 sample_rate) 或 wav 流(采样率和声道从头部读取),
+    只取第一个声道, 不足一个采样的字节留到下一块
+    '''
+    def __init__(self, sample_rate=None, channels=1, wav=False):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.dtype = np.dtype('<i2')
+        self.scale = 1 / 32767
+        self.header = wav  # 还在等待 wav 头部
+        self.rest = b''
+
+    def __parse_header(self):
+        '''头部完整时读取格式, 返回 True, self.rest 只剩 data 块的内容'''
+        data = self.rest
+        if len(data) < 12:
+            return False
+        if data[:4] not in (b'RIFF', b'RF64') or data[8:12] != b'WAVE':
+            raise ValueError('not a wav stream')
+        pos = 12
+        while pos + 8 <= len(data):
+            chunk_id = data[pos:pos + 4]
+            size = struct.unpack_from('<I', data, pos + 4)[0]
+            if chunk_id == b'data':  # 流式 wav 的 data 长度通常是 0 或最大值, 不使用
+                self.rest = data[pos + 8:]
+                print(f'[INFO]wav stream {self.sample_rate}: {self.channels} channels, {self.dtype.itemsize * 8} bits')
+                return True
+            if pos + 8 + size > len(data):
+                return False
+            if chunk_id == b'fmt ':
+                fmt, self.channels, self.sample_rate = struct.unpack_from('<HHI', data, pos + 8)
+                bits = struct.unpack_from('<H', data, pos + 22)[0]
+                if fmt == 0xFFFE:  # WAVE_FORMAT_EXTENSIBLE, 子格式的前两个字节
+                    fmt = struct.unpack_from('<H', data, pos + 32)[0]
+                if (fmt, bits) == (1, 16):
+                    self.dtype, self.scale = np.dtype('<i2'), 1 / 32767
+                elif (fmt, bits) == (3, 32):
+                    self.dtype, self.scale = np.dtype('<f4'), 1.
+                else:
+                    raise ValueError(f'unsupported wav format {fmt} with {bits} bits')
+            pos += 8 + size + (size & 1)
+        return False
+
+    def push(self, data):
+        '''返回 float32 采样, wav 头部还不完整时为空'''
+        self.rest += data
+        if self.header:
+            if not self.__parse_header():
+                return np.zeros(0, dtype=np.float32)
+            self.header = False
+        frame = self.dtype.itemsize * self.channels
+        n = len(self.rest) // frame * frame
+        samples = np.frombuffer(self.rest[:n], dtype=self.dtype)[::self.channels].astype(np.float32)
+        self.rest = self.rest[n:]
+        if self.scale != 1.:
+            samples *= self.scale
+        return samples
+
+    def flush(self):
+        return np.zeros(0, dtype=np.float32)
+
+
+class MP3Decoder:
+    '''
+    流式解码 mp3 字节(edge-tts): 用 PyAV 的解析器从任意切分的字节中找出完整的 mp3 帧, 收到即解码,
+    接口与 PCMDecoder 相同, 只取第一个声道
+    '''
+    def __init__(self):
+        import av
+        self.codec = av.CodecContext.create('mp3', 'r')
+        self.invalid = av.error.InvalidDataError
+        self.sample_rate = None
+
+    def __decode(self, packets):
+        out = []
+        for packet in packets:
+            try:
+                frames = self.codec.decode(packet)
+            except self.invalid: #ID3 标签等不是音频帧的数据
+                continue
+            for frame in frames:
+                self.sample_rate = frame.sample_rate
+                samples = frame.to_ndarray()
+                if frame.format.is_planar:
+                    samples = samples[0]
+                else:
+                    samples = samples.reshape(-1, len(frame.layout.channels))[:, 0]
+                if samples.dtype == np.int16:
+                    samples = samples.astype(np.float32) / 32767
+                out.append(samples.astype(np.float32, copy=False))
+        return np.concatenate(out) if out else np.zeros(0, dtype=np.float32)
+
+    def push(self, data):
+        return self.__decode(self.codec.parse(data))
+
+    def flush(self):
+        '''输入结束, 解码解析器和解码器中剩余的帧'''
+        return self.__decode(self.codec.parse(None) + [None])
+
+
+@lru_cache(maxsize=None)
+def polyphase_filter(sr_orig, sr_new, filter='kaiser_best'):
+    '''
+    把 resampy 的插值滤波展开成 sr_new/gcd 个相位的定长 FIR, 每组采样率只计算一次
+    返回 (weights (step_out, 2*width), base (step_out,), width, step_in, step_out):
+    输出 t = q*step_out+p 为输入 [n-width+1, n+width] 与 weights[p] 的内积, n = q*step_in+base[p]
+    '''
+    win, precision, _ = resampy.filters.get_filter(filter)
+    ratio = sr_new / sr_orig
+    if ratio < 1:
+        win = ratio * win
+    delta = np.diff(win, append=win[-1])
+    scale = min(1., ratio)
+    g = gcd(sr_orig, sr_new)
+    step_in, step_out = sr_orig // g, sr_new // g
+    index_step = int(scale * precision)
+    width = int(math.ceil(((len(win) - 1) // precision) / scale)) + 1
+    weights = np.zeros((step_out, 2 * width), dtype=np.float64)
+    base = np.zeros(step_out, dtype=np.int64)
+    for p in range(step_out):  # 与 resampy 的 _resample_loop 相同的取值
+        time_register = p / ratio
+        n = int(time_register)
+        base[p] = n
+        frac = scale * (time_register - n)
+        for side, frac in ((-1, frac), (1, scale - frac)):
+            index_frac = frac * precision
+            offset = int(index_frac)
+            eta = index_frac - offset
+            i = np.arange((len(win) - offset) // index_step)
+            w = win[offset + i * index_step] + eta * delta[offset + i * index_step]
+            if side < 0:
+                weights[p, width - 1 - i] = w  # x[n-i]
+            else:
+                weights[p, width + i] = w      # x[n+i+1]
+    weights = weights.astype(np.float32)
+    weights.setflags(write=False)
+    return weights, base, width, step_in, step_out
+
+
+class StreamResampler:
+    '''
+    分块重采样, 使用预先展开的多相滤波器, 结果与对整段调用 resampy.resample 相同(float32 舍入误差内):
+    每次只输出滤波器支撑范围已经完整的采样, 剩余的输入留到下一块
+    '''
+    def __init__(self, sr_orig, sr_new, filter='kaiser_best'):
+        self.sr_orig = sr_orig
+        self.sr_new = sr_new
+        if sr_orig == sr_new:
+            return
+        self.weights, self.base, self.width, self.step_in, self.step_out = polyphase_filter(sr_orig, sr_new, filter)
+        self.buf = np.zeros(self.width, dtype=np.float32)  # 开头补 0, 与整段重采样的边界相同
+        self.buf_start = -self.width  # buf[0] 的输入采样序号
+        self.n_in = 0     # 已输入的采样数
+        self.out_pos = 0  # 下一个输出采样序号
+
+    def __center(self, t):
+        return t // self.step_out * self.step_in + self.base[t % self.step_out]
+
+    def __compute(self, end):
+        t = np.arange(self.out_pos, end)
+        start = self.__center(t) - self.width + 1 - self.buf_start
+        windows = np.lib.stride_tricks.sliding_window_view(self.buf, 2 * self.width)
+        out = np.einsum('tk,tk->t', windows[start], self.weights[t % self.step_out])
+        self.out_pos = end
+        # 丢弃之后的输出不再需要的输入
+        drop = self.__center(end) - self.width + 1 - self.buf_start
+        self.buf = self.buf[drop:]
+        self.buf_start += drop
+        return out
+
+    def push(self, samples):
+        if self.sr_orig == self.sr_new:
+            return np.asarray(samples, dtype=np.float32)
+        samples = np.asarray(samples, dtype=np.float32)
+        self.buf = np.concatenate([self.buf, samples])
+        self.n_in += len(samples)
+        # 右侧 width 个输入都已到达的输出, 中心 n 单调, 只有 t 本身需要检查
+        t = (self.n_in - self.width) * self.step_out // self.step_in
+        end = t + 1 if self.__center(t) + self.width < self.n_in else t
+        if end <= self.out_pos:
+            return np.zeros(0, dtype=np.float32)
+        return self.__compute(end)
+
+    def flush(self):
+        '''输入结束, 输出剩余采样(末尾按 0 补齐, 与整段重采样相同)'''
+        if self.sr_orig == self.sr_new:
+            return np.zeros(0, dtype=np.float32)
+        end = int(self.n_in * float(self.sr_new) / float(self.sr_orig))
+        if end <= self.out_pos:
+            return np.zeros(0, dtype=np.float32)
+        self.buf = np.concatenate([self.buf, np.zeros(self.width + self.step_in, dtype=np.float32)])
+        return self.__compute(end)
+
+
+def decode_stream(fileobj, sample_rate=16000, blocksize=8192):
+    '''分块解码音频文件, 只取第一个声道, 逐块返回重采样到 sample_rate 的 float32 采样'''
+    with sf.SoundFile(fileobj) as f:
+        print(f'[INFO]put audio stream {f.samplerate}: {f.frames} frames, {f.channels} channels')
+        if f.channels > 1:
+            print(f'[WARN] audio has {f.channels} channels, only use the first.')
+        if f.samplerate != sample_rate:
+            print(f'[WARN] audio sample rate is {f.samplerate}, resampling into {sample_rate}.')
+        resampler = StreamResampler(f.samplerate, sample_rate)
+        for block in f.blocks(blocksize, dtype='float32', always_2d=True):
+            out = resampler.push(block[:, 0])
+            if len(out):
+                yield out
+        out = resampler.flush()
+        if len(out):
+            yield out
@@ -0,0 +1,229 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 单文件 avatar 包: 帧/人脸/坐标打包为原始 uint8 数组, 加载时 mmap, 多进程共享 page cache
+#
+# 文件布局:
+#   MAGIC(8) | header_len(uint32) | header json | ... 按页对齐的原始数组 ...
+# header["arrays"][name] = {"dtype","shape","offset"}
+# 尺寸不一致的图片(如 musetalk mask)按 ragged 存储: name 为拼接后的一维数据, name+'__index' 为 [N,4] (offset,h,w,c)
+
+import os
+import json
+import glob
+import pickle
+import struct
+
+import numpy as np
+import cv2
+from tqdm import tqdm
+
+MAGIC = b'LTAVBNDL'
+VERSION = 1
+ALIGN = 4096
+BUNDLE_NAME = 'avatar.bundle'
+
+
+def bundle_path(avatar_path):
+    return os.path.join(avatar_path, BUNDLE_NAME)
+
+def _align(n, align=ALIGN):
+    return (n + align - 1) // align * align
+
+def list_imgs(img_dir):
+    img_list = glob.glob(os.path.join(img_dir, '*.[jpJP][pnPN]*[gG]'))
+    return sorted(img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+
+
+class RaggedFrames:
+    """形状不一致的图片序列, 按下标返回 mmap 上的视图"""
+    def __init__(self, data, index):
+        self.data = data
+        self.index = index
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def __getitem__(self, idx):
+        offset, h, w, c = self.index[idx]
+        return self.data[offset:offset + h * w * c].reshape(h, w, c)
+
+
+class BundleWriter:
+    def __init__(self, path):
+        self.path = path
+        self.specs = {}   # name -> (dtype, shape)
+        self.fills = {}   # name -> callable(memmap), 为None时由调用者通过 create() 返回的 memmap 写入
+
+    def add(self, name, dtype, shape, fill=None):
+        self.specs[name] = (np.dtype(dtype).str, [int(s) for s in shape])
+        self.fills[name] = fill
+
+    def create(self, meta):
+        '''按已登记的数组生成文件布局, 返回可写的 memmap, 写完后调用 commit'''
+        # header 先按占位 offset 计算长度, 再确定数据起点
+        arrays = {}
+        for name, (dtype, shape) in self.specs.items():
+            arrays[name] = {'dtype': dtype, 'shape': shape, 'offset': 0}
+        header = {'version': VERSION, 'meta': meta, 'arrays': arrays}
+        head_len = len(json.dumps(header).encode('utf-8')) + 32 * len(arrays) + 64
+        offset = _align(len(MAGIC) + 4 + head_len)
+        for name, (dtype, shape) in self.specs.items():
+            arrays[name]['offset'] = offset
+            offset = _align(offset + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        total = offset
+
+        header_bytes = json.dumps(header).encode('utf-8')
+        assert len(MAGIC) + 4 + len(header_bytes) <= min(a['offset'] for a in arrays.values())
+        self.tmp_path = self.path + '.tmp'
+        with open(self.tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header_bytes)))
+            f.write(header_bytes)
+            f.truncate(total)
+        out = {}
+        for name, (dtype, shape) in self.specs.items():
+            if int(np.prod(shape)) == 0:
+                continue
+            out[name] = np.memmap(self.tmp_path, dtype=np.dtype(dtype), mode='r+',
+                                  offset=arrays[name]['offset'], shape=tuple(shape))
+        return out
+
+    def commit(self, out):
+        for arr in out.values():
+            arr.flush()
+        out.clear()
+        os.replace(self.tmp_path, self.path)
+
+    def write(self, meta):
+        out = self.create(meta)
+        for name, arr in out.items():
+            if self.fills.get(name) is not None:
+                self.fills[name](arr)
+        self.commit(out)
+
+
+def _add_images(writer, name, img_list):
+    '''同尺寸图片直接堆叠为 [N,H,W,C], 否则按 ragged 存储'''
+    shapes = []
+    for img_path in img_list:
+        img = cv2.imread(img_path)  #离线转换, 先扫描一遍尺寸
+        if img is None:
+            raise ValueError(f'cannot read image {img_path}')
+        shapes.append(img.shape)
+    if len(set(shapes)) <= 1:
+        shape = [len(img_list)] + list(shapes[0] if shapes else (0, 0, 3))
+        def fill(arr):
+            print(f'packing {name}...')
+            for i, img_path in enumerate(tqdm(img_list)):
+                arr[i] = cv2.imread(img_path)
+        writer.add(name, np.uint8, shape, fill)
+    else:
+        index = np.zeros((len(img_list), 4), dtype=np.int64)
+        offset = 0
+        for i, (h, w, c) in enumerate(shapes):
+            index[i] = (offset, h, w, c)
+            offset += h * w * c
+        def fill(arr):
+            print(f'packing {name} (ragged)...')
+            for i, img_path in enumerate(tqdm(img_list)):
+                o, h, w, c = index[i]
+                arr[o:o + h * w * c] = cv2.imread(img_path).reshape(-1)
+        writer.add(name, np.uint8, [offset], fill)
+        _add_array(writer, name + '__index', index)
+
+
+def _add_array(writer, name, array):
+    array = np.ascontiguousarray(array)
+    def fill(arr):
+        arr[...] = array
+    writer.add(name, array.dtype, array.shape, fill)
+
+
+def build_bundle(avatar_path, output=None):
+    '''从 avatar 目录(full_imgs/face_imgs/mask + coords.pkl/mask_coords.pkl)生成单文件 bundle'''
+    output = output or bundle_path(avatar_path)
+    writer = BundleWriter(output)
+    meta = {'avatar_path': os.path.abspath(avatar_path)}
+
+    with open(os.path.join(avatar_path, 'coords.pkl'), 'rb') as f:
+        coord_list_cycle = pickle.load(f)
+    _add_array(writer, 'coords', np.asarray(coord_list_cycle, dtype=np.int32).reshape(-1, 4))
+
+    for name, subdir in (('frames', 'full_imgs'), ('faces', 'face_imgs'), ('masks', 'mask')):
+        img_dir = os.path.join(avatar_path, subdir)
+        if os.path.isdir(img_dir):
+            img_list = list_imgs(img_dir)
+            if len(img_list) > 0:
+                _add_images(writer, name, img_list)
+                meta[name] = len(img_list)
+
+    mask_coords_path = os.path.join(avatar_path, 'mask_coords.pkl')
+    if os.path.exists(mask_coords_path):
+        with open(mask_coords_path, 'rb') as f:
+            mask_coords_list_cycle = pickle.load(f)
+        _add_array(writer, 'mask_coords', np.asarray(mask_coords_list_cycle, dtype=np.int32).reshape(-1, 4))
+
+    writer.write(meta)
+    print(f'[INFO] avatar bundle saved to {output}')
+    return output
+
+
+def load_bundle(path):
+    '''mmap 方式打开 bundle, 返回 (meta, {name: ndarray/RaggedFrames})'''
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not an avatar bundle')
+        head_len, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(head_len).decode('utf-8'))
+    if header['version'] != VERSION:
+        raise ValueError(f'unsupported avatar bundle version {header["version"]}')
+
+    raw = {}
+    for name, spec in header['arrays'].items():
+        shape = tuple(spec['shape'])
+        if int(np.prod(shape)) == 0:
+            raw[name] = np.zeros(shape, dtype=np.dtype(spec['dtype']))
+        else:
+            raw[name] = np.memmap(path, dtype=np.dtype(spec['dtype']), mode='r',
+                                  offset=spec['offset'], shape=shape)
+    arrays = {}
+    for name, arr in raw.items():
+        if name.endswith('__index'):
+            continue
+        if name + '__index' in raw:
+            arrays[name] = RaggedFrames(arr, np.asarray(raw[name + '__index']))
+        else:
+            arrays[name] = arr
+    return header['meta'], arrays
+
+
+def coords_to_list(coords):
+    return [tuple(int(v) for v in c) for c in coords]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='pack avatar images into a memory-mapped bundle')
+    parser.add_argument('--avatar_id', type=str, default='avator_1')
+    parser.add_argument('--avatar_path', type=str, default='', help="default ./data/avatars/<avatar_id>")
+    parser.add_argument('--output', type=str, default='')
+    args = parser.parse_args()
+
+    avatar_path = args.avatar_path or f"./data/avatars/{args.avatar_id}"
+    build_bundle(avatar_path, args.output or None)
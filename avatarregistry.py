@@ -0,0 +1,113 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 进程内 avatar 注册表: 按 avatar_id 懒加载, 会话引用计数, 超出内存预算时按 LRU 释放未使用的 avatar
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+def avatar_nbytes(obj):
+    '''估算 avatar 占用的私有内存, mmap 的数据在 page cache 中共享, 不计入'''
+    if isinstance(obj, np.memmap):
+        return 0
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, (list, tuple)):
+        return sum(avatar_nbytes(o) for o in obj)
+    if hasattr(obj, 'nbytes'):  # ImgCache
+        return obj.nbytes
+    return 0
+
+
+class _Entry:
+    def __init__(self):
+        self.avatar = None
+        self.refcount = 0
+        self.nbytes = 0
+        self.loaded = threading.Event()
+        self.error = None
+
+
+class AvatarRegistry:
+    def __init__(self, loader, mem_budget=0):
+        '''
+        loader: avatar_id -> avatar, 与各模型的 load_avatar 返回值一致
+        mem_budget: 字节数, 0 表示不限制
+        '''
+        self.loader = loader
+        self.mem_budget = mem_budget
+        self.__entries = OrderedDict()  # avatar_id -> _Entry, 按最近使用排序
+        self.__lock = threading.Lock()
+
+    def acquire(self, avatar_id):
+        with self.__lock:
+            entry = self.__entries.get(avatar_id)
+            owner = entry is None
+            if owner:
+                entry = _Entry()
+                self.__entries[avatar_id] = entry
+            entry.refcount += 1
+            self.__entries.move_to_end(avatar_id)
+
+        if owner:
+            try:
+                print(f'[INFO] load avatar {avatar_id}')
+                entry.avatar = self.loader(avatar_id)
+                entry.nbytes = avatar_nbytes(entry.avatar)
+            except Exception as e:
+                entry.error = e
+                with self.__lock:
+                    self.__entries.pop(avatar_id, None)
+            entry.loaded.set()
+            with self.__lock:
+                self.__evict()
+        else:
+            entry.loaded.wait()
+        if entry.error is not None:
+            raise entry.error
+        return entry.avatar
+
+    def release(self, avatar_id):
+        with self.__lock:
+            entry = self.__entries.get(avatar_id)
+            if entry is None:
+                return
+            entry.refcount = max(0, entry.refcount - 1)
+            self.__evict()
+
+    def __evict(self):
+        if self.mem_budget <= 0:
+            return
+        total = sum(e.nbytes for e in self.__entries.values())
+        for avatar_id, entry in list(self.__entries.items()):
+            if total <= self.mem_budget:
+                break
+            if entry.refcount == 0 and entry.loaded.is_set():
+                print(f'[INFO] evict avatar {avatar_id}, {entry.nbytes/1024/1024:.1f}MB')
+                del self.__entries[avatar_id]
+                total -= entry.nbytes
+
+    def stats(self):
+        with self.__lock:
+            return {avatar_id: {'refcount': e.refcount, 'mb': round(e.nbytes/1024/1024, 1)}
+                    for avatar_id, e in self.__entries.items()}
@@ -22,6 +22,19 @@ import queue
 from queue import Queue
 import torch.multiprocessing as mp
 
+from batchpolicy import FrameClock
+from audioring import AudioRing
+
+_silence = {}
+
+def silence_frame(chunk):
+    '''所有会话共享的只读静音帧'''
+    frame = _silence.get(chunk)
+    if frame is None:
+        frame = np.zeros(chunk, dtype=np.float32)
+        frame.setflags(write=False)
+        _silence[chunk] = frame
+    return frame
 
 class BaseASR:
     def __init__(self, opt, parent=None):
@@ -31,42 +44,73 @@ class BaseASR:
         self.fps = opt.fps # 20 ms per frame
         self.sample_rate = 16000
         self.chunk = self.sample_rate // self.fps # 320 samples per chunk (20ms * 16000 / 1000)
-        self.queue = Queue()
-        self.output_queue = mp.Queue()
+        self.video_fps = opt.video_fps
+        self.clock = FrameClock(self.video_fps,self.fps) #每个视频帧对应的音频帧数
+        self.queue = AudioRing(int(getattr(opt,'audio_buffer',30)*self.fps),self.chunk) #待播放的语音, 写满时 TTS 等待
+        self.output_queue = Queue() #推理线程与 ASR 在同一进程, 不需要 mp.Queue 的序列化
 
         self.batch_size = opt.batch_size
 
         self.frames = []
+        self.frame_count = 0   #已取出的音频帧数
+        self.last_speech = -1  #最后一个语音帧的序号
         self.stride_left_size = opt.l
         self.stride_right_size = opt.r
         #self.context_size = 10
-        self.feat_queue = mp.Queue(2)
+        self.feat_queue = Queue(2)
 
         #self.warm_up()
 
     def flush_talk(self):
-        self.queue.queue.clear()
+        self.queue.clear()
+
+    def close(self):
+        self.queue.close()
 
     def put_audio_frame(self,audio_chunk,eventpoint=None): #16khz 20ms pcm
-        self.queue.put((audio_chunk,eventpoint))
+        '''缓冲满时阻塞, 被打断(flush_talk)或会话结束时返回 False'''
+        return self.queue.write(audio_chunk,[eventpoint])==1
+
+    def put_audio_frames(self,stream,eventpoints=None,block=True):
+        '''一次写入多个 20ms 块, 返回写入的块数, block=False 时缓冲满的部分丢弃'''
+        return self.queue.write(stream,eventpoints,block=block)
 
     #return frame:audio pcm; type: 0-normal speak, 1-silence; eventpoint:custom event sync with audio
     def get_audio_frame(self):        
-        try:
-            frame,eventpoint = self.queue.get(block=True,timeout=0.01)
+        item = self.queue.read(1,timeout=0.01)
+        if item is not None:
+            frames,_,eventpoints = item
+            frame,eventpoint = frames[0],eventpoints[0]
             type = 0
             #print(f'[INFO] get frame {frame.shape}')
-        except queue.Empty:
+        else:
             if self.parent and self.parent.curr_state>1: #播放自定义音频
                 frame = self.parent.get_audio_stream(self.parent.curr_state)
                 type = self.parent.curr_state
             else:
-                frame = np.zeros(self.chunk, dtype=np.float32)
+                frame = silence_frame(self.chunk)
                 type = 1
             eventpoint = None
 
+        if type == 0:
+            self.last_speech = self.frame_count
+        self.frame_count += 1
         return frame,type,eventpoint 
 
+    def is_idle(self, n=0):
+        '''
+        窗口中本步输出的 n 个音频帧和其后的右侧上下文都不是语音时为空闲状态,
+        推理线程只推理语音帧, 空闲时不需要计算特征
+        '''
+        return self.last_speech < self.frame_count - self.stride_right_size - n
+
+    def frame_offset(self, frame):
+        '''
+        第 frame 个视频帧的开始时间相对它的第一个音频帧的偏移(秒),
+        视频帧率不整除音频帧率时不为 0, 切特征时加上才不会与推理线程分组的帧错开
+        '''
+        return frame/self.video_fps - self.clock.audio_pos(frame)/self.fps
+
     #return frame:audio pcm; type: 0-normal speak, 1-silence; eventpoint:custom event sync with audio
     def get_audio_out(self): 
         return self.output_queue.get()
@@ -26,15 +26,17 @@ import cv2
 import glob
 import resampy
 
+import json
 import queue
 from queue import Queue
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 from io import BytesIO
 import soundfile as sf
 
 import av
 from fractions import Fraction
 
+from audiostream import Framer,decode_stream
 from ttsreal import EdgeTTS,VoitsTTS,XTTS,CosyVoiceTTS,FishTTS
 
 from tqdm import tqdm
@@ -46,6 +48,83 @@ def read_imgs(img_list):
         frames.append(frame)
     return frames
 
+class CustomClip:
+    '''一段自定义视频(图片序列+音频), 进程内共享, 只读'''
+    def __init__(self, item):
+        self.opt = item
+        self.cachekey = CustomClip.key(item)
+        input_img_list = glob.glob(os.path.join(item['imgpath'], '*.[jpJP][pnPN]*[gG]'))
+        input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+        if len(input_img_list) == 0:
+            print(f"[WARN] No images found in {item['imgpath']} for audiotype {item['audiotype']}")
+        self.imgs = read_imgs(input_img_list)
+        for img in self.imgs:
+            img.flags.writeable = False
+        self.audio, sample_rate = sf.read(item['audiopath'], dtype='float32')
+        self.audio.flags.writeable = False
+
+    @staticmethod
+    def key(item):
+        #路径或文件修改时间变化时重新读取
+        mtimes = []
+        for path in (item['imgpath'], item['audiopath']):
+            mtimes.append(os.path.getmtime(path) if os.path.exists(path) else None)
+        return (item['imgpath'], item['audiopath'], *mtimes)
+
+class CustomClipCache:
+    '''custom_video.json 中的自定义视频只加载一次, 所有会话引用同一份数据;
+    配置文件修改后自动重新加载, 未变化的片段复用'''
+    check_interval = 1.0 #s
+
+    def __init__(self):
+        self.lock = Lock()
+        self.clips = {}        # audiotype -> CustomClip
+        self.config = None
+        self.mtime = None
+        self.lastcheck = 0
+
+    def __load(self, customopt):
+        loaded = {clip.cachekey: clip for clip in self.clips.values()}
+        clips = {}
+        for item in customopt:
+            print(item)
+            clip = loaded.get(CustomClip.key(item))
+            if clip is None:
+                clip = CustomClip(item)
+            else:
+                clip.opt = item
+            clips[item['audiotype']] = clip
+        self.clips = clips
+
+    def get(self, opt):
+        config = getattr(opt, 'customvideo_config', '')
+        with self.lock:
+            if not config:
+                if self.mtime is None:
+                    self.__load(opt.customopt)
+                    self.mtime = 0
+                return self.clips
+            now = time.time()
+            if self.config == config and now - self.lastcheck < self.check_interval:
+                return self.clips
+            self.lastcheck = now
+            try:
+                mtime = os.path.getmtime(config)
+                if self.config != config or mtime != self.mtime:
+                    with open(config, 'r') as file:
+                        customopt = json.load(file)
+                    if self.config == config:
+                        print(f'[INFO] {config} changed, reload custom video')
+                    self.__load(customopt)
+                    opt.customopt = customopt
+                    self.config = config
+                    self.mtime = mtime
+            except Exception as e:
+                print(f'[ERROR] load {config} failed: {e}')
+            return self.clips
+
+custom_clip_cache = CustomClipCache()
+
 class BaseReal:
     def __init__(self, opt):
         self.opt = opt
@@ -87,33 +166,21 @@ class BaseReal:
             self.tts.add_completion_callback(lambda: self.set_curr_state(2, True))
     
     def put_audio_frame(self,audio_chunk,eventpoint=None): #16khz 20ms pcm
-        self.asr.put_audio_frame(audio_chunk,eventpoint)
-
-    def put_audio_file(self,filebyte): 
-        input_stream = BytesIO(filebyte)
-        stream = self.__create_bytes_stream(input_stream)
-        streamlen = stream.shape[0]
-        idx=0
-        while streamlen >= self.chunk:  #and self.state==State.RUNNING
-            self.put_audio_frame(stream[idx:idx+self.chunk])
-            streamlen -= self.chunk
-            idx += self.chunk
-    
-    def __create_bytes_stream(self,byte_stream):
-        #byte_stream=BytesIO(buffer)
-        stream, sample_rate = sf.read(byte_stream) # [T*sample_rate,] float64
-        print(f'[INFO]put audio stream {sample_rate}: {stream.shape}')
-        stream = stream.astype(np.float32)
+        return self.asr.put_audio_frame(audio_chunk,eventpoint)
 
-        if stream.ndim > 1:
-            print(f'[WARN] audio has {stream.shape[1]} channels, only use the first.')
-            stream = stream[:, 0]
-    
-        if sample_rate != self.sample_rate and stream.shape[0]>0:
-            print(f'[WARN] audio sample rate is {sample_rate}, resampling into {self.sample_rate}.')
-            stream = resampy.resample(x=stream, sr_orig=sample_rate, sr_new=self.sample_rate)
+    def put_audio_frames(self,frames,eventpoints=None): #(n,chunk), 返回写入的块数
+        return self.asr.put_audio_frames(frames,eventpoints)
 
-        return stream
+    def put_audio_file(self,filebyte): 
+        '''边解码边写入语音缓冲, 缓冲满时等待播放, 在工作线程中调用'''
+        framer = Framer(self.chunk)
+        try:
+            for block in decode_stream(BytesIO(filebyte),self.sample_rate):
+                frames = framer.push(block) #skip last frame(not 20ms)
+                if len(frames) and self.asr.put_audio_frames(frames) < len(frames): #被打断
+                    break
+        except Exception as e: #在工作线程中, 异常只能记录
+            print(f'[WARN] put audio file failed: {e}')
 
     def flush_talk(self):
         self.tts.flush_talk()
@@ -123,19 +190,20 @@ class BaseReal:
         return self.speaking
     
     def __loadcustom(self):
-        for item in self.opt.customopt:
-            print(item)
-            input_img_list = glob.glob(os.path.join(item['imgpath'], '*.[jpJP][pnPN]*[gG]'))
-            input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-            if len(input_img_list) == 0:
-                print(f"[WARN] No images found in {item['imgpath']} for audiotype {item['audiotype']}")
-            self.custom_img_cycle[item['audiotype']] = read_imgs(input_img_list)
-            self.custom_audio_cycle[item['audiotype']], sample_rate = sf.read(item['audiopath'], dtype='float32')
-            self.custom_audio_index[item['audiotype']] = 0
-            self.custom_index[item['audiotype']] = 0
-            self.custom_opt[item['audiotype']] = item
+        clips = custom_clip_cache.get(self.opt)
+        for audiotype in list(self.custom_opt):
+            if audiotype not in clips:
+                for d in (self.custom_img_cycle,self.custom_audio_cycle,self.custom_audio_index,self.custom_index,self.custom_opt):
+                    d.pop(audiotype,None)
+        for audiotype,clip in clips.items():
+            self.custom_img_cycle[audiotype] = clip.imgs
+            self.custom_audio_cycle[audiotype] = clip.audio
+            self.custom_audio_index.setdefault(audiotype,0)
+            self.custom_index.setdefault(audiotype,0)
+            self.custom_opt[audiotype] = clip.opt
 
     def init_customindex(self):
+        self.__loadcustom()
         self.curr_state=0
         for key in self.custom_audio_index:
             self.custom_audio_index[key]=0
@@ -156,7 +224,7 @@ class BaseReal:
                     '-vcodec','rawvideo',
                     '-pix_fmt', 'bgr24', #像素格式
                     '-s', "{}x{}".format(self.width, self.height),
-                    '-r', str(25),
+                    '-r', str(self.opt.video_fps),
                     '-i', '-',
                     '-pix_fmt', 'yuv420p', 
                     '-vcodec', "h264",
@@ -279,8 +347,10 @@ class BaseReal:
     
     def set_curr_state(self,audiotype, reinit):
         print('set_curr_state:',audiotype)
-        self.curr_state = audiotype
         if reinit:
+            self.__loadcustom()
+        self.curr_state = audiotype
+        if reinit and audiotype in self.custom_index:
             self.custom_audio_index[audiotype] = 0
             self.custom_index[audiotype] = 0
     
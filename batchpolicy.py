@@ -0,0 +1,132 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 推理 batch 的组织: 只推理有语音的视频帧, 推理的 batch 大小补齐到预热过的几个尺寸
+
+
+def infer_sizes(batch_size):
+    '''会用到的推理 batch 大小: 不超过 batch_size 的 2 的幂, 再加上 batch_size 本身, 启动时逐个预热'''
+    sizes = []
+    n = 1
+    while n < batch_size:
+        sizes.append(n)
+        n *= 2
+    sizes.append(batch_size)
+    return sizes
+
+
+def speech_frames(groups):
+    '''groups: 每个视频帧对应的音频帧, 任一个不是静音(type==0)就需要推理, 返回这些视频帧在 batch 中的序号'''
+    return [i for i, frames in enumerate(groups) if any(f[1] == 0 for f in frames)]
+
+
+def pad_rows(rows, sizes):
+    '''把需要推理的序号补齐到 sizes 中不小于它的最小尺寸, 重复最后一个, 多出的结果丢弃'''
+    size = next((s for s in sizes if s >= len(rows)), len(rows))
+    return rows + rows[-1:] * (size - len(rows))
+
+
+class BatchPolicy:
+    '''
+    自适应 batch 大小: 语音刚开始时用小 batch 尽快出第一帧, 语音积压或推理跟不上实时时逐级增大
+    ASR 每步调用 next_batch 决定收集多少帧, 推理线程调用 record 上报实测耗时
+    '''
+    def __init__(self, max_batch, latency=0.25, fps=25, audio_fps=50):
+        '''
+        max_batch: 最大 batch, 即 --batch_size
+        latency: 语音开始时 收集音频+推理 的目标时间(秒)
+        fps: 视频帧率
+        '''
+        self.sizes = infer_sizes(max_batch)
+        self.latency = latency
+        self.frame_time = 1. / fps
+        self.audio_per_frame = audio_fps / fps
+        self.__infer_time = {}  # 推理的 batch 大小 -> 每帧耗时(秒), 滑动平均
+        self.__size = self.sizes[0]
+
+    def record(self, size, seconds):
+        t = seconds / size
+        old = self.__infer_time.get(size)
+        self.__infer_time[size] = t if old is None else old * 0.8 + t * 0.2
+
+    def frame_cost(self, size):
+        '''size 的每帧推理耗时, 没测过的尺寸用最接近的已测尺寸估计, 都没测过返回 0'''
+        if not self.__infer_time:
+            return 0.
+        nearest = min(self.__infer_time, key=lambda s: abs(s - size))
+        return self.__infer_time[nearest]
+
+    def start_size(self):
+        '''满足延迟目标的最大尺寸, 至少为最小尺寸'''
+        best = self.sizes[0]
+        for s in self.sizes:
+            if s * (self.frame_time + self.frame_cost(s)) <= self.latency:
+                best = s
+        return best
+
+    def next_batch(self, queued):
+        '''
+        queued: 队列中待处理的语音帧数(20ms 一帧)
+        返回本步处理的视频帧数
+        '''
+        if queued == 0:  # 没有积压的语音, 下一句从小 batch 开始
+            self.__size = self.start_size()
+            return self.__size
+        i = self.sizes.index(self.__size)
+        if i + 1 < len(self.sizes):
+            nxt = self.sizes[i + 1]
+            # 积压的语音够一个更大的 batch, 或当前尺寸推理跟不上实时
+            if queued >= nxt * self.audio_per_frame or self.frame_cost(self.__size) > self.frame_time * 0.9:
+                self.__size = nxt
+        return self.__size
+
+    def stats(self):
+        return {'size': self.__size, 'infer_fps': {s: round(1. / t, 1) for s, t in self.__infer_time.items() if t > 0}}
+
+
+class FrameClock:
+    '''
+    视频帧与 20ms 音频帧的对应关系, 视频帧率不必整除音频帧率:
+    第 k 个视频帧对应音频帧 [k*audio_fps//video_fps, (k+1)*audio_fps//video_fps)
+    ASR 和推理线程各持有一个, 按相同的 batch 序列推进, 保持一致
+    '''
+    def __init__(self, video_fps=25, audio_fps=50):
+        if video_fps <= 0 or video_fps > audio_fps:
+            raise ValueError(f'video fps must be in (0, {audio_fps}], got {video_fps}')
+        self.video_fps = video_fps
+        self.audio_fps = audio_fps
+        self.frame = 0  # 下一个视频帧的序号
+
+    def audio_pos(self, frame):
+        '''第 frame 个视频帧开始处的音频帧序号'''
+        return frame * self.audio_fps // self.video_fps
+
+    def take(self, n):
+        '''取接下来 n 个视频帧, 返回每帧对应的音频帧数'''
+        counts = [self.audio_pos(self.frame + i + 1) - self.audio_pos(self.frame + i) for i in range(n)]
+        self.frame += n
+        return counts
+
+
+def group_frames(audio_frames, counts):
+    '''按每个视频帧的音频帧数把音频帧分组'''
+    groups = []
+    pos = 0
+    for n in counts:
+        groups.append(audio_frames[pos:pos + n])
+        pos += n
+    return groups
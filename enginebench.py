@@ -0,0 +1,101 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# wav2lip 推理引擎对比: 用随机输入比较各变体与原始模型的输出误差和速度
+# python enginebench.py --checkpoint ./models/wav2lip.pth --batch_size 16 --onnx
+
+import copy
+import time
+
+import torch
+
+
+def random_inputs(batch_size, modelres=384, device='cpu', seed=0):
+    gen = torch.Generator().manual_seed(seed)
+    mel_batch = torch.randn(batch_size, 1, 80, 16, generator=gen).to(device)
+    img_batch = torch.rand(batch_size, 6, modelres, modelres, generator=gen).to(device)
+    return mel_batch, img_batch
+
+
+@torch.inference_mode()
+def compare(ref, model, batch_size=4, rounds=3, modelres=384, device='cpu'):
+    '''返回 model 与 ref 在随机输入上的最大像素误差(0~255)'''
+    maxdiff = 0.
+    for seed in range(rounds):
+        mel_batch, img_batch = random_inputs(batch_size, modelres, device, seed)
+        diff = (ref(mel_batch, img_batch).cpu() - model(mel_batch, img_batch).cpu()).abs().max().item()
+        maxdiff = max(maxdiff, diff * 255.)
+    return maxdiff
+
+
+@torch.inference_mode()
+def timeit(model, batch_size=16, rounds=10, modelres=384, device='cpu'):
+    '''返回每帧推理耗时(秒)'''
+    mel_batch, img_batch = random_inputs(batch_size, modelres, device)
+    model(mel_batch, img_batch)  # warmup
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    t = time.perf_counter()
+    for _ in range(rounds):
+        model(mel_batch, img_batch)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - t) / rounds / batch_size
+
+
+def fused_variants(model):
+    '''原始模型折叠 BatchNorm 后的变体'''
+    return {
+        'fused': copy.deepcopy(model).fuse_for_inference(),
+        'fused_channels_last': copy.deepcopy(model).fuse_for_inference(channels_last=True),
+    }
+
+
+def run(ref, variants, batch_size=16, rounds=10, tolerance=1.0, device='cpu'):
+    results = {}
+    base = timeit(ref, batch_size, rounds, device=device)
+    print(f'{"original":24s} {1/base:8.2f} fps')
+    for name, model in variants.items():
+        diff = compare(ref, model, device=device)
+        t = timeit(model, batch_size, rounds, device=device)
+        results[name] = {'fps': 1/t, 'speedup': base/t, 'maxdiff': diff}
+        flag = 'OK' if diff <= tolerance else 'FAIL'
+        print(f'{name:24s} {1/t:8.2f} fps  x{base/t:.2f}  max diff {diff:.4f} {flag}')
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='compare wav2lip inference variants')
+    parser.add_argument('--checkpoint', type=str, default='./models/wav2lip.pth')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--onnx', action='store_true', help="also compare the onnxruntime engine")
+    parser.add_argument('--ort_intra_threads', type=int, default=0)
+    parser.add_argument('--ort_inter_threads', type=int, default=0)
+    parser.add_argument('--tolerance', type=float, default=1.0, help="max pixel diff (0~255) against the original model")
+    args = parser.parse_args()
+
+    from lipreal import load_model, device
+    ref = load_model(args.checkpoint)
+    variants = fused_variants(ref)
+    if args.onnx:
+        from onnxengine import load_onnx_model
+        variants['onnxruntime'] = load_onnx_model(args.checkpoint, args.ort_intra_threads, args.ort_inter_threads)
+    results = run(ref, variants, args.batch_size, args.rounds, args.tolerance, device)
+    if any(r['maxdiff'] > args.tolerance for r in results.values()):
+        raise SystemExit('some variants differ from the original model beyond tolerance')
@@ -0,0 +1,168 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 推理输入的人脸 batch 组装
+# avatar 加载时把人脸一次性转成归一化后的 NCHW 张量(float16/float32, 或保留 uint8 在组装时归一化),
+# uint8 且来自 bundle 的 memmap 时不复制, 直接引用 mmap 的只读视图, 各会话/进程共享 page cache,
+# 推理时按 mirror_index 用 index_select 取出一个 batch, 写入复用的 staging 张量,
+# 没有 float64 中间结果, 也没有逐帧的 python 循环。
+
+import time
+import warnings
+
+import numpy as np
+import torch
+
+FACE_DTYPES = {'float32': torch.float32, 'float16': torch.float16, 'uint8': torch.uint8}
+
+
+def face_tensor(face_list_cycle, dtype='uint8', crop=None, chunk=64):
+    '''
+    face_list_cycle: HWC uint8 人脸图片列表(或 N,H,W,C 数组/memmap)
+    dtype: float32/float16 预先除以255, uint8 保留原值
+    crop: (y0,y1,x0,x1) 只保留模型输入区域
+    返回 N,3,h,w 的 cpu 张量, 分块转换避免整段的 float 中间结果;
+    uint8 且输入是数组时返回 N,H,W,C 数据上的 N,3,h,w 视图(不复制), 只能读
+    '''
+    torch_dtype = FACE_DTYPES[dtype]
+    if torch_dtype == torch.uint8 and isinstance(face_list_cycle, np.ndarray):
+        faces = face_list_cycle
+        if crop is not None:
+            y0, y1, x0, x1 = crop
+            faces = faces[:, y0:y1, x0:x1]
+        with warnings.catch_warnings(): #只读 memmap, 张量只用来 index_select
+            warnings.simplefilter('ignore', UserWarning)
+            return torch.from_numpy(faces).permute(0, 3, 1, 2)
+    length = len(face_list_cycle)
+    out = None
+    for start in range(0, length, chunk):
+        block = np.asarray([face_list_cycle[i] for i in range(start, min(length, start + chunk))])
+        if crop is not None:
+            y0, y1, x0, x1 = crop
+            block = block[:, y0:y1, x0:x1]
+        block = torch.from_numpy(np.ascontiguousarray(block)).permute(0, 3, 1, 2)
+        if out is None:
+            out = torch.empty((length,) + tuple(block.shape[1:]), dtype=torch_dtype)
+        if torch_dtype == torch.uint8:
+            out[start:start + len(block)] = block
+        else:
+            out[start:start + len(block)] = block.to(torch.float32).div_(255.)
+    return out
+
+
+class FaceBatcher:
+    def __init__(self, faces, batch_size, mask, masked_first=True, device='cpu'):
+        '''
+        faces: face_tensor 的返回值, N,3,h,w
+        mask: (y0,y1,x0,x1) 遮挡区域, 置 0
+        masked_first: 通道顺序 [遮挡图, 原图](wav2lip) 或 [原图, 遮挡图](ultralight)
+        '''
+        self.faces = faces
+        self.mask = mask
+        self.device = device
+        self.scale = 1. / 255. if faces.dtype == torch.uint8 else None
+        _, c, h, w = faces.shape
+        if faces.stride(1) == 1: #N,H,W,C 上的视图: 按 HWC 整块取出, 转换 dtype 时再换成 CHW
+            self.__source = faces.permute(0, 2, 3, 1)
+            self.__gathered = torch.empty((batch_size, h, w, c), dtype=faces.dtype)
+        else:
+            self.__source = faces
+            self.__gathered = torch.empty((batch_size, c, h, w), dtype=faces.dtype)
+        self.__staging = torch.zeros((batch_size, 2 * c, h, w), dtype=torch.float32)
+        if device != 'cpu':
+            self.__gathered = self.__gathered.pin_memory()
+            self.__staging = self.__staging.pin_memory()
+        if masked_first:
+            self.__masked, self.__real = self.__staging[:, :c], self.__staging[:, c:]
+        else:
+            self.__real, self.__masked = self.__staging[:, :c], self.__staging[:, c:]
+
+    def __call__(self, idxs):
+        '''idxs: 帧下标序列, 返回 B,6,h,w 的 float32 张量(在 device 上), 下次调用前有效'''
+        n = len(idxs)
+        idxs = torch.as_tensor(idxs, dtype=torch.long)
+        gathered = self.__gathered[:n]
+        torch.index_select(self.__source, 0, idxs, out=gathered)
+        if self.__source is not self.faces:
+            gathered = gathered.permute(0, 3, 1, 2)
+        real, masked = self.__real[:n], self.__masked[:n]
+        real.copy_(gathered)
+        if self.scale is not None:
+            real.mul_(self.scale)
+        masked.copy_(real)
+        y0, y1, x0, x1 = self.mask
+        masked[:, :, y0:y1, x0:x1] = 0
+        batch = self.__staging[:n]
+        if self.device == 'cpu':
+            return batch
+        return batch.to(self.device, non_blocking=True)
+
+
+def resize_faces(faces, size):
+    '''faces: face_tensor 的返回值或原始人脸列表, 缩放到 size x size, 保持 dtype, 用于低清模型'''
+    if not torch.is_tensor(faces):
+        faces = face_tensor(faces)
+    out = torch.empty((len(faces), faces.shape[1], size, size), dtype=faces.dtype)
+    for start in range(0, len(faces), 64):
+        block = faces[start:start + 64].to(torch.float32)
+        block = torch.nn.functional.interpolate(block, size=(size, size), mode='area')
+        if faces.dtype == torch.uint8:
+            block = block.round_().clamp_(0, 255)
+        out[start:start + len(block)] = block
+    return out
+
+
+def wav2lip_batcher(faces, batch_size, device='cpu'):
+    h = faces.shape[2]
+    return FaceBatcher(faces, batch_size, (h // 2, h, 0, faces.shape[3]), True, device)
+
+
+def bench(faces, batch_size=16, rounds=20, dtype='uint8'):
+    '''对比原来的 list + float64 组装方式和 FaceBatcher 的耗时'''
+    length = len(faces)
+    idx_list = [np.random.randint(0, length, batch_size) for _ in range(rounds)]
+
+    t = time.perf_counter()
+    for idxs in idx_list:
+        img_batch = np.asarray([faces[i] for i in idxs])
+        img_masked = img_batch.copy()
+        img_masked[:, img_batch.shape[1]//2:] = 0
+        img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
+        ref = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2)))
+    t_list = (time.perf_counter() - t) / rounds
+
+    batcher = wav2lip_batcher(face_tensor(faces, dtype), batch_size)
+    t = time.perf_counter()
+    for idxs in idx_list:
+        out = batcher(idxs)
+    t_batcher = (time.perf_counter() - t) / rounds
+    diff = (out - ref).abs().max().item()
+    print(f'batch {batch_size}: list {t_list*1000:.1f}ms, batcher({dtype}) {t_batcher*1000:.1f}ms, max diff {diff:.6f}')
+    return t_list, t_batcher, diff
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='benchmark face batch assembly')
+    parser.add_argument('--avatar_id', type=str, default='avator_1')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--dtype', type=str, default='uint8', choices=list(FACE_DTYPES))
+    args = parser.parse_args()
+
+    from lipreal import load_avatar
+    _, faces, _, _, _ = load_avatar(args.avatar_id, face_dtype=None)
+    bench(faces, args.batch_size, dtype=args.dtype)
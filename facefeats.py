@@ -0,0 +1,126 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# Wav2Lip 人脸编码特征缓存
+# face_encoder_blocks 的输入(遮住下半脸的人脸 + 参考人脸)只与 avatar 帧有关, 与音频无关,
+# 每帧的 8 个 skip 特征预先算好存成 mmap 文件, 推理时只跑 audio_encoder 和 decoder。
+# 384 模型每帧约 4.7M 个值(float16 约 9.4MB), 文件较大, 放在本地盘上由各进程共享 page cache。
+
+import os
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from avatarbundle import BundleWriter, load_bundle
+
+FEATS_NAME = 'face_feats.bundle'
+
+
+def feats_path(avatar_path):
+    return os.path.join(avatar_path, FEATS_NAME)
+
+def face_batch(faces):
+    '''与 lipreal.inference 相同的人脸输入: [遮住下半脸, 原图] 拼成 6 通道, 归一化到 0~1, NCHW'''
+    img_batch = np.asarray(faces)
+    img_masked = img_batch.copy()
+    img_masked[:, img_batch.shape[1]//2:] = 0
+    img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
+    return torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2)))
+
+
+class FaceFeats:
+    def __init__(self, path):
+        meta, arrays = load_bundle(path)
+        self.meta = meta
+        self.feats = [arrays[f'feat{i}'] for i in range(len(arrays))]
+
+    def __len__(self):
+        return self.feats[0].shape[0]
+
+    def gather(self, idxs, device):
+        '''按帧下标取出一个 batch 的 skip 特征'''
+        return [torch.from_numpy(np.take(f, idxs, axis=0)).to(device=device, dtype=torch.float32)
+                for f in self.feats]
+
+
+def load_face_feats(avatar_path, length):
+    path = feats_path(avatar_path)
+    if not os.path.exists(path):
+        print(f'[WARN] {path} not found, run: python facefeats.py --avatar_id <id>')
+        return None
+    face_feats = FaceFeats(path)
+    if len(face_feats) != length:
+        print(f'[WARN] {path} has {len(face_feats)} frames, avatar has {length}, rebuild it')
+        return None
+    print(f'load face feature cache {path}')
+    return face_feats
+
+
+@torch.no_grad()
+def build_face_feats(model, face_list_cycle, output, dtype='float16', batch_size=8, device='cpu'):
+    length = len(face_list_cycle)
+    probe = model.encode_face(face_batch([face_list_cycle[0]]).to(device))
+    writer = BundleWriter(output)
+    for i, f in enumerate(probe):
+        writer.add(f'feat{i}', dtype, (length,) + tuple(f.shape[1:]))
+    out = writer.create({'frames': length, 'dtype': dtype})
+    print('encoding faces...')
+    for start in tqdm(range(0, length, batch_size)):
+        end = min(length, start + batch_size)
+        feats = model.encode_face(face_batch([face_list_cycle[i] for i in range(start, end)]).to(device))
+        for i, f in enumerate(feats):
+            out[f'feat{i}'][start:end] = f.cpu().numpy().astype(dtype)
+    writer.commit(out)
+    print(f'[INFO] face feature cache saved to {output}')
+
+
+@torch.no_grad()
+def verify_face_feats(model, face_list_cycle, face_feats, batch_size=4, rounds=4, device='cpu'):
+    '''用随机 mel 对比完整前向和缓存特征前向的输出, 返回最大像素误差(0~255)'''
+    length = len(face_list_cycle)
+    maxdiff = 0.
+    for _ in range(rounds):
+        idxs = np.random.randint(0, length, batch_size)
+        mel_batch = torch.randn(batch_size, 1, 80, 16).to(device)
+        ref = model(mel_batch, face_batch([face_list_cycle[i] for i in idxs]).to(device))
+        pred = model.decode(mel_batch, face_feats.gather(idxs, device))
+        maxdiff = max(maxdiff, (ref - pred).abs().max().item() * 255.)
+    print(f'face feature cache max pixel diff: {maxdiff:.4f}')
+    return maxdiff
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='precompute Wav2Lip face encoder features for an avatar')
+    parser.add_argument('--avatar_id', type=str, default='avator_1')
+    parser.add_argument('--checkpoint', type=str, default='./models/wav2lip.pth')
+    parser.add_argument('--dtype', type=str, default='float16', choices=['float16', 'float32'])
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--verify', action='store_true', help="compare with the full forward pass after building")
+    parser.add_argument('--tolerance', type=float, default=1.0, help="max pixel diff (0~255) accepted by --verify")
+    args = parser.parse_args()
+
+    from lipreal import load_model, load_avatar, device
+    avatar_path = f"./data/avatars/{args.avatar_id}"
+    model = load_model(args.checkpoint)
+    _, face_list_cycle, _, _, _ = load_avatar(args.avatar_id, face_dtype=None)
+    build_face_feats(model, face_list_cycle, feats_path(avatar_path), args.dtype, args.batch_size, device)
+    if args.verify:
+        diff = verify_face_feats(model, face_list_cycle, FaceFeats(feats_path(avatar_path)), device=device)
+        if diff > args.tolerance:
+            raise SystemExit(f'face feature cache differs from full forward by {diff:.4f} > {args.tolerance}')
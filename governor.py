@@ -0,0 +1,162 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 按负载给会话分档: 机器推理跟不上时逐个把会话降到低档, 负载下降后逐个恢复
+# 档位: 0 完整 384 模型; 1 384 模型隔帧推理, 中间帧取前后帧混合或沿用前一帧; 2 96 低清模型(需 --lowres_checkpoint)
+
+import threading
+import time
+
+TIER_FULL = 0
+TIER_HALF = 1
+TIER_LOWRES = 2
+TIER_NAMES = ['full', 'half_rate', 'lowres']
+
+
+class SessionLoad:
+    '''单个会话的负载统计和当前档位, 推理线程/process_frames/render 写入, Governor 定期读取'''
+    def __init__(self, video_fps=25):
+        self.video_fps = video_fps
+        self.tier = TIER_FULL
+        self.__lock = threading.Lock()
+        self.__reset()
+
+    def __reset(self):
+        self.infer_frames = 0      # 实际推理的帧数
+        self.infer_time = 0.       # 推理耗时(秒)
+        self.out_frames = 0        # 输出的视频帧数
+        self.speech_frames = 0     # 其中说话的帧数
+        self.queue_min = None      # 视频发送队列的最小深度
+        self.since = time.perf_counter()
+
+    def record_infer(self, frames, seconds):
+        with self.__lock:
+            self.infer_frames += frames
+            self.infer_time += seconds
+
+    def record_out(self, speaking):
+        with self.__lock:
+            self.out_frames += 1
+            if speaking:
+                self.speech_frames += 1
+
+    def record_queue(self, depth):
+        with self.__lock:
+            if self.queue_min is None or depth < self.queue_min:
+                self.queue_min = depth
+
+    def take(self):
+        '''返回上次调用以来的统计并清零'''
+        with self.__lock:
+            elapsed = max(time.perf_counter() - self.since, 1e-6)
+            snap = {'tier': self.tier, 'elapsed': elapsed,
+                    'infer_fps': self.infer_frames / self.infer_time if self.infer_time > 0 else 0.,
+                    'busy': self.infer_time / elapsed,
+                    'out_fps': self.out_frames / elapsed,
+                    'speaking': self.speech_frames > 0,
+                    'queue_min': self.queue_min}
+            self.__reset()
+        return snap
+
+
+class Governor:
+    def __init__(self, max_tier=TIER_HALF, interval=2., lag=0.9, busy_limit=1., headroom=0.6, cooldown=3):
+        '''
+        max_tier: 最低可以降到的档位, 没有低清模型时为 TIER_HALF
+        interval: 检查间隔(秒)
+        lag: 说话时输出帧率低于 video_fps*lag 视为跟不上
+        busy_limit: 所有会话推理耗时占比之和超过它视为过载(GPU/CPU 被占满)
+        headroom: 恢复一档后预计的耗时占比之和低于它才恢复
+        cooldown: 每次调整后至少间隔这么多个检查周期再调整
+        '''
+        self.max_tier = max_tier
+        self.interval = interval
+        self.lag = lag
+        self.busy_limit = busy_limit
+        self.headroom = headroom
+        self.cooldown = cooldown
+        self.__loads = {}   # sessionid -> SessionLoad, 按注册顺序
+        self.__stats = {}   # sessionid -> 最近一次统计
+        self.__wait = 0
+        self.__lock = threading.Lock()
+        self.__quit = threading.Event()
+        self.__thread = None
+
+    def register(self, sessionid, load):
+        with self.__lock:
+            self.__loads[sessionid] = load
+
+    def unregister(self, sessionid):
+        with self.__lock:
+            self.__loads.pop(sessionid, None)
+            self.__stats.pop(sessionid, None)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, daemon=True, name='governor')
+        self.__thread.start()
+
+    def stop(self):
+        self.__quit.set()
+
+    def __run(self):
+        while not self.__quit.wait(self.interval):
+            try:
+                self.step()
+            except Exception as e:
+                print(f'[ERROR] governor: {e}')
+
+    def __lagging(self, stat, video_fps):
+        if not stat['speaking']:
+            return False
+        return stat['out_fps'] < video_fps * self.lag or stat['queue_min'] == 0
+
+    def step(self):
+        with self.__lock:
+            loads = dict(self.__loads)
+        stats = {sid: load.take() for sid, load in loads.items()}
+        with self.__lock:
+            self.__stats = stats
+        if not stats:
+            return
+        busy = sum(s['busy'] for s in stats.values())
+        lagging = [sid for sid, s in stats.items() if self.__lagging(s, loads[sid].video_fps)]
+        if self.__wait > 0:
+            self.__wait -= 1
+            return
+
+        if lagging or busy > self.busy_limit:
+            # 降档: 先降档位最高(质量最好)的会话, 同档位先降后加入的
+            candidates = [sid for sid in loads if loads[sid].tier < self.max_tier]
+            if candidates:
+                sid = min(reversed(candidates), key=lambda k: loads[k].tier)
+                loads[sid].tier += 1
+                self.__wait = self.cooldown
+                print(f'[INFO] governor: session {sid} -> {TIER_NAMES[loads[sid].tier]}, busy {busy:.2f}, lagging {lagging}')
+        else:
+            # 恢复: 先恢复档位最低的会话, 隔帧推理恢复后耗时约翻倍, 低清恢复到 384 按 4 倍估计
+            candidates = [sid for sid in loads if loads[sid].tier > TIER_FULL]
+            if candidates:
+                sid = max(candidates, key=lambda k: loads[k].tier)
+                factor = 4. if loads[sid].tier == TIER_LOWRES else 2.
+                if busy + stats[sid]['busy'] * (factor - 1) < self.headroom:
+                    loads[sid].tier -= 1
+                    self.__wait = self.cooldown
+                    print(f'[INFO] governor: session {sid} -> {TIER_NAMES[loads[sid].tier]}, busy {busy:.2f}')
+
+    def stats(self):
+        with self.__lock:
+            return {sid: dict(s, tier_name=TIER_NAMES[s['tier']]) for sid, s in self.__stats.items()}
@@ -0,0 +1,113 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# TTS 服务的 http 客户端: 进程内按服务器共用一个保持连接的 requests.Session,
+# 每句不再重新建立 TCP/TLS 连接, 带连接/读取超时, 每个服务器同时进行的请求数有上限
+
+import socket
+import time
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock, local
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+_pools = {}  # scheme://host:port -> (Session, BoundedSemaphore)
+_lock = Lock()
+_max_conn = 4
+_timeout = (5., 30.)  # (连接, 读取) 秒
+_local = local()  # 本线程的 on_open 钩子
+
+
+def configure(max_conn=4, connect_timeout=5., read_timeout=30.):
+    '''在创建会话之前调用, max_conn: 每个服务器同时进行的请求数'''
+    global _max_conn, _timeout
+    _max_conn = max(1, max_conn)
+    _timeout = (connect_timeout, read_timeout)
+
+
+def pool(url):
+    '''返回 url 所在服务器共用的 (Session, BoundedSemaphore)'''
+    parts = urlsplit(url)
+    key = f'{parts.scheme}://{parts.netloc}'
+    with _lock:
+        if key not in _pools:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_max_conn)
+            session.mount(key, adapter)
+            _pools[key] = (session, BoundedSemaphore(_max_conn))
+        return _pools[key]
+
+
+@contextmanager
+def watch(on_open):
+    '''
+    在本线程中打开的每个响应都调用 on_open(abort), abort() 可以在其他线程中调用以中止该响应,
+    on_open 返回注销函数, 响应关闭前调用, 之后不会再调用 abort
+    '''
+    prev = getattr(_local, 'on_open', None)
+    _local.on_open = on_open
+    try:
+        yield
+    finally:
+        _local.on_open = prev
+
+
+def abort(res):
+    '''关闭响应所在 socket 的读写, 在其他线程中阻塞读取的 iter_content 会立即出错返回'''
+    conn = getattr(res.raw, '_connection', None)
+    sock = getattr(conn, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+@contextmanager
+def request(method, url, name='http', **kwargs):
+    '''
+    流式请求, 占用该服务器的一个名额直到退出(响应读完或被关闭), 记录收到响应头的时间
+    用法: with request('POST', url, 'xtts', json=...) as res: for chunk in iter_content(res, ...)
+    '''
+    session, slots = pool(url)
+    kwargs.setdefault('timeout', _timeout)
+    on_open = getattr(_local, 'on_open', None)
+    with slots:
+        start = time.perf_counter()
+        res = session.request(method, url, stream=True, **kwargs)
+        res.start = start
+        res.name = name
+        print(f'{name} Time to make {method}: {time.perf_counter()-start:.3f}s')
+        remove = on_open(lambda: abort(res)) if on_open is not None else None
+        try:
+            yield res
+        finally:
+            if remove is not None:
+                remove()
+            res.close()
+
+
+def iter_content(res, chunk_size=None):
+    '''同 res.iter_content, 记录首包时间(从发出请求开始)'''
+    first = True
+    for chunk in res.iter_content(chunk_size=chunk_size):
+        if first and chunk:
+            print(f'{res.name} Time to first chunk: {time.perf_counter()-res.start:.3f}s')
+            first = False
+        yield chunk
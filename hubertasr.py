@@ -16,19 +16,26 @@ class HubertASR(BaseASR):
 
     def run_step(self):
         start_time = time.time()
-        
-        for _ in range(self.batch_size * 2):
+        batch_size = self.batch_size
+        if self.queue.empty() and self.is_idle():
+            batch_size = 1 #空闲时每步一帧, 语音到来后下一帧就开始正常的 batch
+        start_frame = self.clock.frame
+        for _ in range(sum(self.clock.take(batch_size))):
             audio_frame, type,eventpoint = self.get_audio_frame()
             self.frames.append(audio_frame)
             self.output_queue.put((audio_frame, type,eventpoint))
         
         if len(self.frames) <= self.stride_left_size + self.stride_right_size:
             return
+        if self.is_idle(len(self.frames) - self.stride_left_size - self.stride_right_size):
+            self.feat_queue.put([None]*batch_size) #没有语音帧, 不计算特征
+            self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
+            return
         
         inputs = np.concatenate(self.frames)  # [N * chunk]
 
         mel = self.audio_processor.get_hubert_from_16k_speech(inputs)
-        mel_chunks=self.audio_processor.feature2chunks(feature_array=mel,fps=self.fps/2,batch_size=self.batch_size,audio_feat_length = self.audio_feat_length, start=self.stride_left_size/2)
+        mel_chunks=self.audio_processor.feature2chunks(feature_array=mel,fps=self.video_fps,batch_size=batch_size,audio_feat_length = self.audio_feat_length, start=self.stride_left_size*self.video_fps/self.fps + self.frame_offset(start_frame)*self.video_fps)
 
         self.feat_queue.put(mel_chunks)
         self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
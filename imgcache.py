@@ -0,0 +1,124 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 压缩帧缓存: 内存里只保存 jpg/png 编码后的数据, 按需在后台线程池解码,
+# 解码结果放在 LRU 窗口里, 并沿 mirror_index 的往返顺序预取后续帧。
+# 支持 len() 和下标访问, 可以直接替换 frame_list_cycle。
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+from tqdm import tqdm
+
+
+class ImgCache:
+    def __init__(self, img_list, cache_size=100, prefetch=12, workers=2, encode='jpg', quality=95):
+        '''
+        img_list: 图片路径列表
+        cache_size: LRU 窗口中保留的解码帧数
+        prefetch: 每次访问后预取的帧数
+        encode: 'jpg'/'png' 重新编码以减小内存, None 直接保存原文件数据
+        '''
+        self.cache_size = max(cache_size, prefetch + 2)
+        self.prefetch = prefetch
+        self.blobs = []
+        print('loading compressed images...')
+        for img_path in tqdm(img_list):
+            if encode is None:
+                with open(img_path, 'rb') as f:
+                    self.blobs.append(np.frombuffer(f.read(), dtype=np.uint8))
+            else:
+                self.blobs.append(self.__encode(cv2.imread(img_path), encode, quality))
+
+        self.__cache = OrderedDict()   # idx -> ndarray
+        self.__pending = {}            # idx -> Future
+        self.__lock = threading.Lock()
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='imgcache')
+        self.__local = threading.local()  # 每个会话的渲染线程各自的访问位置和方向, 共享缓存时互不干扰
+
+    @staticmethod
+    def __encode(img, encode, quality):
+        if encode == 'jpg':
+            ok, buf = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        else:
+            ok, buf = cv2.imencode('.png', img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        if not ok:
+            raise ValueError(f'encode image as {encode} failed')
+        return buf.reshape(-1)
+
+    @property
+    def nbytes(self):
+        return sum(b.nbytes for b in self.blobs)
+
+    def __len__(self):
+        return len(self.blobs)
+
+    def __getitem__(self, idx):
+        return self.get_img(idx)
+
+    def __decode(self, idx):
+        img = cv2.imdecode(self.blobs[idx], cv2.IMREAD_COLOR)
+        img.flags.writeable = False  #缓存中的帧是共享的, 修改前需要copy
+        with self.__lock:
+            self.__pending.pop(idx, None)
+            self.__cache[idx] = img
+            self.__cache.move_to_end(idx)
+            while len(self.__cache) > self.cache_size:
+                self.__cache.popitem(last=False)
+        return img
+
+    def __walk(self, idx, direction, n):
+        # mirror_index 的往返顺序: 0..size-1,size-1..0,0..  端点重复一次
+        size = len(self.blobs)
+        res = []
+        for _ in range(n):
+            nxt = idx + direction
+            if nxt < 0 or nxt >= size:
+                direction = -direction
+                nxt = idx
+            idx = nxt
+            res.append(idx)
+        return res
+
+    def get_img(self, idx):
+        local = self.__local
+        last = getattr(local, 'last', None)
+        if last is not None and idx != last:
+            local.direction = 1 if idx > last else -1
+        local.last = idx
+        direction = getattr(local, 'direction', 1)
+
+        with self.__lock:
+            img = self.__cache.get(idx)
+            if img is not None:
+                self.__cache.move_to_end(idx)
+            future = self.__pending.get(idx)
+        if img is None:
+            if future is not None:
+                img = future.result()
+            else:
+                img = self.__decode(idx)
+
+        if self.prefetch > 0:
+            with self.__lock:
+                for nxt in self.__walk(idx, direction, self.prefetch):
+                    if nxt not in self.__cache and nxt not in self.__pending:
+                        self.__pending[nxt] = self.__executor.submit(self.__decode, nxt)
+        return img
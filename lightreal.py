@@ -37,8 +37,11 @@ from hubertasr import HubertASR
 import asyncio
 from av import AudioFrame, VideoFrame
 from basereal import BaseReal
+from avatarbundle import bundle_path,load_bundle,coords_to_list
+from imgcache import ImgCache
+from facebatch import face_tensor,FaceBatcher
+from batchpolicy import infer_sizes,speech_frames,pad_rows,group_frames,FrameClock
 
-#from imgcache import ImgCache
 
 from tqdm import tqdm
 
@@ -65,7 +68,10 @@ def load_model(opt):
     audio_processor = Audio2Feature()
     return audio_processor
 
-def load_avatar(avatar_id):
+FACE_CROP = (4,164,4,164) #模型输入为人脸图中间的160x160
+FACE_MASK = (5,150,5,155) #即 cv2.rectangle(img,(5,5,150,145),(0,0,0),-1)
+
+def load_avatar(avatar_id,frame_cache=0,face_dtype='uint8'):
     avatar_path = f"./data/avatars/{avatar_id}"
     full_imgs_path = f"{avatar_path}/full_imgs" 
     face_imgs_path = f"{avatar_path}/face_imgs" 
@@ -73,27 +79,35 @@ def load_avatar(avatar_id):
     
     model = Model(6, 'hubert').to(device)  # 假设Model是你自定义的类
     model.load_state_dict(torch.load(f"{avatar_path}/ultralight.pth"))
+
+    if os.path.exists(bundle_path(avatar_path)):
+        print(f'load avatar bundle {bundle_path(avatar_path)}')
+        _,arrays = load_bundle(bundle_path(avatar_path))
+        return model.eval(),arrays['frames'],arrays['faces'],coords_to_list(arrays['coords']),face_tensor(arrays['faces'],face_dtype,FACE_CROP)
     
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
     input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
     input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    frame_list_cycle = read_imgs(input_img_list)
-    #self.imagecache = ImgCache(len(self.coord_list_cycle),self.full_imgs_path,1000)
+    if frame_cache>0: #只保存压缩数据,按需解码
+        frame_list_cycle = ImgCache(input_img_list,frame_cache)
+    else:
+        frame_list_cycle = read_imgs(input_img_list)
     input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
     input_face_list = sorted(input_face_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
     face_list_cycle = read_imgs(input_face_list)
 
-    return model.eval(),frame_list_cycle,face_list_cycle,coord_list_cycle
+    return model.eval(),frame_list_cycle,face_list_cycle,coord_list_cycle,face_tensor(face_list_cycle,face_dtype,FACE_CROP)
 
 
 @torch.no_grad()
 def warm_up(batch_size,avatar,modelres):
     print('warmup model...')
-    model,_,_,_ = avatar
-    img_batch = torch.ones(batch_size, 6, modelres, modelres).to(device)
-    mel_batch = torch.ones(batch_size, 32, 32, 32).to(device)
-    model(img_batch, mel_batch)
+    model = avatar[0]
+    for n in infer_sizes(batch_size): #静音压缩后 batch 大小会变化, 每个尺寸都预热
+        img_batch = torch.ones(n, 6, modelres, modelres).to(device)
+        mel_batch = torch.ones(n, 32, 32, 32).to(device)
+        model(img_batch, mel_batch)
 
 def read_imgs(img_list):
     frames = []
@@ -147,8 +161,11 @@ def __mirror_index(size, index):
         return size - res - 1 
 
 
-def inference(quit_event, batch_size, face_list_cycle, audio_feat_queue, audio_out_queue, res_frame_queue, model):
-    length = len(face_list_cycle)
+def inference(quit_event, batch_size, face_tensor_cycle, audio_feat_queue, audio_out_queue, res_frame_queue, model, video_fps=25):
+    length = len(face_tensor_cycle)
+    face_batcher = FaceBatcher(face_tensor_cycle,batch_size,FACE_MASK,False,device)
+    sizes = infer_sizes(batch_size)
+    clock = FrameClock(video_fps)
     index = 0
     count = 0
     counttime = 0
@@ -160,58 +177,40 @@ def inference(quit_event, batch_size, face_list_cycle, audio_feat_queue, audio_o
             mel_batch = audio_feat_queue.get(block=True, timeout=1)
         except queue.Empty:
             continue
-        is_all_silence=True
+        batch_size = len(mel_batch) #空闲时每步一帧
+        counts = clock.take(batch_size) #每个视频帧对应的音频帧数
         audio_frames = []
-        for _ in range(batch_size*2):
+        for _ in range(sum(counts)):
             frame,type_,eventpoint = audio_out_queue.get()
             audio_frames.append((frame,type_,eventpoint))
-            if type_==0:
-                is_all_silence=False
-        if is_all_silence:
+        audio_frames = group_frames(audio_frames,counts)
+        active = speech_frames(audio_frames) #只推理有语音的帧,静音帧直接用原图
+        if not active:
             for i in range(batch_size):
-                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
+                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i]))
                 index = index + 1
         else:
             t = time.perf_counter()
-            img_batch = []
+            rows = pad_rows(active,sizes)
+            img_batch = face_batcher([__mirror_index(length, index + i) for i in rows])
 
-            for i in range(batch_size):
-                idx = __mirror_index(length, index + i)
-                #face = face_list_cycle[idx]
-                crop_img = face_list_cycle[idx] #face[ymin:ymax, xmin:xmax]
-#                h, w = crop_img.shape[:2]
-                #crop_img = cv2.resize(crop_img, (168, 168), cv2.INTER_AREA)
-                #crop_img_ori = crop_img.copy()
-                img_real_ex = crop_img[4:164, 4:164].copy()
-                img_real_ex_ori = img_real_ex.copy()
-                img_masked = cv2.rectangle(img_real_ex_ori,(5,5,150,145),(0,0,0),-1)
-    
-                img_masked = img_masked.transpose(2,0,1).astype(np.float32)
-                img_real_ex = img_real_ex.transpose(2,0,1).astype(np.float32)
-    
-                img_real_ex_T = torch.from_numpy(img_real_ex / 255.0)
-                img_masked_T = torch.from_numpy(img_masked / 255.0)
-                img_concat_T = torch.cat([img_real_ex_T, img_masked_T], axis=0)[None]
-                img_batch.append(img_concat_T)
-
-            reshaped_mel_batch = [arr.reshape(32, 32, 32) for arr in mel_batch]
+            reshaped_mel_batch = [mel_batch[i].reshape(32, 32, 32) for i in rows]
             mel_batch = torch.stack([torch.from_numpy(arr) for arr in reshaped_mel_batch])
-            img_batch = torch.stack(img_batch).squeeze(1)
-
 
             with torch.no_grad():
-                pred = model(img_batch.cuda(),mel_batch.cuda())
+                pred = model(img_batch.to(device),mel_batch.to(device))
             pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
 
             counttime += (time.perf_counter() - t)
-            count += batch_size
+            count += len(active)
             if count >= 100:
                 print(f"------actual avg infer fps:{count / counttime:.4f}")
                 count = 0
                 counttime = 0
-            for i,res_frame in enumerate(pred):
+            res_frames = dict(zip(active,pred))
+            for i in range(batch_size):
                 #self.__pushmedia(res_frame,loop,audio_track,video_track)
-                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
+                res_frame_queue.put((res_frames.get(i),__mirror_index(length,index),audio_frames[i]))
                 index = index + 1
 
 #            for i, pred_frame in enumerate(pred):
@@ -239,7 +238,7 @@ class LightReal(BaseReal):
         self.res_frame_queue = Queue(self.batch_size*2)  #mp.Queue
         #self.__loadavatar()
         audio_processor = model
-        self.model,self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle = avatar
+        self.model,self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle,self.face_tensor_cycle = avatar
 
         self.asr = HubertASR(opt,self,audio_processor)
         self.asr.warm_up()
@@ -258,7 +257,7 @@ class LightReal(BaseReal):
                 res_frame,idx,audio_frames = self.res_frame_queue.get(block=True, timeout=1)
             except queue.Empty:
                 continue
-            if audio_frames[0][1]!=0 and audio_frames[1][1]!=0: #全为静音数据，只需要取fullimg
+            if all(f[1]!=0 for f in audio_frames): #全为静音数据，只需要取fullimg
                 self.speaking = False
                 audiotype = audio_frames[0][1]
                 if self.custom_index.get(audiotype) is not None: #有自定义视频
@@ -312,8 +311,8 @@ class LightReal(BaseReal):
         self.init_customindex()
         process_thread = Thread(target=self.process_frames, args=(quit_event,loop,audio_track,video_track))
         process_thread.start()
-        Thread(target=inference, args=(quit_event,self.batch_size,self.face_list_cycle,self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.model,)).start()  #mp.Process
+        Thread(target=inference, args=(quit_event,self.batch_size,self.face_tensor_cycle,self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
+                                           self.model,self.opt.video_fps)).start()  #mp.Process
         
 
         #self.render_event.set() #start infer process render
@@ -332,12 +331,13 @@ class LightReal(BaseReal):
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
             if video_track._queue.qsize()>=5:
                 print('sleep qsize=',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
+                time.sleep(video_track._queue.qsize()/self.opt.video_fps*0.8)
                 
             # delay = _starttime+_totalframe*0.04-time.perf_counter() #40ms
             # if delay > 0:
             #     time.sleep(delay)
         #self.render_event.clear() #end infer process render
+        self.asr.close() #唤醒等待写入语音的 TTS
         print('lightreal thread stop')
             
 
@@ -27,11 +27,22 @@ from baseasr import BaseASR
 from wav2lip import audio
 
 class LipASR(BaseASR):
+    def __init__(self, opt, parent=None):
+        super().__init__(opt, parent)
+        self.mel = audio.StreamingMel()
+        self.mel_pos = 0 #self.frames[0] 在整段音频中的采样位置
 
     def run_step(self):
         ############################################## extract audio feature ##############################################
         # get a frame of audio
-        for _ in range(self.batch_size*2):
+        batch_size = self.batch_size
+        policy = getattr(self.parent,'batch_policy',None)
+        if policy is not None: #自适应batch, 推理线程按特征的长度处理
+            batch_size = policy.next_batch(self.queue.qsize())
+        if self.queue.empty() and self.is_idle():
+            batch_size = 1 #空闲时每步一帧, 语音到来后下一帧就开始正常的 batch
+        start_frame = self.clock.frame
+        for _ in range(sum(self.clock.take(batch_size))):
             frame,type,eventpoint = self.get_audio_frame()
             self.frames.append(frame)
             # put to output
@@ -39,26 +50,28 @@ class LipASR(BaseASR):
         # context not enough, do not run network.
         if len(self.frames) <= self.stride_left_size + self.stride_right_size:
             return
+        if self.is_idle(len(self.frames) - self.stride_left_size - self.stride_right_size):
+            self.feat_queue.put([None]*batch_size) #没有语音帧, 推理线程只转发帧序号
+        else:
+            self.feat_queue.put(self.__mel_chunks(batch_size,start_frame))
         
+        # discard the old part to save memory
+        keep = self.stride_left_size + self.stride_right_size
+        self.mel_pos += sum(len(f) for f in self.frames[:-keep])
+        self.frames = self.frames[-keep:]
+
+    def __mel_chunks(self,batch_size,start_frame):
         inputs = np.concatenate(self.frames) # [N * chunk]
-        mel = audio.melspectrogram(inputs)
-        #print(mel.shape[0],mel.shape,len(mel[0]),len(self.frames))
         # cut off stride
-        left = max(0, self.stride_left_size*80/50)
-        right = min(len(mel[0]), len(mel[0]) - self.stride_right_size*80/50)
-        mel_idx_multiplier = 80.*2/self.fps 
+        left = max(0, self.stride_left_size*80/self.fps)
+        mel_idx_multiplier = 80./self.video_fps
+        # 视频帧率不整除音频帧率时, 本批第一个视频帧相对第一个新音频帧有偏移
+        offset = self.frame_offset(start_frame)*80
         mel_step_size = 16
-        i = 0
-        mel_chunks = []
-        while i < (len(self.frames)-self.stride_left_size-self.stride_right_size)/2:
-            start_idx = int(left + i * mel_idx_multiplier)
-            #print(start_idx)
-            if start_idx + mel_step_size > len(mel[0]):
-                mel_chunks.append(mel[:, len(mel[0]) - mel_step_size:])
-            else:
-                mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
-            i += 1
-        self.feat_queue.put(mel_chunks)
-        
-        # discard the old part to save memory
-        self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
+        #超出窗口的用最后 mel_step_size 列
+        starts = np.minimum((left + offset + np.arange(batch_size) * mel_idx_multiplier).astype(int),
+                            self.mel.num_columns(len(inputs)) - mel_step_size)
+        #只计算用到的列, 与上一步重叠的列从缓存取
+        mel = self.mel.columns(inputs, self.mel_pos, starts[0], starts[-1] + mel_step_size)
+        windows = np.lib.stride_tricks.sliding_window_view(mel, mel_step_size, axis=1) # 80,N,16
+        return windows[:, starts - starts[0]].transpose(1, 0, 2) # batch,80,16
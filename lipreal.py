@@ -36,16 +36,23 @@ import torch.multiprocessing as mp
 from lipasr import LipASR
 import asyncio
 from av import AudioFrame, VideoFrame
-from wav2lip.models import Wav2Lip
+from wav2lip.models import Wav2Lip,Wav2Lip96
 from basereal import BaseReal
+from avatarbundle import bundle_path,load_bundle,coords_to_list
+from imgcache import ImgCache
+from facefeats import load_face_feats
+from facebatch import face_tensor,wav2lip_batcher,resize_faces
+from governor import SessionLoad,TIER_FULL,TIER_HALF,TIER_LOWRES
+from batchpolicy import infer_sizes,speech_frames,pad_rows,group_frames,FrameClock,BatchPolicy
 
-#from imgcache import ImgCache
 
 from tqdm import tqdm
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 print('Using {} for inference.'.format(device))
 
+_models = {}
+
 def _load(checkpoint_path):
 	if device == 'cuda':
 		checkpoint = torch.load(checkpoint_path) #,weights_only=True
@@ -54,44 +61,99 @@ def _load(checkpoint_path):
 								map_location=lambda storage, loc: storage)
 	return checkpoint
 
-def load_model(path):
+def fused_path(path):
+	return os.path.splitext(path)[0]+'_fused.pth'
+
+def load_model(path,fuse=False,channels_last=False):
+	'''fuse: 把BatchNorm折叠进卷积, 折叠后的权重缓存在 <name>_fused.pth, 原模型更新后自动重新生成'''
+	key = (path,fuse,channels_last)
+	if key in _models: #同一进程内共享
+		return _models[key]
 	model = Wav2Lip()
-	print("Load checkpoint from: {}".format(path))
-	checkpoint = _load(path)
-	s = checkpoint["state_dict"]
-	new_s = {}
-	for k, v in s.items():
-		new_s[k.replace('module.', '')] = v
-	model.load_state_dict(new_s)
-
-	model = model.to(device)
-	return model.eval()
-
-def load_avatar(avatar_id):
+	cache = fused_path(path)
+	if fuse and os.path.exists(cache) and os.path.getmtime(cache)>=os.path.getmtime(path):
+		print("Load fused checkpoint from: {}".format(cache))
+		model.fuse_for_inference()
+		model.load_state_dict(_load(cache)["state_dict"])
+	else:
+		print("Load checkpoint from: {}".format(path))
+		checkpoint = _load(path)
+		s = checkpoint["state_dict"]
+		new_s = {}
+		for k, v in s.items():
+			new_s[k.replace('module.', '')] = v
+		model.load_state_dict(new_s)
+		if fuse:
+			model.fuse_for_inference()
+			try:
+				torch.save({"state_dict":model.state_dict()},cache)
+				print("Save fused checkpoint to: {}".format(cache))
+			except OSError as e:
+				print(f"[WARN] save fused checkpoint failed: {e}")
+
+	if channels_last:
+		model.memory_format = torch.channels_last
+		model = model.to(memory_format=torch.channels_last)
+	model = model.to(device).eval()
+	_models[key] = model
+	return model
+
+def load_lowres_model(path):
+	'''96 低清模型(原版 wav2lip_gan 等权重), 负载高时的低清档使用'''
+	key = (path,'lowres')
+	if key in _models:
+		return _models[key]
+	print("Load lowres checkpoint from: {}".format(path))
+	s = _load(path)["state_dict"]
+	model = Wav2Lip96()
+	model.load_state_dict({k.replace('module.', ''): v for k, v in s.items()})
+	model = model.to(device).eval()
+	_models[key] = model
+	return model
+
+def load_avatar(avatar_id,frame_cache=0,face_feats=False,face_dtype='uint8',lowres=False):
+    '''lowres: 同时生成低清模型用的 96 人脸, 随 avatar 在注册表中共享'''
     avatar_path = f"./data/avatars/{avatar_id}"
     full_imgs_path = f"{avatar_path}/full_imgs" 
     face_imgs_path = f"{avatar_path}/face_imgs" 
     coords_path = f"{avatar_path}/coords.pkl"
+
+    if os.path.exists(bundle_path(avatar_path)):
+        print(f'load avatar bundle {bundle_path(avatar_path)}')
+        _,arrays = load_bundle(bundle_path(avatar_path))
+        face_list_cycle = arrays['faces']
+        face_feat_cycle = load_face_feats(avatar_path,len(face_list_cycle)) if face_feats else None
+        lowres_face_cycle = resize_faces(face_list_cycle,96) if lowres else None
+        if face_feat_cycle is None and face_dtype:
+            face_list_cycle = face_tensor(face_list_cycle,face_dtype)
+        return arrays['frames'],face_list_cycle,coords_to_list(arrays['coords']),face_feat_cycle,lowres_face_cycle
     
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
     input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
     input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    frame_list_cycle = read_imgs(input_img_list)
-    #self.imagecache = ImgCache(len(self.coord_list_cycle),self.full_imgs_path,1000)
+    if frame_cache>0: #只保存压缩数据,按需解码
+        frame_list_cycle = ImgCache(input_img_list,frame_cache)
+    else:
+        frame_list_cycle = read_imgs(input_img_list)
     input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
     input_face_list = sorted(input_face_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
     face_list_cycle = read_imgs(input_face_list)
+    face_feat_cycle = load_face_feats(avatar_path,len(face_list_cycle)) if face_feats else None
+    lowres_face_cycle = resize_faces(face_list_cycle,96) if lowres else None
+    if face_feat_cycle is None and face_dtype: #有人脸特征缓存时人脸图只用于计数
+        face_list_cycle = face_tensor(face_list_cycle,face_dtype)
 
-    return frame_list_cycle,face_list_cycle,coord_list_cycle
+    return frame_list_cycle,face_list_cycle,coord_list_cycle,face_feat_cycle,lowres_face_cycle
 
 @torch.no_grad()
 def warm_up(batch_size,model,modelres):
     # 预热函数
     print('warmup model...')
-    img_batch = torch.ones(batch_size, 6, modelres, modelres).to(device)
-    mel_batch = torch.ones(batch_size, 1, 80, 16).to(device)
-    model(mel_batch, img_batch)
+    for n in infer_sizes(batch_size): #静音压缩后 batch 大小会变化, 每个尺寸都预热
+        img_batch = torch.ones(n, 6, modelres, modelres).to(device)
+        mel_batch = torch.ones(n, 1, 80, 16).to(device)
+        model(mel_batch, img_batch)
 
 def read_imgs(img_list):
     frames = []
@@ -110,7 +172,7 @@ def __mirror_index(size, index):
     else:
         return size - res - 1 
 
-def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,model):
+def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,model,face_feat_cycle=None,batch_policy=None,video_fps=25,load=None,lowres_model=None,lowres_face_cycle=None):
     
     #model = load_model("./models/wav2lip.pth")
     # input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
@@ -119,6 +181,13 @@ def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_q
     
     #input_latent_list_cycle = torch.load(latents_out_path)
     length = len(face_list_cycle)
+    if face_feat_cycle is None:
+        face_batcher = wav2lip_batcher(face_list_cycle,batch_size,device)
+    lowres_batcher = None
+    if lowres_model is not None and lowres_face_cycle is not None:
+        lowres_batcher = wav2lip_batcher(lowres_face_cycle,batch_size,device)
+    sizes = infer_sizes(batch_size)
+    clock = FrameClock(video_fps)
     index = 0
     count=0
     counttime=0
@@ -130,52 +199,64 @@ def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_q
             mel_batch = audio_feat_queue.get(block=True, timeout=1)
         except queue.Empty:
             continue
-            
-        is_all_silence=True
+        batch_size = len(mel_batch) #自适应batch时每步大小不同
+
+        counts = clock.take(batch_size) #每个视频帧对应的音频帧数
         audio_frames = []
-        for _ in range(batch_size*2):
+        for _ in range(sum(counts)):
             frame,type,eventpoint = audio_out_queue.get()
             audio_frames.append((frame,type,eventpoint))
-            if type==0:
-                is_all_silence=False
+        audio_frames = group_frames(audio_frames,counts)
+        active = speech_frames(audio_frames) #只推理有语音的帧,静音帧直接用原图
 
-        if is_all_silence:
+        if not active:
             for i in range(batch_size):
-                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
+                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i]))
                 index = index + 1
         else:
             # print('infer=======')
             t=time.perf_counter()
-            img_batch = []
-            for i in range(batch_size):
-                idx = __mirror_index(length,index+i)
-                face = face_list_cycle[idx]
-                img_batch.append(face)
-            img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-
-            img_masked = img_batch.copy()
-            img_masked[:, face.shape[0]//2:] = 0
-
-            img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
+            tier = load.tier if load is not None else TIER_FULL
+            infer_rows = active
+            if tier==TIER_HALF: #隔帧推理,奇数帧在前一帧也要推理时复用
+                infer_rows = [i for i in active if (index+i)%2==0 or i-1 not in active]
+            rows = pad_rows(infer_rows,sizes)
+            idxs = [__mirror_index(length,index+i) for i in rows]
+            mel_batch = np.asarray([mel_batch[i] for i in rows])
             mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-            
-            img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
             mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
 
-            with torch.no_grad():
-                pred = model(mel_batch, img_batch)
+            if tier==TIER_LOWRES and lowres_batcher is not None: #低清模型
+                with torch.inference_mode():
+                    pred = lowres_model(mel_batch, lowres_batcher(idxs))
+            elif face_feat_cycle is not None: #人脸编码特征已缓存,只跑音频编码和解码
+                with torch.inference_mode():
+                    pred = model.decode(mel_batch, face_feat_cycle.gather(idxs,device))
+            else:
+                img_batch = face_batcher(idxs)
+                with torch.inference_mode():
+                    pred = model(mel_batch, img_batch)
             pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+            if batch_policy is not None:
+                batch_policy.record(len(rows),time.perf_counter() - t)
+            if load is not None:
+                load.record_infer(len(rows),time.perf_counter() - t)
 
             counttime += (time.perf_counter() - t)
-            count += batch_size
+            count += len(infer_rows)
             #_totalframe += 1
             if count>=100:
                 print(f"------actual avg infer fps:{count/counttime:.4f}")
                 count=0
                 counttime=0
-            for i,res_frame in enumerate(pred):
+            res_frames = dict(zip(infer_rows,pred))
+            for i in active: #隔帧推理时跳过的帧: 前后帧都有时取平均, 否则沿用前一帧
+                if i not in res_frames:
+                    nxt = res_frames.get(i+1)
+                    res_frames[i] = res_frames[i-1] if nxt is None else (res_frames[i-1]+nxt)*0.5
+            for i in range(batch_size):
                 #self.__pushmedia(res_frame,loop,audio_track,video_track)
-                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
+                res_frame_queue.put((res_frames.get(i),__mirror_index(length,index),audio_frames[i]))
                 index = index + 1
             #print('total batch time:',time.perf_counter()-starttime)            
     print('lipreal inference processor stop')
@@ -193,9 +274,14 @@ class LipReal(BaseReal):
         self.batch_size = opt.batch_size
         self.idx = 0
         self.res_frame_queue = Queue(self.batch_size*2)  #mp.Queue
+        self.batch_policy = None
+        if opt.adaptive_batch:
+            self.batch_policy = BatchPolicy(self.batch_size,opt.latency_target/1000,opt.video_fps,self.fps)
+        self.load = SessionLoad(opt.video_fps) #负载统计和质量档位, 由 Governor 调整
+        self.lowres_model = load_lowres_model(opt.lowres_checkpoint) if opt.lowres_checkpoint else None
         #self.__loadavatar()
         self.model = model
-        self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle = avatar
+        self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle,self.face_feat_cycle,self.lowres_face_cycle = avatar
 
         self.asr = LipASR(opt,self)
         self.asr.warm_up()
@@ -213,7 +299,7 @@ class LipReal(BaseReal):
                 res_frame,idx,audio_frames = self.res_frame_queue.get(block=True, timeout=1)
             except queue.Empty:
                 continue
-            if audio_frames[0][1]!=0 and audio_frames[1][1]!=0: #全为静音数据，只需要取fullimg
+            if all(f[1]!=0 for f in audio_frames): #全为静音数据，只需要取fullimg
                 self.speaking = False
                 audiotype = audio_frames[0][1]
                 if self.custom_index.get(audiotype) is not None: #有自定义视频
@@ -244,6 +330,7 @@ class LipReal(BaseReal):
             new_frame = VideoFrame.from_ndarray(image, format="bgr24")
             asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
             self.record_video_data(image)
+            self.load.record_out(self.speaking)
 
             for audio_frame in audio_frames:
                 frame,type,eventpoint = audio_frame
@@ -269,7 +356,8 @@ class LipReal(BaseReal):
 
         Thread(target=inference, args=(quit_event,self.batch_size,self.face_list_cycle,
                                            self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.model,)).start()  #mp.Process
+                                           self.model,self.face_feat_cycle,self.batch_policy,self.opt.video_fps,
+                                           self.load,self.lowres_model,self.lowres_face_cycle)).start()  #mp.Process
 
         #self.render_event.set() #start infer process render
         count=0
@@ -281,17 +369,19 @@ class LipReal(BaseReal):
             # audio stream thread...
             t = time.perf_counter()
             self.asr.run_step()
+            self.load.record_queue(video_track._queue.qsize())
 
             # if video_track._queue.qsize()>=2*self.opt.batch_size:
             #     print('sleep qsize=',video_track._queue.qsize())
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
             if video_track._queue.qsize()>=5:
                 print('sleep qsize=',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
+                time.sleep(video_track._queue.qsize()/self.opt.video_fps*0.8)
                 
             # delay = _starttime+_totalframe*0.04-time.perf_counter() #40ms
             # if delay > 0:
             #     time.sleep(delay)
         #self.render_event.clear() #end infer process render
+        self.asr.close() #唤醒等待写入语音的 TTS
         print('lipreal thread stop')
             
\ No newline at end of file
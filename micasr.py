@@ -0,0 +1,34 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 上行麦克风 ASR 钩子的本地替身, 不需要识别模型或服务, 用来离线检查 VAD 打断和整句提交
+# python app.py --transport webrtc --mic_asr micasr:fixed_transcript
+
+import numpy as np
+
+TRANSCRIPT = '你好'
+
+
+def fixed_transcript(audio):
+    '''不管输入是什么都返回 TRANSCRIPT'''
+    return TRANSCRIPT
+
+
+def energy_summary(audio, sample_rate=16000):
+    '''返回一句话的时长和平均能量, 如 "1.66s -13.5dB"'''
+    db = 10 * np.log10(np.mean(np.square(audio, dtype=np.float32)) + 1e-10)
+    return f'{len(audio)/sample_rate:.2f}s {db:.1f}dB'
@@ -0,0 +1,120 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# webrtc 上行麦克风: 服务端 VAD, 用户开口时立即打断数字人(flush_talk), 一句话结束后交给可替换的 ASR
+# ASR 钩子: fn(audio) -> text, audio 为 16kHz float32, 用 --mic_asr module:function 指定, 本地替身见 micasr.py
+
+import importlib
+from collections import deque
+from threading import Thread
+
+import numpy as np
+from av import AudioResampler
+from aiortc.mediastreams import MediaStreamError
+
+from audiostream import Framer
+
+
+class EnergyVAD:
+    '''
+    能量 VAD: 20ms 帧的能量高于 max(threshold_db, 噪声底+margin_db) 为语音帧,
+    连续 start_frames 个语音帧开始, 连续 end_frames 个非语音帧结束, 不说话时噪声底缓慢跟随
+    '''
+    def __init__(self, threshold_db=-45., margin_db=12., start_frames=3, end_frames=25):
+        self.threshold_db = threshold_db
+        self.margin_db = margin_db
+        self.start_frames = start_frames
+        self.end_frames = end_frames
+        self.noise_db = -60.
+        self.speaking = False
+        self.__count = 0
+
+    def __call__(self, frame):
+        '''返回 'start' / 'end' / None'''
+        db = 10 * np.log10(np.mean(np.square(frame, dtype=np.float32)) + 1e-10)
+        voiced = db > max(self.threshold_db, self.noise_db + self.margin_db)
+        if not self.speaking and not voiced:
+            self.noise_db += (db - self.noise_db) * (0.05 if db > self.noise_db else 0.3)
+        if voiced != self.speaking:
+            self.__count += 1
+        else:
+            self.__count = 0
+        if not self.speaking and self.__count >= self.start_frames:
+            self.speaking, self.__count = True, 0
+            return 'start'
+        if self.speaking and self.__count >= self.end_frames:
+            self.speaking, self.__count = False, 0
+            return 'end'
+        return None
+
+
+def load_asr_hook(path):
+    '''path: module:function, 空字符串返回 None'''
+    if not path:
+        return None
+    module, _, name = path.partition(':')
+    return getattr(importlib.import_module(module), name)
+
+
+class MicIngest:
+    def __init__(self, nerfreal, on_utterance=None, vad=None, preroll=10, max_frames=1500, sample_rate=16000):
+        '''
+        on_utterance: fn(audio) 在单独的线程中调用, audio 为一句话的 float32 采样(含开头前 preroll 帧)
+        max_frames: 一句话最多的 20ms 帧数, 超过时截断提交
+        '''
+        self.nerfreal = nerfreal
+        self.on_utterance = on_utterance
+        self.vad = vad or EnergyVAD()
+        self.sample_rate = sample_rate
+        self.chunk = sample_rate // 50
+        self.max_frames = max_frames
+        self.preroll = deque(maxlen=preroll)
+        self.utterance = None
+
+    async def run(self, track):
+        '''读取 webrtc 音频轨道直到结束, 在事件循环中运行, 每 20ms 的处理量很小'''
+        resampler = AudioResampler(format='s16', layout='mono', rate=self.sample_rate)
+        framer = Framer(self.chunk)
+        while True:
+            try:
+                frame = await track.recv()
+            except MediaStreamError:
+                break
+            frames = resampler.resample(frame)
+            if not isinstance(frames, list): #旧版 PyAV 返回单个帧
+                frames = [frames] if frames is not None else []
+            for f in frames:
+                for chunk in framer.push(f.to_ndarray().reshape(-1).astype(np.float32) / 32767):
+                    self.process(chunk)
+        print('mic track ended')
+
+    def process(self, chunk):
+        event = self.vad(chunk)
+        if event == 'start':
+            print('[INFO] mic speech start, interrupt')
+            self.nerfreal.flush_talk()
+            self.utterance = list(self.preroll)
+        self.preroll.append(chunk)
+        if self.utterance is None:
+            return
+        self.utterance.append(chunk)
+        if event == 'end' or len(self.utterance) >= self.max_frames:
+            audio = np.concatenate(self.utterance)
+            self.utterance = [] if self.vad.speaking else None
+            print(f'[INFO] mic utterance {len(audio)/self.sample_rate:.2f}s')
+            if self.on_utterance is not None:
+                Thread(target=self.on_utterance, args=(audio,), daemon=True).start()
@@ -28,26 +28,62 @@ class MuseASR(BaseASR):
     def __init__(self, opt, parent,audio_processor:Audio2Feature):
         super().__init__(opt,parent)
         self.audio_processor = audio_processor
+        # whisper 每次都补齐到 30s 窗口编码, 编码的音频越短越浪费, 所以把语音缓冲中已排队的语音一起编码(最多 30s),
+        # 特征缓存起来供后面的 batch 切片, 打断或缓存的语音没有按顺序播放时作废
+        self.lookahead = 30*self.fps
+        self.win_pos = 0     #self.frames[0] 的音频帧序号
+        self.feats = None    #缓存的 whisper 特征, 每个音频帧一个
+        self.feat_pos = 0    #self.feats[0] 的音频帧序号
+        self.feat_read = 0   #编码时已取出的音频帧数, 之后取出的帧应该都是编码时排队的语音
+        self.feat_gen = -1   #编码时语音缓冲的 generation
+
+    def __encode(self):
+        inputs = np.concatenate(self.frames)
+        ahead,generation = self.queue.peek(self.lookahead - len(self.frames))
+        if len(ahead):
+            inputs = np.concatenate([inputs,ahead.reshape(-1)])
+        self.feats = self.audio_processor.audio2feat(inputs)
+        self.feat_pos = self.win_pos
+        self.feat_read = self.frame_count
+        self.feat_gen = generation
+
+    def __cached(self):
+        '''缓存的特征是否覆盖当前窗口'''
+        return self.feats is not None and self.feat_gen == self.queue.generation \
+            and self.feat_pos + len(self.feats) >= self.win_pos + len(self.frames)
+
+    def __discard(self):
+        keep = self.stride_left_size + self.stride_right_size
+        self.win_pos += len(self.frames) - keep
+        self.frames = self.frames[-keep:]
 
     def run_step(self):
         ############################################## extract audio feature ##############################################
         start_time = time.time()
-        for _ in range(self.batch_size*2):
+        batch_size = self.batch_size
+        if self.queue.empty() and self.is_idle():
+            batch_size = 1 #空闲时每步一帧, 语音到来后下一帧就开始正常的 batch
+        start_frame = self.clock.frame
+        for _ in range(sum(self.clock.take(batch_size))):
             audio_frame,type,eventpoint = self.get_audio_frame()
+            if type != 0 and self.feats is not None and self.feat_read < self.frame_count <= self.feat_pos + len(self.feats):
+                self.feats = None #缓存中应该是排队的语音, 中间插入了静音或自定义音频
             self.frames.append(audio_frame)
             self.output_queue.put((audio_frame,type,eventpoint))
         
         if len(self.frames) <= self.stride_left_size + self.stride_right_size:
             return
+        if self.is_idle(len(self.frames) - self.stride_left_size - self.stride_right_size):
+            self.feat_queue.put([None]*batch_size) #没有语音帧, 不计算特征
+            self.__discard()
+            return
         
-        inputs = np.concatenate(self.frames) # [N * chunk]
-        whisper_feature = self.audio_processor.audio2feat(inputs)
-        # for feature in whisper_feature:
-        #     self.audio_feats.append(feature)        
-        #print(f"processing audio costs {(time.time() - start_time) * 1000}ms, inputs shape:{inputs.shape} whisper_feature len:{len(whisper_feature)}")
-        whisper_chunks = self.audio_processor.feature2chunks(feature_array=whisper_feature,fps=self.fps/2,batch_size=self.batch_size,start=self.stride_left_size/2 )
-        #print(f"whisper_chunks len:{len(whisper_chunks)},self.audio_feats len:{len(self.audio_feats)},self.output_queue len:{self.output_queue.qsize()}")
-        #self.audio_feats = self.audio_feats[-(self.stride_left_size + self.stride_right_size):]
+        if not self.__cached():
+            self.__encode()
+        #print(f"processing audio costs {(time.time() - start_time) * 1000}ms, feats len:{len(self.feats)}")
+        feats = self.feats[self.win_pos - self.feat_pos:] #从窗口开头切片, 之后与整窗编码时的下标相同
+        whisper_chunks = self.audio_processor.feature2chunks(feature_array=feats,fps=self.video_fps,batch_size=batch_size,start=self.stride_left_size*self.video_fps/self.fps + self.frame_offset(start_frame)*self.video_fps )
+        #print(f"whisper_chunks len:{len(whisper_chunks)},self.output_queue len:{self.output_queue.qsize()}")
         self.feat_queue.put(whisper_chunks)
         # discard the old part to save memory
-        self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
+        self.__discard()
@@ -44,6 +44,9 @@ from museasr import MuseASR
 import asyncio
 from av import AudioFrame, VideoFrame
 from basereal import BaseReal
+from avatarbundle import bundle_path,load_bundle,coords_to_list
+from imgcache import ImgCache
+from batchpolicy import infer_sizes,speech_frames,pad_rows,group_frames,FrameClock
 
 from tqdm import tqdm
 
@@ -59,7 +62,7 @@ def load_model():
     #unet.model.share_memory()
     return vae, unet, pe, timesteps, audio_processor
 
-def load_avatar(avatar_id):
+def load_avatar(avatar_id,frame_cache=0):
     #self.video_path = '' #video_path
     #self.bbox_shift = opt.bbox_shift
     avatar_path = f"./data/avatars/{avatar_id}"
@@ -77,11 +80,18 @@ def load_avatar(avatar_id):
     # }
 
     input_latent_list_cycle = torch.load(latents_out_path)  #,weights_only=True
+    if os.path.exists(bundle_path(avatar_path)):
+        print(f'load avatar bundle {bundle_path(avatar_path)}')
+        _,arrays = load_bundle(bundle_path(avatar_path))
+        return arrays['frames'],arrays['masks'],coords_to_list(arrays['coords']),coords_to_list(arrays['mask_coords']),input_latent_list_cycle
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
     input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
     input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    frame_list_cycle = read_imgs(input_img_list)
+    if frame_cache>0: #只保存压缩数据,按需解码
+        frame_list_cycle = ImgCache(input_img_list,frame_cache)
+    else:
+        frame_list_cycle = read_imgs(input_img_list)
     with open(mask_coords_path, 'rb') as f:
         mask_coords_list_cycle = pickle.load(f)
     input_mask_list = glob.glob(os.path.join(mask_out_path, '*.[jpJP][pnPN]*[gG]'))
@@ -96,17 +106,18 @@ def warm_up(batch_size,model):
     vae, unet, pe, timesteps, audio_processor = model
     #batch_size = 16
     #timesteps = torch.tensor([0], device=unet.device)
-    whisper_batch = np.ones((batch_size, 50, 384), dtype=np.uint8)
-    latent_batch = torch.ones(batch_size, 8, 32, 32).to(unet.device)
+    for n in infer_sizes(batch_size): #静音压缩后 batch 大小会变化, 每个尺寸都预热
+        whisper_batch = np.ones((n, 50, 384), dtype=np.uint8)
+        latent_batch = torch.ones(n, 8, 32, 32).to(unet.device)
 
-    audio_feature_batch = torch.from_numpy(whisper_batch)
-    audio_feature_batch = audio_feature_batch.to(device=unet.device, dtype=unet.model.dtype)
-    audio_feature_batch = pe(audio_feature_batch)
-    latent_batch = latent_batch.to(dtype=unet.model.dtype)
-    pred_latents = unet.model(latent_batch,
-                              timesteps,
-                              encoder_hidden_states=audio_feature_batch).sample
-    vae.decode_latents(pred_latents)
+        audio_feature_batch = torch.from_numpy(whisper_batch)
+        audio_feature_batch = audio_feature_batch.to(device=unet.device, dtype=unet.model.dtype)
+        audio_feature_batch = pe(audio_feature_batch)
+        latent_batch = latent_batch.to(dtype=unet.model.dtype)
+        pred_latents = unet.model(latent_batch,
+                                  timesteps,
+                                  encoder_hidden_states=audio_feature_batch).sample
+        vae.decode_latents(pred_latents)
 
 def read_imgs(img_list):
     frames = []
@@ -127,7 +138,7 @@ def __mirror_index(size, index):
 
 @torch.no_grad()
 def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,
-              vae, unet, pe,timesteps): #vae, unet, pe,timesteps
+              vae, unet, pe,timesteps,video_fps=25): #vae, unet, pe,timesteps
     
     # vae, unet, pe = load_diffusion_model()
     # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -137,6 +148,8 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
     # unet.model = unet.model.half()
     
     length = len(input_latent_list_cycle)
+    sizes = infer_sizes(batch_size)
+    clock = FrameClock(video_fps)
     index = 0
     count=0
     counttime=0
@@ -147,23 +160,25 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
             whisper_chunks = audio_feat_queue.get(block=True, timeout=1)
         except queue.Empty:
             continue
-        is_all_silence=True
+        batch_size = len(whisper_chunks) #空闲时每步一帧
+        counts = clock.take(batch_size) #每个视频帧对应的音频帧数
         audio_frames = []
-        for _ in range(batch_size*2):
+        for _ in range(sum(counts)):
             frame,type,eventpoint = audio_out_queue.get()
             audio_frames.append((frame,type,eventpoint))
-            if type==0:
-                is_all_silence=False
-        if is_all_silence:
+        audio_frames = group_frames(audio_frames,counts)
+        active = speech_frames(audio_frames) #只推理有语音的帧,静音帧直接用原图
+        if not active:
             for i in range(batch_size):
-                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
+                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i]))
                 index = index + 1
         else:
             # print('infer=======')
             t=time.perf_counter()
-            whisper_batch = np.stack(whisper_chunks)
+            rows = pad_rows(active,sizes)
+            whisper_batch = np.stack([whisper_chunks[i] for i in rows])
             latent_batch = []
-            for i in range(batch_size):
+            for i in rows:
                 idx = __mirror_index(length,index+i)
                 latent = input_latent_list_cycle[idx]
                 latent_batch.append(latent)
@@ -192,15 +207,16 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
             # print('vae time:',time.perf_counter()-t)
             #print('diffusion len=',len(recon))
             counttime += (time.perf_counter() - t)
-            count += batch_size
+            count += len(active)
             #_totalframe += 1
             if count>=100:
                 print(f"------actual avg infer fps:{count/counttime:.4f}")
                 count=0
                 counttime=0
-            for i,res_frame in enumerate(recon):
+            res_frames = dict(zip(active,recon))
+            for i in range(batch_size):
                 #self.__pushmedia(res_frame,loop,audio_track,video_track)
-                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
+                res_frame_queue.put((res_frames.get(i),__mirror_index(length,index),audio_frames[i]))
                 index = index + 1
             #print('total batch time:',time.perf_counter()-starttime)            
     print('musereal inference processor stop')
@@ -272,7 +288,7 @@ class MuseReal(BaseReal):
                 res_frame,idx,audio_frames = self.res_frame_queue.get(block=True, timeout=1)
             except queue.Empty:
                 continue
-            if audio_frames[0][1]!=0 and audio_frames[1][1]!=0: #全为静音数据，只需要取fullimg
+            if all(f[1]!=0 for f in audio_frames): #全为静音数据，只需要取fullimg
                 self.speaking = False
                 audiotype = audio_frames[0][1]
                 if self.custom_index.get(audiotype) is not None: #有自定义视频
@@ -331,7 +347,7 @@ class MuseReal(BaseReal):
         self.render_event.set() #start infer process render
         Thread(target=inference, args=(self.render_event,self.batch_size,self.input_latent_list_cycle,
                                            self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.vae, self.unet, self.pe,self.timesteps)).start() #mp.Process
+                                           self.vae, self.unet, self.pe,self.timesteps,self.opt.video_fps)).start() #mp.Process
         count=0
         totaltime=0
         _starttime=time.perf_counter()
@@ -350,7 +366,7 @@ class MuseReal(BaseReal):
             #     totaltime=0
             if video_track._queue.qsize()>=1.5*self.opt.batch_size:
                 print('sleep qsize=',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
+                time.sleep(video_track._queue.qsize()/self.opt.video_fps*0.8)
             # if video_track._queue.qsize()>=5:
             #     print('sleep qsize=',video_track._queue.qsize())
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
@@ -359,5 +375,6 @@ class MuseReal(BaseReal):
             # if delay > 0:
             #     time.sleep(delay)
         self.render_event.clear() #end infer process render
+        self.asr.close() #唤醒等待写入语音的 TTS
         print('musereal thread stop')
             
@@ -61,9 +61,14 @@ class NerfASR(BaseASR):
         self.processor = audio_processor
         self.model = audio_model
 
+        # 攒够 asr_batch 个上下文块后一次 batch 推理, 每块仍是独立的 l+m+r 窗口, 特征不变;
+        # 多出的 (asr_batch-1)*m 帧延迟由预热补上, 环形缓冲相应加大
+        self.asr_batch = max(1, getattr(opt, 'asr_batch', 1))
+        self.pending = [] # 等待推理的窗口
+
         # the extracted features 
         # use a loop queue to efficiently record endless features: [f--t---][-------][-------]
-        self.feat_buffer_size = 4
+        self.feat_buffer_size = 4 + self.asr_batch - 1
         self.feat_buffer_idx = 0
         self.feat_queue = torch.zeros(self.feat_buffer_size * self.context_size, self.audio_dim, dtype=torch.float32, device=self.device)
 
@@ -75,6 +80,7 @@ class NerfASR(BaseASR):
 
         # warm up steps needed: mid + right + window_size + attention_size
         self.warm_up_steps = self.context_size + self.stride_left_size + self.stride_right_size #+ self.stride_left_size   #+ 8 + 2 * 3
+        self.warm_up_steps += (self.asr_batch - 1) * self.context_size
 
     # def get_audio_frame(self):         
     #     try:
@@ -140,22 +146,24 @@ class NerfASR(BaseASR):
         if len(self.frames) < self.stride_left_size + self.context_size + self.stride_right_size:
             return
         
-        inputs = np.concatenate(self.frames) # [N * chunk]
+        self.pending.append(np.concatenate(self.frames)) # [N * chunk]
 
         # discard the old part to save memory
         self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
+        if len(self.pending) < self.asr_batch:
+            return
 
         #print(f'[INFO] frame_to_text... ')
         #t = time.time()
-        logits, labels, text = self.__frame_to_text(inputs)
+        logits, labels, text = self.__frame_to_text(self.pending)
+        self.pending = []
         #print(f'-------wav2vec time:{time.time()-t:.4f}s')
-        feats = logits # better lips-sync than labels
-
-        # record the feats efficiently.. (no concat, constant memory)
-        start = self.feat_buffer_idx * self.context_size
-        end = start + feats.shape[0]
-        self.feat_queue[start:end] = feats
-        self.feat_buffer_idx = (self.feat_buffer_idx + 1) % self.feat_buffer_size
+        for feats in logits: # better lips-sync than labels
+            # record the feats efficiently.. (no concat, constant memory)
+            start = self.feat_buffer_idx * self.context_size
+            end = start + feats.shape[0]
+            self.feat_queue[start:end] = feats
+            self.feat_buffer_idx = (self.feat_buffer_idx + 1) % self.feat_buffer_size
 
         # very naive, just concat the text output.
         #if text != '':
@@ -186,17 +194,17 @@ class NerfASR(BaseASR):
     
 
         
-    def __frame_to_text(self, frame):
-        # frame: [N * 320], N = (context_size + 2 * stride_size)
+    def __frame_to_text(self, frames):
+        # frames: B 个 [N * 320], N = (context_size + 2 * stride_size), 长度相同, 逐条归一化, 不需要 padding
         
-        inputs = self.processor(frame, sampling_rate=self.sample_rate, return_tensors="pt", padding=True)
+        inputs = self.processor(frames, sampling_rate=self.sample_rate, return_tensors="pt", padding=True)
         
         with torch.no_grad():
             result = self.model(inputs.input_values.to(self.device))
             if 'hubert' in self.opt.asr_model:
-                logits = result.last_hidden_state # [B=1, T=pts//320, hid=1024]
+                logits = result.last_hidden_state # [B, T=pts//320, hid=1024]
             else:
-                logits = result.logits # [1, N - 1, 32]
+                logits = result.logits # [B, N - 1, 32]
         #print('logits.shape:',logits.shape)
         
         # cut off stride
@@ -223,7 +231,7 @@ class NerfASR(BaseASR):
         # print(predicted_ids[0])
         # print(transcription)
 
-        return logits[0], None,None #predicted_ids[0], transcription # [N,]
+        return logits, None,None #predicted_ids[0], transcription # [B, N, C]
     
 
     def warm_up(self):       
@@ -376,6 +376,7 @@ class NeRFReal(BaseReal):
                 if video_track._queue.qsize()>=5:
                     #print('sleep qsize=',video_track._queue.qsize())
                     time.sleep(0.04*video_track._queue.qsize()*0.8)
+        self.asr.close() #唤醒等待写入语音的 TTS
         print('nerfreal thread stop')
             
             
\ No newline at end of file
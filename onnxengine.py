@@ -0,0 +1,112 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# wav2lip 的 onnxruntime 推理后端
+# 从 models/wav2lip.pth 导出动态 batch 的 onnx 模型(BatchNorm 已折叠), 用 ORT session 推理,
+# 输入输出通过 IO binding 绑定到预分配的内存, 调用方式与 torch 模型相同: model(mel_batch, img_batch)
+
+import copy
+import inspect
+import os
+import threading
+
+import numpy as np
+import torch
+import onnxruntime as ort
+
+INPUT_NAMES = ['mel', 'face']
+OUTPUT_NAMES = ['pred']
+
+
+def onnx_path(path):
+    return os.path.splitext(path)[0] + '.onnx'
+
+
+@torch.no_grad()
+def export_onnx(model, output, modelres=384, opset=17):
+    '''model: torch 的 Wav2Lip, 导出 batch 维度可变的 onnx'''
+    mel_batch = torch.zeros(2, 1, 80, 16)
+    img_batch = torch.zeros(2, 6, modelres, modelres)
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False  # 新版本默认走 dynamo 导出, 这里沿用 torchscript 导出
+    tmp = output + '.tmp'
+    torch.onnx.export(copy.deepcopy(model).cpu().eval(), (mel_batch, img_batch), tmp,
+                      input_names=INPUT_NAMES, output_names=OUTPUT_NAMES,
+                      dynamic_axes={name: {0: 'batch'} for name in INPUT_NAMES + OUTPUT_NAMES},
+                      opset_version=opset, **kwargs)
+    os.replace(tmp, output)
+    print(f'[INFO] export onnx model to {output}')
+
+
+class OnnxWav2Lip:
+    def __init__(self, path, intra_threads=0, inter_threads=0, providers=None):
+        '''
+        intra_threads/inter_threads: ORT 算子内/算子间线程数, 0 由 ORT 决定
+        providers: 默认 CPUExecutionProvider
+        '''
+        so = ort.SessionOptions()
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        so.intra_op_num_threads = intra_threads
+        so.inter_op_num_threads = inter_threads
+        if inter_threads > 1:
+            so.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        self.session = ort.InferenceSession(path, so, providers=providers or ['CPUExecutionProvider'])
+        self.path = path
+        self.__local = threading.local()  # 多个会话的推理线程共用session, binding和输出缓冲区每个线程一份
+        print(f'load onnx model {path}, providers {self.session.get_providers()}')
+
+    def __buffers(self):
+        local = self.__local
+        if not hasattr(local, 'binding'):
+            local.binding = self.session.io_binding()
+            local.outputs = {}  # batch_size -> 预分配的输出
+        return local
+
+    def __output(self, outputs, shape):
+        out = outputs.get(shape[0])
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+            outputs[shape[0]] = out
+        return out
+
+    def __call__(self, mel_batch, img_batch):
+        '''与 torch 模型相同的调用方式, 返回的张量指向本线程的缓冲区, 下次调用前有效'''
+        mel = np.ascontiguousarray(mel_batch.cpu().numpy(), dtype=np.float32)
+        face = np.ascontiguousarray(img_batch.cpu().numpy(), dtype=np.float32)
+        local = self.__buffers()
+        out = self.__output(local.outputs, (face.shape[0], 3, face.shape[2], face.shape[3]))
+        binding = local.binding
+        binding.clear_binding_inputs()
+        binding.clear_binding_outputs()
+        binding.bind_cpu_input(INPUT_NAMES[0], mel)
+        binding.bind_cpu_input(INPUT_NAMES[1], face)
+        binding.bind_output(OUTPUT_NAMES[0], 'cpu', 0, np.float32, out.shape, out.ctypes.data)
+        self.session.run_with_iobinding(binding)
+        return torch.from_numpy(out)
+
+    def eval(self):
+        return self
+
+
+def load_onnx_model(checkpoint, intra_threads=0, inter_threads=0, providers=None):
+    '''checkpoint 对应的 onnx 不存在或比 checkpoint 旧时重新导出'''
+    path = onnx_path(checkpoint)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(checkpoint):
+        from lipreal import load_model
+        export_onnx(load_model(checkpoint, fuse=True), path)
+    return OnnxWav2Lip(path, intra_threads, inter_threads, providers)
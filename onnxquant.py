@@ -0,0 +1,240 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# wav2lip 的 INT8 静态量化(onnxruntime), 按 avatar 生成
+# 用 avatar 自己的人脸和一段语音的 mel 做校准, 量化后与 fp32 对比嘴部区域 PSNR(可选 SyncNet 置信度)和 fps,
+# 结果写入 data/avatars/<id>/wav2lip_int8.json, 达到阈值才会在 --engine onnxruntime_int8 时启用
+# python onnxquant.py --avatar_id avator_1 --audio ./data/calib.wav
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+from onnxruntime.quantization import CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType, quantize_static
+
+from onnxengine import OnnxWav2Lip, INPUT_NAMES
+
+INT8_NAME = 'wav2lip_int8.onnx'
+REPORT_NAME = 'wav2lip_int8.json'
+
+
+def int8_path(avatar_path):
+    return os.path.join(avatar_path, INT8_NAME)
+
+def report_path(avatar_path):
+    return os.path.join(avatar_path, REPORT_NAME)
+
+
+def mel_chunks(wav_path, fps=25, mel_step_size=16):
+    '''与 LipASR 相同的方式从整段语音切出每个视频帧对应的 mel 块(80,16)'''
+    from wav2lip import audio
+    mel = audio.melspectrogram(audio.load_wav(wav_path, 16000))
+    mel_idx_multiplier = 80. / fps
+    chunks = []
+    i = 0
+    while int(i * mel_idx_multiplier) + mel_step_size <= mel.shape[1]:
+        start = int(i * mel_idx_multiplier)
+        chunks.append(mel[:, start:start + mel_step_size])
+        i += 1
+    return chunks
+
+
+def sample_batches(batcher, length, mels, batch_size, num, first=0):
+    '''
+    按连续帧顺序配对人脸和 mel, 人脸从第 first 帧开始, 返回 [(mel_batch, img_batch)], 都是 float32 numpy
+    评估时 first 取校准用过的帧数, 人脸与校准集不重叠
+    '''
+    batches = []
+    for start in range(0, min(num, len(mels)) - batch_size + 1, batch_size):
+        idxs = [(first + start + i) % length for i in range(batch_size)]
+        mel_batch = np.asarray(mels[start:start + batch_size], dtype=np.float32)[:, None]
+        batches.append((mel_batch, batcher(idxs).numpy().copy()))
+    return batches
+
+
+class Wav2LipCalibReader(CalibrationDataReader):
+    def __init__(self, batches):
+        self.batches = batches
+        self.__iter = iter(batches)
+
+    def get_next(self):
+        batch = next(self.__iter, None)
+        if batch is None:
+            return None
+        return dict(zip(INPUT_NAMES, batch))
+
+    def rewind(self):
+        self.__iter = iter(self.batches)
+
+
+def quantize_int8(fp32_path, output, batches, per_channel=True, method='minmax', max_intermediate=2):
+    '''
+    QDQ 格式静态量化: 权重 int8(按通道), 激活 uint8
+    max_intermediate: 校准时每累计这么多个 batch 的中间结果就合并一次, 384 模型的中间激活很大, 不限制会占满内存
+    '''
+    calibrate_method = {'minmax': CalibrationMethod.MinMax,
+                        'entropy': CalibrationMethod.Entropy,
+                        'percentile': CalibrationMethod.Percentile}[method]
+    tmp = output + '.tmp'
+    quantize_static(fp32_path, tmp, Wav2LipCalibReader(batches),
+                    quant_format=QuantFormat.QDQ, per_channel=per_channel,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                    calibrate_method=calibrate_method,
+                    extra_options={'CalibMaxIntermediateOutputs': max_intermediate})
+    os.replace(tmp, output)
+    print(f'[INFO] int8 model saved to {output}')
+
+
+def mouth_psnr(ref, pred):
+    '''ref/pred: B,3,H,W 取值 0~1, 只比较下半脸(模型生成的区域), 返回每帧的 PSNR'''
+    h = ref.shape[2]
+    diff = ref[:, :, h // 2:] - pred[:, :, h // 2:]
+    mse = np.maximum((diff.astype(np.float64) ** 2).reshape(len(diff), -1).mean(axis=1), 1e-10)
+    return 10 * np.log10(1. / mse)
+
+
+def load_syncnet(path, device='cpu'):
+    from wav2lip.models.syncnet import SyncNet_color
+    model = SyncNet_color()
+    checkpoint = torch.load(path, map_location='cpu')
+    model.load_state_dict({k.replace('module.', ''): v for k, v in checkpoint["state_dict"].items()})
+    return model.to(device).eval()
+
+
+@torch.no_grad()
+def sync_confidence(syncnet, frames, mels, device='cpu'):
+    '''
+    frames: N,3,H,W 连续生成的人脸(0~1), mels: N 个 (80,16)
+    每 5 帧的下半脸缩放到 96x96 后与中间帧的 mel 算余弦相似度, 返回平均值
+    '''
+    faces = torch.nn.functional.interpolate(torch.from_numpy(frames), size=(96, 96), mode='bilinear', align_corners=False)
+    faces = faces[:, :, 48:]
+    scores = []
+    for i in range(0, len(faces) - 4):
+        face = faces[i:i + 5].reshape(1, -1, 48, 96).to(device)
+        mel = torch.from_numpy(np.asarray(mels[i + 2], dtype=np.float32))[None, None].to(device)
+        a, v = syncnet(mel, face)
+        scores.append(torch.nn.functional.cosine_similarity(a, v).item())
+    return float(np.mean(scores)) if scores else None
+
+
+def run_model(model, batches):
+    '''返回 (输出 N,3,H,W, 每帧耗时)'''
+    model(*[torch.from_numpy(x) for x in batches[0]])  # warmup
+    outputs = []
+    t = time.perf_counter()
+    for mel_batch, img_batch in batches:
+        outputs.append(model(torch.from_numpy(mel_batch), torch.from_numpy(img_batch)).numpy().copy())
+    n = sum(len(b[0]) for b in batches)
+    return np.concatenate(outputs), (time.perf_counter() - t) / n
+
+
+def evaluate(fp32_model, int8_model, batches, mels=None, syncnet=None):
+    ref, t_fp32 = run_model(fp32_model, batches)
+    pred, t_int8 = run_model(int8_model, batches)
+    psnr = mouth_psnr(ref, pred)
+    report = {'fps_fp32': 1 / t_fp32, 'fps_int8': 1 / t_int8, 'speedup': t_fp32 / t_int8,
+              'mouth_psnr_mean': float(psnr.mean()), 'mouth_psnr_min': float(psnr.min())}
+    if syncnet is not None:
+        report['sync_fp32'] = sync_confidence(syncnet, ref, mels)
+        report['sync_int8'] = sync_confidence(syncnet, pred, mels)
+    return report
+
+
+_int8_models = {}  # avatar_id -> (文件修改时间, OnnxWav2Lip 或 None)
+_int8_lock = threading.Lock()
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+def load_avatar_int8(avatar_id, intra_threads=0, inter_threads=0):
+    '''
+    avatar 有通过质量评估的 int8 模型时返回 OnnxWav2Lip, 否则返回 None,
+    按评估报告和模型文件的修改时间缓存, 之后生成或重新评估的 int8 模型会在下次调用时加载
+    '''
+    avatar_path = f"./data/avatars/{avatar_id}"
+    key = (_mtime(report_path(avatar_path)), _mtime(int8_path(avatar_path)))
+    with _int8_lock:
+        cached = _int8_models.get(avatar_id)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        model = None
+        try:
+            with open(report_path(avatar_path)) as f:
+                report = json.load(f)
+            if report.get('accepted') and os.path.exists(int8_path(avatar_path)):
+                model = OnnxWav2Lip(int8_path(avatar_path), intra_threads, inter_threads)
+            else:
+                print(f'[INFO] int8 model of {avatar_id} not accepted, use fp32')
+        except FileNotFoundError:
+            print(f'[INFO] no int8 model for {avatar_id}, run: python onnxquant.py --avatar_id {avatar_id}')
+        _int8_models[avatar_id] = (key, model)
+        return model
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='int8 static quantization of wav2lip for an avatar')
+    parser.add_argument('--avatar_id', type=str, default='avator_1')
+    parser.add_argument('--checkpoint', type=str, default='./models/wav2lip.pth')
+    parser.add_argument('--audio', type=str, required=True, help="speech wav used for calibration and evaluation")
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--num_calib', type=int, default=128, help="frames used for calibration")
+    parser.add_argument('--num_eval', type=int, default=64, help="frames used for evaluation, audio and faces taken after the calibration frames")
+    parser.add_argument('--method', type=str, default='minmax', choices=['minmax', 'entropy', 'percentile'])
+    parser.add_argument('--psnr_threshold', type=float, default=30., help="min mean mouth PSNR (dB) to accept the int8 model")
+    parser.add_argument('--syncnet', type=str, default='', help="optional syncnet checkpoint for sync confidence")
+    parser.add_argument('--max_sync_drop', type=float, default=0.05, help="max sync confidence drop to accept, with --syncnet")
+    parser.add_argument('--ort_intra_threads', type=int, default=0)
+    args = parser.parse_args()
+
+    from facebatch import wav2lip_batcher
+    from lipreal import load_avatar
+    from onnxengine import load_onnx_model
+    avatar_path = f"./data/avatars/{args.avatar_id}"
+    _, faces, _, _, _ = load_avatar(args.avatar_id)
+    batcher = wav2lip_batcher(faces, args.batch_size)
+    mels = mel_chunks(args.audio)
+    if len(mels) < args.num_calib + args.num_eval:
+        raise SystemExit(f'{args.audio} gives {len(mels)} frames, need {args.num_calib + args.num_eval}')
+    if len(faces) < args.num_calib + args.num_eval:
+        print(f'[WARN] avatar has {len(faces)} faces, fewer than num_calib+num_eval, evaluation reuses calibration faces')
+
+    fp32_model = load_onnx_model(args.checkpoint, args.ort_intra_threads)
+    calib = sample_batches(batcher, len(faces), mels, args.batch_size, args.num_calib)
+    quantize_int8(fp32_model.path, int8_path(avatar_path), calib, method=args.method)
+    int8_model = OnnxWav2Lip(int8_path(avatar_path), args.ort_intra_threads)
+
+    eval_mels = mels[args.num_calib:args.num_calib + args.num_eval]
+    batches = sample_batches(batcher, len(faces), eval_mels, args.batch_size, args.num_eval, first=args.num_calib)
+    syncnet = load_syncnet(args.syncnet) if args.syncnet else None
+    report = evaluate(fp32_model, int8_model, batches, eval_mels, syncnet)
+    accepted = report['mouth_psnr_mean'] >= args.psnr_threshold
+    if syncnet is not None:
+        accepted = accepted and report['sync_fp32'] - report['sync_int8'] <= args.max_sync_drop
+    report.update({'accepted': accepted, 'psnr_threshold': args.psnr_threshold, 'method': args.method,
+                   'audio': args.audio, 'num_calib': args.num_calib, 'num_eval': args.num_eval})
+    with open(report_path(avatar_path), 'w') as f:
+        json.dump(report, f, indent=2)
+    for k, v in report.items():
+        print(f'{k:18s} {v:.4f}' if isinstance(v, float) else f'{k:18s} {v}')
@@ -0,0 +1,20 @@
+import numpy as np
+
+from audioring import AudioRing
+
+
+def test_peek_returns_queued_frames_without_reading():
+    ring = AudioRing(8, chunk=4)
+    frames = (np.arange(24, dtype=np.float32).reshape(6, 4) - 12) / 100
+    ring.write(frames)
+    ring.read(4)
+    ring.write(frames[:4])  # 写入位置绕回开头
+    ahead, generation = ring.peek(10)
+    assert len(ahead) == 6 and ring.qsize() == 6
+    expected = np.rint(np.concatenate([frames[4:], frames[:4]]) * 32767) / 32767
+    np.testing.assert_allclose(ahead, expected, atol=1e-7)
+    read, _, _ = ring.read(2)
+    np.testing.assert_array_equal(read, ahead[:2])
+    ring.clear()
+    ahead, cleared = ring.peek(10)
+    assert len(ahead) == 0 and cleared == generation + 1
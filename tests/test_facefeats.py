@@ -0,0 +1,35 @@
+import numpy as np
+import torch
+
+from facefeats import FaceFeats, build_face_feats, face_batch, verify_face_feats
+from wav2lip.models import Wav2Lip
+
+
+def _model():
+    torch.manual_seed(0)
+    return Wav2Lip().eval()
+
+
+def _faces(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 256, (384, 384, 3), dtype=np.uint8) for _ in range(n)]
+
+
+@torch.no_grad()
+def test_decode_cached_feats_matches_forward():
+    model = _model()
+    faces = face_batch(_faces(2))
+    mel = torch.randn(2, 1, 80, 16)
+    ref = model(mel, faces)
+    pred = model.decode(mel, model.encode_face(faces))
+    assert (ref - pred).abs().max().item() * 255. < 1e-3
+
+
+def test_fp16_cache_within_tolerance(tmp_path):
+    model = _model()
+    faces = _faces(2, seed=1)
+    path = str(tmp_path / 'face_feats.bundle')
+    build_face_feats(model, faces, path, 'float16', batch_size=2)
+    face_feats = FaceFeats(path)
+    assert len(face_feats) == 2
+    assert verify_face_feats(model, faces, face_feats, batch_size=2, rounds=1) < 1.0
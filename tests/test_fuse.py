@@ -0,0 +1,59 @@
+import copy
+
+import pytest
+import torch
+
+from wav2lip.models import Wav2Lip
+from wav2lip.models.conv_384 import Conv2d, Conv2dTranspose
+
+
+def _randomize_bn(model, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        for m in model.modules():
+            if isinstance(m, torch.nn.BatchNorm2d):
+                n = m.num_features
+                m.running_mean.copy_(torch.randn(n, generator=g) * 0.1)
+                m.running_var.copy_(torch.rand(n, generator=g) + 0.5)
+                m.weight.copy_(torch.rand(n, generator=g) + 0.5)
+                m.bias.copy_(torch.randn(n, generator=g) * 0.1)
+    return model.eval()
+
+
+@torch.no_grad()
+@pytest.mark.parametrize('layer', [Conv2d(8, 16, 3, 1, 1), Conv2d(16, 16, 3, 1, 1, residual=True),
+                                   Conv2dTranspose(8, 16, 3, 2, 1, 1)])
+def test_fused_layer_matches(layer):
+    layer = _randomize_bn(layer)
+    x = torch.randn(2, layer.conv_block[0].in_channels, 12, 12)
+    ref = layer(x)
+    layer.fuse()
+    assert len(layer.conv_block) == 1
+    assert (layer(x) - ref).abs().max().item() < 1e-4
+
+
+@pytest.fixture(scope='module')
+def models():
+    torch.manual_seed(0)
+    model = _randomize_bn(Wav2Lip())
+    mel = torch.randn(2, 1, 80, 16)
+    face = torch.rand(2, 6, 384, 384)
+    with torch.no_grad():
+        ref = model(mel, face)
+    return model, mel, face, ref
+
+
+@torch.no_grad()
+@pytest.mark.parametrize('channels_last', [False, True])
+def test_fused_model_matches(models, channels_last):
+    model, mel, face, ref = models
+    fused = copy.deepcopy(model).fuse_for_inference(channels_last=channels_last)
+    assert not any(isinstance(m, torch.nn.BatchNorm2d) for m in fused.modules())
+    assert (fused(mel, face) - ref).abs().max().item() < 1e-4
+    assert (fused.decode(mel, fused.encode_face(face)) - ref).abs().max().item() < 1e-4
+
+
+@torch.no_grad()
+def test_decode_encode_face_equals_forward(models):
+    model, mel, face, ref = models
+    assert torch.equal(model.decode(mel, model.encode_face(face)), ref)
@@ -0,0 +1,77 @@
+import threading
+
+import numpy as np
+
+import micasr
+from micvad import MicIngest
+
+CHUNK = 320
+
+
+class FakeReal:
+    def __init__(self):
+        self.flushes = 0
+
+    def flush_talk(self):
+        self.flushes += 1
+
+
+def _silence(n):
+    return [np.zeros(CHUNK, dtype=np.float32) for _ in range(n)]
+
+
+def _voiced(n):
+    t = np.arange(CHUNK) / 16000
+    return [(0.3 * np.sin(2 * np.pi * 220 * t)).astype(np.float32) for _ in range(n)]
+
+
+def _run(frames, **kwargs):
+    real = FakeReal()
+    results = []
+    done = threading.Semaphore(0)
+    events = []
+
+    def on_utterance(audio):
+        results.append((len(audio), micasr.energy_summary(audio), micasr.fixed_transcript(audio)))
+        done.release()
+
+    ingest = MicIngest(real, on_utterance, **kwargs)
+    for i, frame in enumerate(frames):
+        flushes = real.flushes
+        ingest.process(frame)
+        if real.flushes != flushes:
+            events.append(i)
+    return real, ingest, results, done, events
+
+
+def _wait(done, n):
+    for _ in range(n):
+        assert done.acquire(timeout=5)
+
+
+def test_start_interrupts_and_end_submits_utterance():
+    frames = _silence(30) + _voiced(50) + _silence(40)
+    real, ingest, results, done, events = _run(frames)
+    _wait(done, 1)
+    # 第 3 个语音帧时开始, 只打断一次
+    assert events == [32]
+    # preroll 10 帧 + 开始后的语音帧 + 结束前的 25 个静音帧
+    assert results[0][0] == (10 + 48 + 25) * CHUNK
+    assert results[0][2] == micasr.TRANSCRIPT
+    assert ingest.utterance is None and not ingest.vad.speaking
+
+
+def test_silence_does_nothing():
+    real, ingest, results, done, events = _run(_silence(100))
+    assert real.flushes == 0 and results == [] and ingest.utterance is None
+
+
+def test_long_speech_is_flushed_at_max_frames():
+    frames = _silence(20) + _voiced(100) + _silence(30)
+    real, ingest, results, done, events = _run(frames, max_frames=40)
+    _wait(done, 4)
+    assert real.flushes == 1  # 截断提交不会再次打断
+    lengths = [r[0] // CHUNK for r in results]
+    assert sorted(lengths, reverse=True)[:3] == [40, 40, 40]  # 回调在各自的线程中, 顺序不定
+    assert sum(lengths) == 10 + 98 + 25
+    assert ingest.utterance is None
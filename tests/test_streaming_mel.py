@@ -0,0 +1,79 @@
+import types
+
+import numpy as np
+import pytest
+
+from wav2lip import audio
+
+
+def _wav(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.standard_normal(n) * 0.1).astype(np.float32)
+
+
+def test_columns_match_whole_window():
+    mel = audio.StreamingMel()
+    wav = _wav(320 * 52)
+    ref = audio.melspectrogram(wav)
+    for c0, c1 in ((0, 16), (10, 40), (20, ref.shape[1]), (0, ref.shape[1])):
+        np.testing.assert_array_equal(mel.columns(wav, 0, c0, c1), ref[:, c0:c1])
+
+
+def test_columns_reused_when_window_advances_by_whole_hops():
+    stream = _wav(320 * 300, seed=1)
+    mel = audio.StreamingMel()
+    computed = []
+    compute = mel._StreamingMel__compute
+    def counted(wav, c0, c1):
+        computed.append(c1 - c0 + 1)
+        return compute(wav, c0, c1)
+    mel._StreamingMel__compute = counted
+    step, window = 320 * 30, 320 * 52  # 9600 是 hop 的整数倍
+    requested = 0
+    for start in range(0, len(stream) - window, step):
+        wav = stream[start:start + window]
+        got = mel.columns(wav, start, 8, 75)
+        requested += 75 - 8
+        np.testing.assert_array_equal(got, audio.melspectrogram(wav)[:, 8:75])
+    assert sum(computed) < 0.8 * requested  # 与上一个窗口重叠的列来自缓存
+
+
+def _reference_chunks(inputs, batch_size, l, fps, video_fps, offset):
+    '''原来的做法: 对整个窗口计算 melspectrogram 再逐帧切片'''
+    mel = audio.melspectrogram(inputs)
+    left = max(0, l * 80 / fps)
+    mel_idx_multiplier = 80. / video_fps
+    chunks = []
+    for i in range(batch_size):
+        start_idx = int(left + offset + i * mel_idx_multiplier)
+        if start_idx + 16 > len(mel[0]):
+            chunks.append(mel[:, len(mel[0]) - 16:])
+        else:
+            chunks.append(mel[:, start_idx:start_idx + 16])
+    return np.asarray(chunks)
+
+
+@pytest.mark.parametrize('video_fps,batch_size', [(25, 16), (25, 10), (30, 16), (20, 8)])
+def test_run_step_matches_full_window_melspectrogram(video_fps, batch_size):
+    from lipasr import LipASR
+    opt = types.SimpleNamespace(fps=50, video_fps=video_fps, batch_size=batch_size, l=10, r=10, audio_buffer=30)
+    asr = LipASR(opt)
+    speech = _wav(320 * 400, seed=2).reshape(-1, 320)
+    asr.put_audio_frames(speech)
+    frames = []
+    window_start = 0
+    keep = opt.l + opt.r
+    steps = 0
+    while steps < 8:
+        start_frame = asr.clock.frame
+        asr.run_step()
+        while not asr.output_queue.empty():
+            frames.append(asr.output_queue.get()[0])
+        if len(frames) - window_start <= keep:
+            continue
+        got = asr.feat_queue.get_nowait()
+        inputs = np.concatenate(frames[window_start:])
+        ref = _reference_chunks(inputs, batch_size, opt.l, opt.fps, video_fps, asr.frame_offset(start_frame) * 80)
+        np.testing.assert_array_equal(got, ref)
+        window_start = len(frames) - keep
+        steps += 1
@@ -0,0 +1,117 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 本地的替身 TTS 服务, 用来离线比较每句新建连接(requests.post)和 httpclient 连接池的首包时间
+# 新连接先等待 --connect_ms 模拟 TCP/TLS 建连, 每个请求等待 --ttfb_ms 后流式返回 16k int16 pcm
+# python ttsbench.py --requests 20 --connect_ms 60 --ttfb_ms 100
+# 只启动替身服务(返回原始 pcm, 不区分接口): python ttsbench.py --serve --port 9881
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 保持连接
+    disable_nagle_algorithm = True  # 否则保持连接时小包等待延迟确认, 首包多 40ms
+    connect_ms = 0
+    ttfb_ms = 100
+    audio_ms = 2000
+
+    def setup(self):
+        super().setup()
+        time.sleep(self.connect_ms / 1000)
+
+    def log_message(self, format, *args):
+        pass
+
+    def __respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        time.sleep(self.ttfb_ms / 1000)
+        t = np.arange(16 * self.audio_ms) / 16000
+        pcm = (0.3 * np.sin(2 * np.pi * 220 * t) * 32767).astype('<i2').tobytes()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(pcm)))
+        self.end_headers()
+        for i in range(0, len(pcm), 640):  # 20ms 一块
+            self.wfile.write(pcm[i:i + 640])
+
+    do_GET = __respond
+    do_POST = __respond
+
+
+def serve(port=0, connect_ms=0, ttfb_ms=100, audio_ms=2000):
+    '''在后台线程启动替身服务, 返回 (server, url)'''
+    handler = type('Handler', (StandInHandler,), dict(connect_ms=connect_ms, ttfb_ms=ttfb_ms, audio_ms=audio_ms))
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def bare_ttfb(url):
+    import requests
+    start = time.perf_counter()
+    res = requests.post(url, json={'text': 'hi'}, stream=True)
+    ttfb = None
+    for chunk in res.iter_content(chunk_size=640):
+        if ttfb is None and chunk:
+            ttfb = time.perf_counter() - start
+    return ttfb
+
+
+def pooled_ttfb(url):
+    import httpclient
+    start = time.perf_counter()
+    ttfb = None
+    with httpclient.request('POST', url, 'bench', json={'text': 'hi'}) as res:
+        for chunk in res.iter_content(chunk_size=640):
+            if ttfb is None and chunk:
+                ttfb = time.perf_counter() - start
+    return ttfb
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='stand-in streaming TTS server and connection pooling benchmark')
+    parser.add_argument('--serve', action='store_true', help="only run the stand-in server")
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--connect_ms', type=int, default=60, help="delay on each new connection, stands in for TCP/TLS setup")
+    parser.add_argument('--ttfb_ms', type=int, default=100, help="synthesis delay before the first audio chunk")
+    parser.add_argument('--audio_ms', type=int, default=2000)
+    args = parser.parse_args()
+
+    server, url = serve(args.port, args.connect_ms, args.ttfb_ms, args.audio_ms)
+    print(f'stand-in tts server at {url}')
+    if args.serve:
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+    else:
+        import httpclient
+        httpclient.configure(1)
+        for name, fn in (('requests.post', bare_ttfb), ('httpclient', pooled_ttfb)):
+            ttfb = np.array([fn(url + '/tts') for _ in range(args.requests)]) * 1000
+            print(f'{name:14s} ttfb mean {ttfb.mean():.1f}ms  p50 {np.median(ttfb):.1f}ms  max {ttfb.max():.1f}ms')
+    server.shutdown()
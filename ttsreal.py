@@ -16,26 +16,70 @@
 ###############################################################################
 import os
 import time
+import hashlib
 import numpy as np
-import soundfile as sf
-import resampy
 import asyncio
 import edge_tts
 
 from typing import Iterator
 
-import requests
+import httpclient
 
 import queue
 from queue import Queue
-from io import BytesIO
-from threading import Thread, Event
+from threading import Thread, Event, Lock, local
+from collections import deque
 from enum import Enum
 
+from audiostream import Framer,PCMDecoder,MP3Decoder,StreamResampler
+
 class State(Enum):
     RUNNING=0
     PAUSE=1
 
+_edge_loop = None
+_edge_lock = Lock()
+
+def edge_loop():
+    '''edge-tts 在进程内共用一个常驻的事件循环线程, 不再每句新建事件循环'''
+    global _edge_loop
+    with _edge_lock:
+        if _edge_loop is None:
+            _edge_loop = asyncio.new_event_loop()
+            Thread(target=_edge_loop.run_forever, name='edgetts', daemon=True).start()
+    return _edge_loop
+
+class TTSJob:
+    '''一句话的合成任务: 工作线程写入 20ms 帧, 播放线程按句子顺序取出'''
+    def __init__(self,msg,generation):
+        self.msg = msg
+        self.generation = generation  #与 BaseTTS.generation 不同时已被打断
+        self.frames = Queue()  #(frames,eventpoints), None 表示合成结束
+        self.cancelled = False
+        self.__cancels = []  #被打断时调用, 中止进行中的请求
+        self.__lock = Lock()
+
+    def on_cancel(self,fn):
+        '''登记被打断时调用的 fn, 已被打断时立即调用, 返回注销函数(注销后不会再调用 fn)'''
+        with self.__lock:
+            if not self.cancelled:
+                self.__cancels.append(fn)
+                return lambda: self.__remove(fn)
+        fn()
+        return lambda: None
+
+    def __remove(self,fn):
+        with self.__lock:
+            if fn in self.__cancels:
+                self.__cancels.remove(fn)
+
+    def cancel(self):
+        with self.__lock: #fn 只做不阻塞的关闭, 持锁调用保证注销后不会再被调用
+            self.cancelled = True
+            for fn in self.__cancels:
+                fn()
+            self.__cancels = []
+
 class BaseTTS:
     def __init__(self, opt, parent):
         self.opt=opt
@@ -44,14 +88,40 @@ class BaseTTS:
         self.fps = opt.fps # 20 ms per frame
         self.sample_rate = 16000
         self.chunk = self.sample_rate // self.fps # 320 samples per chunk (20ms * 16000 / 1000)
-        self.input_stream = BytesIO()
 
         self.msgqueue = Queue()
         self.state = State.RUNNING
+        self.concurrency = max(1,getattr(opt,'tts_concurrency',2)) #同时合成的句子数
+        self.jobs = deque()  #正在合成或等待播放的句子, 按顺序, 只在播放线程中修改
+        self.generation = 0  #每次 flush_talk 加一, 取消所有进行中的合成
+        self.__local = local()  #工作线程当前的 TTSJob
+        self.__running = set()  #工作线程还没有退出的任务, 包括被打断后已从 jobs 中移除的
+        self.__lock = Lock()
+        self.trim_level = 10**(-50/20) #开头峰值低于 -50dB 的帧视为静音, 不播放
 
     def flush_talk(self):
         self.msgqueue.queue.clear()
         self.state = State.PAUSE
+        self.__cancel_all()
+
+    def __cancel_all(self):
+        self.generation += 1
+        with self.__lock:
+            for job in self.__running:
+                job.cancel()
+
+    def on_cancel(self,fn):
+        '''在工作线程中登记被打断时调用的 fn(中止进行中的请求), 返回注销函数'''
+        job = getattr(self.__local,'job',None)
+        if job is None:
+            return lambda: None
+        return job.on_cancel(fn)
+
+    def __busy(self):
+        '''占用的合成名额: 正在合成或等待播放的句子, 加上被打断后工作线程还没退出的句子'''
+        with self.__lock:
+            stale = [job for job in self.__running if job.generation!=self.generation]
+        return len(self.jobs) + sum(1 for job in stale if job not in self.jobs)
 
     def put_msg_txt(self,msg,eventpoint=None): 
         if len(msg)>0:
@@ -61,18 +131,130 @@ class BaseTTS:
         process_thread = Thread(target=self.process_tts, args=(quit_event,))
         process_thread.start()
     
-    def process_tts(self,quit_event):        
+    def process_tts(self,quit_event):
+        '''
+        播放线程: 后面最多 concurrency-1 句与当前句同时合成, 音频先缓存在各自的 TTSJob 中,
+        严格按句子顺序写入语音缓冲, 句子之间不再等待下一句的首包
+        '''
         while not quit_event.is_set():
+            busy = self.__busy()
+            while busy < self.concurrency:
+                try:
+                    msg = self.msgqueue.get(block=not self.jobs, timeout=1)
+                    self.state=State.RUNNING
+                except queue.Empty:
+                    break
+                job = TTSJob(msg,self.generation)
+                self.jobs.append(job)
+                with self.__lock:
+                    self.__running.add(job)
+                Thread(target=self.__synthesize, args=(job,), daemon=True).start()
+                busy += 1
+            if not self.jobs:
+                if busy >= self.concurrency: #名额都被打断后还没退出的工作线程占用
+                    quit_event.wait(0.01)
+                continue
+            job = self.jobs[0]
             try:
-                msg = self.msgqueue.get(block=True, timeout=1)
-                self.state=State.RUNNING
+                item = job.frames.get(timeout=0.05)
             except queue.Empty:
+                if job.generation!=self.generation:
+                    self.jobs.popleft() #被打断的句子不再等待合成结束
+                continue
+            if item is None or job.generation!=self.generation:
+                self.jobs.popleft()
                 continue
-            self.txt_to_audio(msg)
+            frames,eventpoints = item
+            self.parent.put_audio_frames(frames,eventpoints) #被打断时 flush_talk 已取消所有任务
+        self.__cancel_all()
         print('ttsreal thread stop')
-    
+
+    def __synthesize(self,job):
+        self.__local.job = job
+        try:
+            with httpclient.watch(job.on_cancel): #被打断时中止本句的 http 请求
+                self.txt_to_audio(job.msg)
+        except Exception as e:
+            print(e)
+        finally:
+            with self.__lock:
+                self.__running.discard(job)
+            job.frames.put(None)
+
+    def __put(self,frames,eventpoints):
+        '''在 TTSJob 的工作线程中写入任务缓存, 否则直接写入语音缓冲, 被打断时返回 False'''
+        job = getattr(self.__local,'job',None)
+        if job is None:
+            return self.parent.put_audio_frames(frames,eventpoints)==len(frames)
+        if job.generation!=self.generation:
+            return False
+        job.frames.put((frames,eventpoints))
+        return True
+
+    def __cancelled(self):
+        job = getattr(self.__local,'job',None)
+        return job.generation!=self.generation if job is not None else self.state!=State.RUNNING
+
     def txt_to_audio(self,msg):
         pass
+
+    def __decode(self,audio_stream,sample_rate,wav,decoder):
+        '''逐块返回 (n,chunk) 的 16k 采样, 最后不足 20ms 的部分补 0'''
+        decoder = decoder or PCMDecoder(sample_rate,wav=wav)
+        resampler = None
+        framer = Framer(self.chunk)
+        def resample(samples):
+            nonlocal resampler
+            if resampler is None:
+                if decoder.sample_rate != self.sample_rate:
+                    print(f'[WARN] audio sample rate is {decoder.sample_rate}, resampling into {self.sample_rate}.')
+                resampler = StreamResampler(decoder.sample_rate,self.sample_rate)
+            return framer.push(resampler.push(samples))
+        for chunk in audio_stream:
+            if chunk is None or len(chunk)==0:
+                continue
+            samples = decoder.push(chunk)
+            if len(samples)>0: #wav 头部或 mp3 帧还不完整时为空
+                yield resample(samples)
+        samples = decoder.flush()
+        if len(samples)>0:
+            yield resample(samples)
+        if resampler is not None:
+            yield framer.push(resampler.flush())
+            if len(framer.rest)>0:
+                yield framer.push(np.zeros(self.chunk-len(framer.rest),np.float32))
+
+    def stream_audio(self,audio_stream,msg,sample_rate=None,wav=False,decoder=None):
+        '''
+        所有后端共用的流式阶段: 解码和重采样的状态跨块保留, 不足 20ms 的余量留到下一块,
+        去掉开头的静音, 按 20ms 写入语音缓冲, 第一帧带 start 事件, 结束后补一个带 end 事件的静音帧
+        audio_stream: 字节块, 原始 int16 pcm 时给出 sample_rate, wav=True 时从头部读取, 其他格式给出 decoder
+        '''
+        text,textevent = msg
+        start = time.perf_counter()
+        started = False
+        for frames in self.__decode(audio_stream,sample_rate,wav,decoder):
+            if self.__cancelled():
+                return
+            if not started:
+                voiced = np.flatnonzero(np.abs(frames).max(axis=1,initial=0) >= self.trim_level)
+                if len(voiced)==0:
+                    continue
+                frames = frames[voiced[0]:]
+            eventpoints = [None]*len(frames)
+            if not started:
+                eventpoints[0] = {'status':'start','text':text,'msgenvent':textevent}
+                started = True
+                print(f'[INFO] tts time to first audio: {time.perf_counter()-start:.3f}s')
+            if not self.__put(frames,eventpoints): #被打断
+                return
+        if self.__cancelled(): #被打断时中止了请求
+            return
+        eventpoints = [{'status':'end','text':text,'msgenvent':textevent}]
+        if not started: #没有语音也要发出 start/end 事件, 每帧一个事件点, 用两帧静音
+            print('[WARN] tts returned no speech')
+            eventpoints.insert(0,{'status':'start','text':text,'msgenvent':textevent})
+        self.__put(np.zeros((len(eventpoints),self.chunk),np.float32),eventpoints)
     
 
 ###########################################################################################
@@ -81,69 +263,38 @@ class EdgeTTS(BaseTTS):
         voicename = "zh-CN-XiaoxiaoNeural"
         text,textevent = msg
         t = time.time()
-        asyncio.new_event_loop().run_until_complete(self.__main(voicename,text))
+        chunks = Queue() #mp3 字节块, None 表示结束
+        future = asyncio.run_coroutine_threadsafe(self.__main(voicename,text,chunks),edge_loop())
+        remove = self.on_cancel(future.cancel) #被打断时停止接收, 等待首包时也能立即返回
+        try:
+            self.stream_audio(iter(chunks.get,None),msg,decoder=MP3Decoder())
+        finally:
+            remove()
+            future.cancel()
         print(f'-------edge tts time:{time.time()-t:.4f}s')
-        if self.input_stream.getbuffer().nbytes<=0: #edgetts err
-            print('edgetts err!!!!!')
-            return
-        
-        self.input_stream.seek(0)
-        stream = self.__create_bytes_stream(self.input_stream)
-        streamlen = stream.shape[0]
-        idx=0
-        while streamlen >= self.chunk and self.state==State.RUNNING:
-            eventpoint=None
-            streamlen -= self.chunk
-            if idx==0:
-                eventpoint={'status':'start','text':text,'msgenvent':textevent}
-            elif streamlen<self.chunk:
-                eventpoint={'status':'end','text':text,'msgenvent':textevent}
-            self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-            idx += self.chunk
-        #if streamlen>0:  #skip last frame(not 20ms)
-        #    self.queue.put(stream[idx:])
-        self.input_stream.seek(0)
-        self.input_stream.truncate() 
-
-    def __create_bytes_stream(self,byte_stream):
-        #byte_stream=BytesIO(buffer)
-        stream, sample_rate = sf.read(byte_stream) # [T*sample_rate,] float64
-        print(f'[INFO]tts audio stream {sample_rate}: {stream.shape}')
-        stream = stream.astype(np.float32)
-
-        if stream.ndim > 1:
-            print(f'[WARN] audio has {stream.shape[1]} channels, only use the first.')
-            stream = stream[:, 0]
-    
-        if sample_rate != self.sample_rate and stream.shape[0]>0:
-            print(f'[WARN] audio sample rate is {sample_rate}, resampling into {self.sample_rate}.')
-            stream = resampy.resample(x=stream, sr_orig=sample_rate, sr_new=self.sample_rate)
 
-        return stream
-    
-    async def __main(self,voicename: str, text: str):
+    async def __main(self,voicename: str, text: str, chunks: Queue):
         try:
             communicate = edge_tts.Communicate(text, voicename)
-
-            #with open(OUTPUT_FILE, "wb") as file:
-            first = True
+            received = False
             async for chunk in communicate.stream():
-                if first:
-                    first = False
                 if chunk["type"] == "audio" and self.state==State.RUNNING:
-                    #self.push_audio(chunk["data"])
-                    self.input_stream.write(chunk["data"])
-                    #file.write(chunk["data"])
+                    chunks.put(chunk["data"])
+                    received = True
                 elif chunk["type"] == "WordBoundary":
                     pass
+            if not received: #edgetts err
+                print('edgetts err!!!!!')
         except Exception as e:
             print(e)
+        finally:
+            chunks.put(None)
 
 ###########################################################################################
 class FishTTS(BaseTTS):
     def txt_to_audio(self,msg): 
         text,textevent = msg
-        self.stream_tts(
+        self.stream_audio(
             self.fish_speech(
                 text,
                 self.opt.REF_FILE,  
@@ -151,11 +302,11 @@ class FishTTS(BaseTTS):
                 "zh", #en args.language,
                 self.opt.TTS_SERVER, #"http://127.0.0.1:5000", #args.server_url,
             ),
-            msg
+            msg,
+            wav=True
         )
 
     def fish_speech(self, text, reffile, reftext,language, server_url) -> Iterator[bytes]:
-        start = time.perf_counter()
         req={
             'text':text,
             'reference_id':reffile,
@@ -164,62 +315,31 @@ class FishTTS(BaseTTS):
             'use_memory_cache':'on'
         }
         try:
-            res = requests.post(
+            with httpclient.request(
+                "POST",
                 f"{server_url}/v1/tts",
+                "fish_speech",
                 json=req,
-                stream=True,
                 headers={
                     "content-type": "application/json",
                 },
-            )
-            end = time.perf_counter()
-            print(f"fish_speech Time to make POST: {end-start}s")
-
-            if res.status_code != 200:
-                print("Error:", res.text)
-                return
-                
-            first = True
-        
-            for chunk in res.iter_content(chunk_size=17640): # 1764 44100*20ms*2
-                #print('chunk len:',len(chunk))
-                if first:
-                    end = time.perf_counter()
-                    print(f"fish_speech Time to first chunk: {end-start}s")
-                    first = False
-                if chunk and self.state==State.RUNNING:
-                    yield chunk
-            #print("gpt_sovits response.elapsed:", res.elapsed)
+            ) as res:
+                if res.status_code != 200:
+                    print("Error:", res.text)
+                    return
+
+                for chunk in httpclient.iter_content(res,17640): # 1764 44100*20ms*2, 开头是 wav 头部
+                    #print('chunk len:',len(chunk))
+                    if chunk and self.state==State.RUNNING:
+                        yield chunk
         except Exception as e:
             print(e)
 
-    def stream_tts(self,audio_stream,msg):
-        text,textevent = msg
-        first = True
-        for chunk in audio_stream:
-            if chunk is not None and len(chunk)>0:          
-                stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                stream = resampy.resample(x=stream, sr_orig=44100, sr_new=self.sample_rate)
-                #byte_stream=BytesIO(buffer)
-                #stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
-                    eventpoint=None
-                    if first:
-                        eventpoint={'status':'start','text':text,'msgenvent':textevent}
-                        first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
-        eventpoint={'status':'end','text':text,'msgenvent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
-
 ###########################################################################################
 class VoitsTTS(BaseTTS):
     def txt_to_audio(self,msg): 
         text,textevent = msg
-        self.stream_tts(
+        self.stream_audio(
             self.gpt_sovits(
                 text,
                 self.opt.REF_FILE,  
@@ -227,18 +347,18 @@ class VoitsTTS(BaseTTS):
                 "zh", #en args.language,
                 self.opt.TTS_SERVER, #"http://127.0.0.1:5000", #args.server_url,
             ),
-            msg
+            msg,
+            wav=True
         )
 
     def gpt_sovits(self, text, reffile, reftext,language, server_url) -> Iterator[bytes]:
-        start = time.perf_counter()
         req={
             'text':text,
             'text_lang':language,
             'ref_audio_path':reffile,
             'prompt_text':reftext,
             'prompt_lang':language,
-            'media_type':'ogg',
+            'media_type':'wav', #流式 wav 只在开头有一个头部, 之后都是 pcm
             'streaming_mode':True
         }
         # req["text"] = text
@@ -248,75 +368,94 @@ class VoitsTTS(BaseTTS):
         # #req["stream_chunk_size"] = stream_chunk_size  # you can reduce it to get faster response, but degrade quality
         # req["streaming_mode"] = True
         try:
-            res = requests.post(
+            with httpclient.request(
+                "POST",
                 f"{server_url}/tts",
+                "gpt_sovits",
                 json=req,
-                stream=True,
-            )
-            end = time.perf_counter()
-            print(f"gpt_sovits Time to make POST: {end-start}s")
-
-            if res.status_code != 200:
-                print("Error:", res.text)
-                return
-                
-            first = True
-        
-            for chunk in res.iter_content(chunk_size=None): #12800 1280 32K*20ms*2
-                print('chunk len:',len(chunk))
-                if first:
-                    end = time.perf_counter()
-                    print(f"gpt_sovits Time to first chunk: {end-start}s")
-                    first = False
-                if chunk and self.state==State.RUNNING:
-                    yield chunk
-            #print("gpt_sovits response.elapsed:", res.elapsed)
+            ) as res:
+                if res.status_code != 200:
+                    print("Error:", res.text)
+                    return
+
+                for chunk in httpclient.iter_content(res,None): #12800 1280 32K*20ms*2
+                    #print('chunk len:',len(chunk))
+                    if chunk and self.state==State.RUNNING:
+                        yield chunk
         except Exception as e:
             print(e)
 
-    def __create_bytes_stream(self,byte_stream):
-        #byte_stream=BytesIO(buffer)
-        stream, sample_rate = sf.read(byte_stream) # [T*sample_rate,] float64
-        print(f'[INFO]tts audio stream {sample_rate}: {stream.shape}')
-        stream = stream.astype(np.float32)
-
-        if stream.ndim > 1:
-            print(f'[WARN] audio has {stream.shape[1]} channels, only use the first.')
-            stream = stream[:, 0]
-    
-        if sample_rate != self.sample_rate and stream.shape[0]>0:
-            print(f'[WARN] audio sample rate is {sample_rate}, resampling into {self.sample_rate}.')
-            stream = resampy.resample(x=stream, sr_orig=sample_rate, sr_new=self.sample_rate)
-
-        return stream
-
-    def stream_tts(self,audio_stream,msg):
-        text,textevent = msg
-        first = True
-        for chunk in audio_stream:
-            if chunk is not None and len(chunk)>0:          
-                #stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                #stream = resampy.resample(x=stream, sr_orig=32000, sr_new=self.sample_rate)
-                byte_stream=BytesIO(chunk)
-                stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
-                    eventpoint=None
-                    if first:
-                        eventpoint={'status':'start','text':text,'msgenvent':textevent}
-                        first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
-        eventpoint={'status':'end','text':text,'msgenvent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)
-
 ###########################################################################################
+class CosyPrompt:
+    '''
+    CosyVoice 的参考音频: 每个 (服务器, 参考音频, 参考文本) 只上传注册一次(add_zero_shot_spk), 之后每句只发送文字和 zero_shot_spk_id
+    服务器不支持注册时每句上传参考音频(只读一次文件)
+    '''
+    def __init__(self,server_url,reffile,reftext):
+        self.server_url = server_url
+        self.reftext = reftext
+        with open(reffile,'rb') as f:
+            self.wav = f.read()
+        self.id = 'livetalking_' + hashlib.md5(self.wav + reftext.encode()).hexdigest()[:16]
+        self.spk_id = None  #注册成功后的说话人 id
+        self.supported = True
+        self.retry_at = 0.  #注册失败后等到这个时间再重试, 不要每句都多上传一次参考音频
+        self.lock = Lock()
+
+    def hold(self,seconds=30.):
+        self.retry_at = time.time() + seconds
+
+    def register(self,stale=None):
+        '''
+        stale: 服务器已经忘记的 id, 多个句子同时发现时只重新注册一次
+        返回是否发出了注册请求; 调用前要释放占用的连接名额
+        '''
+        with self.lock:
+            if not self.supported or time.time() < self.retry_at \
+                    or (self.spk_id is not None and self.spk_id != stale):
+                return False
+            self.spk_id = None
+            data = {'prompt_text':self.reftext,'zero_shot_spk_id':self.id}
+            files = [('prompt_wav', ('prompt_wav', self.wav, 'application/octet-stream'))]
+            try:
+                with httpclient.request("POST", f"{self.server_url}/add_zero_shot_spk", "cosy_voice register", data=data, files=files) as res:
+                    if res.status_code in (404,405):
+                        print('[INFO] cosyvoice server has no speaker registration, upload the prompt with every sentence')
+                        self.supported = False
+                    elif res.status_code != 200:
+                        print('[WARN] cosyvoice speaker registration failed:', res.text)
+                        self.hold()
+                    else:
+                        res.content #读完响应, 连接放回连接池
+                        self.spk_id = self.id
+            except Exception as e:
+                print(e)
+                self.hold()
+            return True
+
+    def payload(self,text):
+        '''返回 (data, files)'''
+        data = {'tts_text':text,'prompt_text':self.reftext}
+        if self.spk_id is not None:
+            data['zero_shot_spk_id'] = self.spk_id
+            return data,None
+        return data,[('prompt_wav', ('prompt_wav', self.wav, 'application/octet-stream'))]
+
+_cosy_prompts = {}
+_cosy_lock = Lock()
+
+def cosy_prompt(server_url,reffile,reftext):
+    '''进程内按 (服务器, 参考音频, 参考文本) 共用, 参考音频修改后重新注册'''
+    key = (server_url,os.path.abspath(reffile),os.path.getmtime(reffile),reftext)
+    with _cosy_lock:
+        if key not in _cosy_prompts:
+            _cosy_prompts[key] = CosyPrompt(server_url,reffile,reftext)
+        return _cosy_prompts[key]
+
 class CosyVoiceTTS(BaseTTS):
     def txt_to_audio(self,msg):
         text,textevent = msg 
-        self.stream_tts(
+        self.stream_audio(
             self.cosy_voice(
                 text,
                 self.opt.REF_FILE,  
@@ -324,60 +463,37 @@ class CosyVoiceTTS(BaseTTS):
                 "zh", #en args.language,
                 self.opt.TTS_SERVER, #"http://127.0.0.1:5000", #args.server_url,
             ),
-            msg
+            msg,
+            22050
         )
 
     def cosy_voice(self, text, reffile, reftext,language, server_url) -> Iterator[bytes]:
-        start = time.perf_counter()
-        payload = {
-            'tts_text': text,
-            'prompt_text': reftext
-        }
         try:
-            files = [('prompt_wav', ('prompt_wav', open(reffile, 'rb'), 'application/octet-stream'))]
-            res = requests.request("GET", f"{server_url}/inference_zero_shot", data=payload, files=files, stream=True)
-            
-            end = time.perf_counter()
-            print(f"cosy_voice Time to make POST: {end-start}s")
-
-            if res.status_code != 200:
-                print("Error:", res.text)
+            prompt = cosy_prompt(server_url,reffile,reftext)
+            if prompt.spk_id is None:
+                prompt.register()
+            for retry in (True,False):
+                spk_id = prompt.spk_id
+                payload,files = prompt.payload(text)
+                with httpclient.request("GET", f"{server_url}/inference_zero_shot", "cosy_voice", data=payload, files=files) as res:
+                    if res.status_code == 200:
+                        for chunk in httpclient.iter_content(res,8820): # 882 22.05K*20ms*2
+                            if chunk and self.state==State.RUNNING:
+                                yield chunk
+                        return
+                    error = res.text
+                #退出 with 释放连接名额后再注册, 否则名额用完时注册请求永远等不到名额
+                if spk_id is not None and retry: #服务器重启等原因忘记了说话人, 重新注册
+                    print(f"[WARN] cosyvoice speaker {spk_id} rejected, register again:", error)
+                    if prompt.register(stale=spk_id):
+                        continue
+                elif spk_id is not None: #刚注册的 id 仍被拒绝, 不是说话人的问题, 暂停重新注册
+                    prompt.hold()
+                print("Error:", error)
                 return
-                
-            first = True
-        
-            for chunk in res.iter_content(chunk_size=8820): # 882 22.05K*20ms*2
-                if first:
-                    end = time.perf_counter()
-                    print(f"cosy_voice Time to first chunk: {end-start}s")
-                    first = False
-                if chunk and self.state==State.RUNNING:
-                    yield chunk
         except Exception as e:
             print(e)
 
-    def stream_tts(self,audio_stream,msg):
-        text,textevent = msg
-        first = True
-        for chunk in audio_stream:
-            if chunk is not None and len(chunk)>0:          
-                stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                stream = resampy.resample(x=stream, sr_orig=22050, sr_new=self.sample_rate)
-                #byte_stream=BytesIO(buffer)
-                #stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
-                    eventpoint=None
-                    if first:
-                        eventpoint={'status':'start','text':text,'msgenvent':textevent}
-                        first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
-        eventpoint={'status':'end','text':text,'msgenvent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
-
 ###########################################################################################
 class XTTS(BaseTTS):
     def __init__(self, opt, parent):
@@ -386,7 +502,7 @@ class XTTS(BaseTTS):
 
     def txt_to_audio(self,msg):
         text,textevent = msg  
-        self.stream_tts(
+        self.stream_audio(
             self.xtts(
                 text,
                 self.speaker,
@@ -394,62 +510,34 @@ class XTTS(BaseTTS):
                 self.opt.TTS_SERVER, #"http://localhost:9000", #args.server_url,
                 "20" #args.stream_chunk_size
             ),
-            msg
+            msg,
+            24000
         )
 
     def get_speaker(self,ref_audio,server_url):
-        files = {"wav_file": ("reference.wav", open(ref_audio, "rb"))}
-        response = requests.post(f"{server_url}/clone_speaker", files=files)
-        return response.json()
+        with open(ref_audio, "rb") as f:
+            with httpclient.request("POST", f"{server_url}/clone_speaker", "xtts clone_speaker", files={"wav_file": ("reference.wav", f)}) as res:
+                return res.json()
 
     def xtts(self,text, speaker, language, server_url, stream_chunk_size) -> Iterator[bytes]:
-        start = time.perf_counter()
+        speaker = dict(speaker) #多句同时合成, 不修改共用的 speaker
         speaker["text"] = text
         speaker["language"] = language
         speaker["stream_chunk_size"] = stream_chunk_size  # you can reduce it to get faster response, but degrade quality
         try:
-            res = requests.post(
+            with httpclient.request(
+                "POST",
                 f"{server_url}/tts_stream",
+                "xtts",
                 json=speaker,
-                stream=True,
-            )
-            end = time.perf_counter()
-            print(f"xtts Time to make POST: {end-start}s")
-
-            if res.status_code != 200:
-                print("Error:", res.text)
-                return
-
-            first = True
-        
-            for chunk in res.iter_content(chunk_size=9600): #24K*20ms*2
-                if first:
-                    end = time.perf_counter()
-                    print(f"xtts Time to first chunk: {end-start}s")
-                    first = False
-                if chunk:
-                    yield chunk
+            ) as res:
+                if res.status_code != 200:
+                    print("Error:", res.text)
+                    return
+
+                for chunk in httpclient.iter_content(res,9600): #24K*20ms*2
+                    if chunk:
+                        yield chunk
         except Exception as e:
             print(e)
     
-    def stream_tts(self,audio_stream,msg):
-        text,textevent = msg
-        first = True
-        for chunk in audio_stream:
-            if chunk is not None and len(chunk)>0:          
-                stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                stream = resampy.resample(x=stream, sr_orig=24000, sr_new=self.sample_rate)
-                #byte_stream=BytesIO(buffer)
-                #stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
-                    eventpoint=None
-                    if first:
-                        eventpoint={'status':'start','text':text,'msgenvent':textevent}
-                        first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
-        eventpoint={'status':'end','text':text,'msgenvent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)  
\ No newline at end of file
@@ -50,6 +50,50 @@ def melspectrogram(wav):
         return _normalize(S)
     return S
 
+class StreamingMel:
+    """
+    流式 mel: 相邻窗口大部分重叠, 每步只计算新用到的 STFT 列。
+    中间的列只依赖 [中心-n_fft/2, 中心+n_fft/2) 的采样和它前一个采样(预加重),
+    按列中心的绝对采样位置缓存, 结果与对整个窗口调用 melspectrogram 的对应列相同;
+    受窗口首尾 padding 或窗口首个采样影响的列仍按整窗计算。
+    """
+    def __init__(self):
+        self.n_fft = hp.n_fft
+        self.hop = get_hop_size()
+        window = librosa.filters.get_window('hann', hp.win_size, fftbins=True)
+        self.window = librosa.util.pad_center(window, size=hp.n_fft)[:, None]
+        self.cache = {}  # 列中心的绝对采样位置 -> mel 列
+
+    def num_columns(self, length):
+        return 1 + length // self.hop
+
+    def __compute(self, wav, c0, c1):
+        """wav 中心在 c0*hop..c1*hop 的列, 与 librosa.stft 相同的计算和 dtype"""
+        half = self.n_fft // 2
+        y = preemphasis(wav[c0 * self.hop - half - 1:c1 * self.hop + half], hp.preemphasis, hp.preemphasize)[1:]
+        frames = np.lib.stride_tricks.sliding_window_view(y, self.n_fft)[::self.hop].T
+        D = np.fft.rfft(self.window * frames, axis=0).astype(librosa.util.dtype_r2c(y.dtype))
+        S = _amp_to_db(_linear_to_mel(np.abs(D))) - hp.ref_level_db
+        if hp.signal_normalization:
+            return _normalize(S)
+        return S
+
+    def columns(self, wav, start, c0, c1):
+        """
+        wav: 当前窗口的采样, start: wav[0] 在整段音频中的位置, 窗口只能向后滑动
+        返回 melspectrogram(wav)[:, c0:c1]
+        """
+        half = self.n_fft // 2
+        if c0 * self.hop - half < 1 or (c1 - 1) * self.hop + half > len(wav):
+            return melspectrogram(wav)[:, c0:c1]
+        self.cache = {k: v for k, v in self.cache.items() if k >= start}
+        missing = [c for c in range(c0, c1) if start + c * self.hop not in self.cache]
+        if missing:
+            S = self.__compute(wav, missing[0], missing[-1])
+            for j, c in enumerate(range(missing[0], missing[-1] + 1)):
+                self.cache[start + c * self.hop] = S[:, j]
+        return np.stack([self.cache[start + c * self.hop] for c in range(c0, c1)], axis=1)
+
 def _lws_processor():
     import lws
     return lws.lws(hp.n_fft, get_hop_size(), fftsize=hp.win_size, mode="speech")
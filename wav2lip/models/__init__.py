@@ -1,2 +1,3 @@
 from .wav2lip import Wav2Lip #, Wav2Lip_disc_qual
+from .wav2lip96 import Wav2Lip96
 #from .syncnet import SyncNet_color
\ No newline at end of file
@@ -2,6 +2,25 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
+
+def fold_bn(conv, bn, transpose=False):
+    '''把 BatchNorm 折叠进卷积的 weight/bias, 返回新的卷积层, 只用于推理'''
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    if transpose:  # ConvTranspose2d 的 weight 为 cin,cout,kh,kw
+        fused = nn.ConvTranspose2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride,
+                                   conv.padding, conv.output_padding, conv.groups, True, conv.dilation)
+        weight = conv.weight * scale.reshape(1, -1, 1, 1)
+    else:
+        fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride,
+                          conv.padding, conv.dilation, conv.groups, True)
+        weight = conv.weight * scale.reshape(-1, 1, 1, 1)
+    with torch.no_grad():
+        fused.weight.copy_(weight)
+        fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return fused.to(conv.weight.device)
+
+
 class Conv2d(nn.Module):
     def __init__(self, cin, cout, kernel_size, stride, padding, residual=False, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -18,6 +37,10 @@ class Conv2d(nn.Module):
             out += x
         return self.act(out)
 
+    def fuse(self):
+        if len(self.conv_block) == 2:
+            self.conv_block = nn.Sequential(fold_bn(self.conv_block[0], self.conv_block[1]))
+
 class nonorm_Conv2d(nn.Module):
     def __init__(self, cin, cout, kernel_size, stride, padding, residual=False, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -42,3 +65,7 @@ class Conv2dTranspose(nn.Module):
     def forward(self, x):
         out = self.conv_block(x)
         return self.act(out)
+
+    def fuse(self):
+        if len(self.conv_block) == 2:
+            self.conv_block = nn.Sequential(fold_bn(self.conv_block[0], self.conv_block[1], transpose=True))
@@ -147,31 +147,36 @@ class Wav2Lip(nn.Module):
         self.output_block = nn.Sequential(Conv2d(80, 32, kernel_size=3, stride=1, padding=1),
                                           nn.Conv2d(32, 3, kernel_size=1, stride=1, padding=0),
                                           nn.Sigmoid())
+        self.memory_format = torch.contiguous_format
+
+    def fuse_for_inference(self, channels_last=False):
+        '''把所有 Conv2d+BatchNorm2d 折叠成单个卷积, 只能用于推理(eval), 不能再训练'''
+        self.eval()
+        for m in self.modules():
+            if isinstance(m, (Conv2d, Conv2dTranspose)):
+                m.fuse()
+        if channels_last:
+            self.memory_format = torch.channels_last
+            self.to(memory_format=torch.channels_last)
+        return self
 
     def freeze_audio_encoder(self):
         for p in self.audio_encoder.parameters():
             p.requires_grad = False
 
-    def forward(self, audio_sequences, face_sequences):
-
-        B = audio_sequences.size(0)
-
-        input_dim_size = len(face_sequences.size())
-        if input_dim_size > 4:
-            audio_sequences = torch.cat([audio_sequences[:, i] for i in range(audio_sequences.size(1))], dim=0)
-            face_sequences = torch.cat([face_sequences[:, :, i] for i in range(face_sequences.size(2))], dim=0)
-
-        audio_embedding = self.audio_encoder(audio_sequences)  # B, 512, 1, 1
-
-
-
+    def encode_face(self, face_sequences):
+        # 人脸编码只与 avatar 帧有关, 与音频无关, 可以预先计算缓存
         feats = []
-        x = face_sequences
-
+        x = face_sequences.contiguous(memory_format=self.memory_format)
         for f in self.face_encoder_blocks:
             x = f(x)
             feats.append(x)
+        return feats
 
+    def decode(self, audio_sequences, feats):
+        audio_embedding = self.audio_encoder(audio_sequences.contiguous(memory_format=self.memory_format))  # B, 512, 1, 1
+
+        feats = list(feats)
         x = audio_embedding
         for f in self.face_decoder_blocks:
             x = f(x)
@@ -185,7 +190,18 @@ class Wav2Lip(nn.Module):
 
             feats.pop()
 
-        x = self.output_block(x)
+        return self.output_block(x)
+
+    def forward(self, audio_sequences, face_sequences):
+
+        B = audio_sequences.size(0)
+
+        input_dim_size = len(face_sequences.size())
+        if input_dim_size > 4:
+            audio_sequences = torch.cat([audio_sequences[:, i] for i in range(audio_sequences.size(1))], dim=0)
+            face_sequences = torch.cat([face_sequences[:, :, i] for i in range(face_sequences.size(2))], dim=0)
+
+        x = self.decode(audio_sequences, self.encode_face(face_sequences))
 
         if input_dim_size > 4:
             x = torch.split(x, B, dim=0)  # [(B, C, H, W)]
@@ -195,4 +211,3 @@ class Wav2Lip(nn.Module):
             outputs = x
 
         return outputs
-
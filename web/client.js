@@ -1,11 +1,28 @@
 var pc = null;
 
+// 勾选 use-mic 时上传麦克风, 服务端检测到说话会立即打断数字人
+function micTrack() {
+    const useMic = document.getElementById('use-mic');
+    if (!useMic || !useMic.checked) {
+        return Promise.resolve(null);
+    }
+    return navigator.mediaDevices.getUserMedia({
+        audio: { echoCancellation: true, noiseSuppression: true, autoGainControl: true }
+    }).then((stream) => stream.getAudioTracks()[0]);
+}
+
 function negotiate() {
     console.log("client.js: negotiate() called");
     pc.addTransceiver('video', { direction: 'recvonly' });
-    pc.addTransceiver('audio', { direction: 'recvonly' });
-    console.log("client.js: Transceivers added");
-    return pc.createOffer().then((offer) => {
+    return micTrack().then((track) => {
+        if (track) {
+            pc.addTransceiver(track, { direction: 'sendrecv' });
+        } else {
+            pc.addTransceiver('audio', { direction: 'recvonly' });
+        }
+        console.log("client.js: Transceivers added");
+        return pc.createOffer();
+    }).then((offer) => {
         console.log("client.js: Offer created:", offer.sdp);
         return pc.setLocalDescription(offer);
     }).then(() => {
@@ -34,6 +51,7 @@ function negotiate() {
             body: JSON.stringify({
                 sdp: offer.sdp,
                 type: offer.type,
+                avatar_id: (document.getElementById('avatar_id') || {}).value,
             }),
             headers: {
                 'Content-Type': 'application/json'
@@ -154,6 +172,7 @@ function stop() {
         // Use a short timeout to allow signaling messages to potentially complete
         setTimeout(() => {
              try {
+                 pc.getSenders().forEach((sender) => { if (sender.track) sender.track.stop(); });
                  pc.close();
                  console.log("client.js: PeerConnection closed");
                  pc = null; // Reset pc variable
@@ -29,7 +29,7 @@ import numpy as np
 
 AUDIO_PTIME = 0.020  # 20ms audio packetization
 VIDEO_CLOCK_RATE = 90000
-VIDEO_PTIME = 1 / 25  # 30fps
+VIDEO_PTIME = 1 / 25  # 默认25fps, 实际按 --video_fps
 VIDEO_TIME_BASE = fractions.Fraction(1, VIDEO_CLOCK_RATE)
 SAMPLE_RATE = 16000
 AUDIO_TIME_BASE = fractions.Fraction(1, SAMPLE_RATE)
@@ -56,6 +56,7 @@ class PlayerStreamTrack(MediaStreamTrack):
         self._queue = asyncio.Queue()
         self.timelist = [] #记录最近包的时间戳
         if self.kind == 'video':
+            self.video_ptime = 1 / player.video_fps if player is not None else VIDEO_PTIME
             self.framecount = 0
             self.lasttime = time.perf_counter()
             self.totaltime = 0
@@ -70,7 +71,7 @@ class PlayerStreamTrack(MediaStreamTrack):
         if self.kind == 'video':
             if hasattr(self, "_timestamp"):
                 #self._timestamp = (time.time()-self._start) * VIDEO_CLOCK_RATE
-                self._timestamp += int(VIDEO_PTIME * VIDEO_CLOCK_RATE)
+                self._timestamp += int(self.video_ptime * VIDEO_CLOCK_RATE)
                 wait = self._start + (self._timestamp / VIDEO_CLOCK_RATE) - time.time()
                 # wait = self.timelist[0] + len(self.timelist)*VIDEO_PTIME - time.time()               
                 if wait>0:
@@ -169,6 +170,7 @@ class HumanPlayer:
         self.__audio: Optional[PlayerStreamTrack] = None
         self.__video: Optional[PlayerStreamTrack] = None
 
+        self.video_fps = nerfreal.opt.video_fps
         self.__audio = PlayerStreamTrack(self, kind="audio")
         self.__video = PlayerStreamTrack(self, kind="video")
 